@@ -1,9 +1,25 @@
-from django.test import TestCase
+import json
+import time
+import zlib
+from datetime import timedelta
+from unittest import skipUnless
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
 from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 
-from environments.models import Environment, Identity
-from features.models import Feature, FeatureState
+from app.pagination import table_estimates
+from environments.cache import environment_keys_cache
+from environments.models import Environment, EnvironmentClone, Identity
+from environments.registrations import identity_registrations
+from features.changes import compact_changes
+from features.models import Feature, FeatureState, FeatureStateChange, FeatureStateValue, \
+    BOOLEAN, INTEGER
+from features.streams import change_listener
 from projects.models import Project
 from organisations.models import Organisation
 
@@ -360,6 +376,627 @@ class ProjectFeatureTestCase(TestCase):
         Helper.clean_up()
 
 
+class NestedViewSetQueriesTestCase(TestCase):
+    feature_states_url = '/api/v1/environments/%s/featurestates/'
+    identity_feature_states_url = '/api/v1/environments/%s/identities/%s/featurestates/'
+    identities_url = '/api/v1/environments/%s/identities/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        organisation = Organisation.objects.create(name='ssg')
+        self.project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=self.project)
+        self.identity = Identity.objects.create(identifier='user1', environment=self.environment)
+        for i in range(3):
+            feature = Feature.objects.create(name='feature%d' % i, project=self.project)
+            self.override = FeatureState.objects.create(feature=feature, identity=self.identity,
+                                                        environment=self.environment)
+        # the environment is resolved from the cache of api keys once warm, as are the sizes
+        # of the tables, which decide whether lists are counted
+        environment_keys_cache.get(self.environment.api_key)
+        table_estimates.get(FeatureState)
+        table_estimates.get(Identity)
+
+    def test_should_list_environment_feature_states_with_their_values(self):
+        # When
+        # count and feature states with their values
+        with self.assertNumQueries(2):
+            response = self.client.get(self.feature_states_url % self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['count'], 3)
+
+    def test_should_resolve_identity_once_when_listing_identity_feature_states(self):
+        # When
+        # identity, count and feature states with their values
+        with self.assertNumQueries(3):
+            response = self.client.get(self.identity_feature_states_url %
+                                       (self.environment.api_key, self.identity.identifier))
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['count'], 3)
+
+    def test_should_not_reload_related_objects_when_updating_identity_feature_state(self):
+        # When
+        # identity, feature state with its relations, uniqueness check, update and the value
+        with self.assertNumQueries(5):
+            response = self.client.patch((self.identity_feature_states_url + '%d/') %
+                                         (self.environment.api_key, self.identity.identifier,
+                                          self.override.id),
+                                         data={'enabled': True}, format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['enabled'])
+
+    def test_should_list_identities_without_joining_environment(self):
+        # When
+        with self.assertNumQueries(2):
+            response = self.client.get(self.identities_url % self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['count'], 1)
+
+    def test_should_return_not_found_for_unknown_identity(self):
+        # When
+        response = self.client.get(self.identity_feature_states_url %
+                                   (self.environment.api_key, 'unknown'))
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class CursorPaginationTestCase(TestCase):
+    feature_states_url = '/api/v1/environments/%s/featurestates/'
+    identities_url = '/api/v1/environments/%s/identities/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        organisation = Organisation.objects.create(name='ssg')
+        self.project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=self.project)
+        for i in range(5):
+            Feature.objects.create(name='feature%d' % i, project=self.project)
+            Identity.objects.create(identifier='user%d' % i, environment=self.environment)
+        environment_keys_cache.get(self.environment.api_key)
+
+    def get_pages(self, url):
+        responses = []
+        while url:
+            responses.append(self.client.get(url))
+            url = responses[-1].data['next']
+        return responses
+
+    def test_should_page_through_identities_in_order_of_id(self):
+        # When
+        responses = self.get_pages(self.identities_url % self.environment.api_key +
+                                   '?cursor=&page_size=2')
+
+        # Then
+        self.assertEquals([response.status_code for response in responses],
+                          [status.HTTP_200_OK] * 3)
+        self.assertEquals([identity['identifier'] for response in responses
+                           for identity in response.data['results']],
+                          ['user%d' % i for i in range(5)])
+        self.assertNotIn('count', responses[0].data)
+
+    def test_should_page_through_feature_states_in_order_of_id(self):
+        # Given
+        expected_ids = list(FeatureState.objects.filter(environment=self.environment)
+                            .order_by('id').values_list('id', flat=True))
+
+        # When
+        responses = self.get_pages(self.feature_states_url % self.environment.api_key +
+                                   '?cursor=&page_size=2')
+
+        # Then
+        self.assertEquals([feature_state['id'] for response in responses
+                           for feature_state in response.data['results']], expected_ids)
+
+    def test_should_fetch_later_pages_without_counting(self):
+        # Given
+        first_page = self.client.get(self.identities_url % self.environment.api_key +
+                                     '?cursor=&page_size=2')
+
+        # When
+        # identities only, found from the id at the end of the previous page
+        with self.assertNumQueries(1) as queries:
+            second_page = self.client.get(first_page.data['next'])
+
+        # Then
+        self.assertEquals(len(second_page.data['results']), 2)
+        self.assertNotIn('COUNT', queries.captured_queries[0]['sql'])
+        self.assertNotIn('OFFSET', queries.captured_queries[0]['sql'])
+
+    def test_should_use_page_numbers_without_cursor(self):
+        # When
+        response = self.client.get(self.identities_url % self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['count'], 5)
+
+
+class IdentitySearchTestCase(TestCase):
+    identities_url = '/api/v1/environments/%s/identities/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        organisation = Organisation.objects.create(name='ssg')
+        project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=project)
+        for identifier in ('Alice', 'bob', 'malice'):
+            Identity.objects.create(identifier=identifier, environment=self.environment)
+
+    def test_should_search_identities_by_identifier(self):
+        # When
+        response = self.client.get(self.identities_url % self.environment.api_key +
+                                   '?search=alice')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([identity['identifier'] for identity in response.data['results']],
+                          ['Alice', 'malice'])
+
+    def test_should_search_identities_by_identifier_prefix(self):
+        # When
+        response = self.client.get(self.identities_url % self.environment.api_key +
+                                   '?search=alice&prefix=true')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([identity['identifier'] for identity in response.data['results']],
+                          ['Alice'])
+
+
+class EstimatedCountPaginationTestCase(TestCase):
+    identities_url = '/api/v1/environments/%s/identities/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        organisation = Organisation.objects.create(name='ssg')
+        project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=project)
+        Identity.objects.bulk_create([
+            Identity(identifier='user%d' % i, environment=self.environment) for i in range(5)
+        ])
+        table_estimates.clear()
+
+    def tearDown(self):
+        table_estimates.clear()
+
+    def test_should_count_identities_exactly_below_threshold(self):
+        # When
+        response = self.client.get(self.identities_url % self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['count'], 5)
+        self.assertFalse(response.data['count_is_estimated'])
+
+    @skipUnless(connection.vendor == 'postgresql', "estimates are read from postgres statistics")
+    @override_settings(ESTIMATED_COUNT_THRESHOLD=1)
+    def test_should_estimate_count_of_identities_above_threshold(self):
+        # Given
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE %s' % connection.ops.quote_name(Identity._meta.db_table))
+
+        # When
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.identities_url % self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['count_is_estimated'])
+        self.assertGreaterEqual(response.data['count'], 1)
+        self.assertEquals(len(response.data['results']), 5)
+        self.assertFalse([query for query in queries.captured_queries
+                          if 'COUNT(' in query['sql'].upper()])
+
+
+class EnvironmentCloneTestCase(TestCase):
+    clone_url = '/api/v1/environments/%s/clone/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        self.environment = Environment.objects.get(name="test env")
+        self.feature = Feature.objects.create(name='feature1', project=self.environment.project,
+                                              initial_value='default')
+        feature_state = FeatureState.objects.get(feature=self.feature,
+                                                 environment=self.environment)
+        feature_state.enabled = True
+        feature_state.save()
+        FeatureStateValue.objects.filter(feature_state=feature_state)\
+            .update(type=INTEGER, integer_value=5, string_value=None)
+        self.identity = Identity.objects.create(identifier='user1', environment=self.environment)
+        override = FeatureState.objects.create(feature=self.feature, environment=self.environment,
+                                               identity=self.identity)
+        FeatureStateValue.objects.filter(feature_state=override).update(string_value='override')
+
+    def test_should_clone_environment_feature_states(self):
+        # When
+        response = self.client.post(self.clone_url % self.environment.api_key,
+                                    data={'name': 'QA'}, format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(response.data['status'], EnvironmentClone.COMPLETE)
+        self.assertEquals(response.data['source'], self.environment.api_key)
+        clone = Environment.objects.get(api_key=response.data['environment']['api_key'])
+        self.assertEquals(clone.name, 'QA')
+        feature_state = FeatureState.objects.get(environment=clone, identity=None)
+        self.assertTrue(feature_state.enabled)
+        self.assertEquals(feature_state.get_feature_state_value(), 5)
+        self.assertFalse(clone.identities.exists())
+
+    def test_should_clone_identities_and_their_overrides(self):
+        # When
+        response = self.client.post(self.clone_url % self.environment.api_key,
+                                    data={'name': 'QA', 'include_identities': True},
+                                    format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_201_CREATED)
+        self.assertEquals(response.data['identities_copied'], 1)
+        identity = Identity.objects.get(environment__api_key=response.data['environment']
+                                        ['api_key'])
+        self.assertEquals(identity.identifier, 'user1')
+        override = FeatureState.objects.get(identity=identity)
+        self.assertEquals(override.feature, self.feature)
+        self.assertEquals(override.get_feature_state_value(), 'override')
+        self.assertEquals(FeatureState.objects.filter(identity=self.identity).count(), 1)
+
+    @override_settings(ENVIRONMENT_CLONE_BACKGROUND_IDENTITIES=0)
+    def test_should_copy_identities_of_large_environment_in_background(self):
+        # When
+        response = self.client.post(self.clone_url % self.environment.api_key,
+                                    data={'name': 'QA', 'include_identities': True},
+                                    format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEquals(response.data['status'], EnvironmentClone.PENDING)
+        self.assertEquals(response.data['identity_count'], 1)
+        clone_url = self.clone_url % response.data['environment']['api_key']
+        self.assertEquals(self.client.get(clone_url).data['identities_copied'], 0)
+
+        call_command('run_environment_clones', once=True, stdout=six.StringIO())
+
+        response = self.client.get(clone_url)
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['status'], EnvironmentClone.COMPLETE)
+        self.assertEquals(response.data['identities_copied'], 1)
+        identity = Identity.objects.get(environment__api_key=response.data['environment']
+                                        ['api_key'])
+        self.assertEquals(FeatureState.objects.get(identity=identity).get_feature_state_value(),
+                          'override')
+
+    def test_should_not_find_clone_of_environment_that_is_not_a_clone(self):
+        # When
+        response = self.client.get(self.clone_url % self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class FeatureStateBulkUpdateTestCase(TestCase):
+    bulk_url = '/api/v1/environments/%s/featurestates/bulk/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        self.environment = Environment.objects.get(name="test env")
+        self.features = [Feature.objects.create(name='feature%d' % i,
+                                                project=self.environment.project,
+                                                initial_value='value%d' % i)
+                         for i in range(3)]
+
+    def get_feature_state(self, feature):
+        return FeatureState.objects.get(feature=feature, environment=self.environment,
+                                        identity=None)
+
+    def test_should_update_feature_states_together(self):
+        # Given
+        data = [
+            {'feature': self.features[0].id, 'enabled': True},
+            {'feature': self.features[1].id, 'feature_state_value': 10},
+            {'feature': self.features[2].id, 'enabled': True, 'feature_state_value': False},
+        ]
+
+        # When
+        response = self.client.patch(self.bulk_url % self.environment.api_key, data=data,
+                                     format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(len(response.data), 3)
+        feature_states = [self.get_feature_state(feature) for feature in self.features]
+        self.assertEquals([feature_state.enabled for feature_state in feature_states],
+                          [True, False, True])
+        self.assertEquals([feature_state.get_feature_state_value()
+                           for feature_state in feature_states], ['value0', 10, False])
+        self.assertEquals(FeatureStateChange.objects.filter(
+            environment=self.environment, change_type=FeatureStateChange.CHANGED).count(), 3)
+
+    def test_should_update_feature_states_with_a_fixed_number_of_queries(self):
+        # Given
+        features = self.features + [Feature.objects.create(name='feature%d' % i,
+                                                           project=self.environment.project)
+                                    for i in range(3, 20)]
+        data = [{'feature': feature.id, 'enabled': True, 'feature_state_value': 'on'}
+                for feature in features]
+        environment_keys_cache.get(self.environment.api_key)
+
+        # When
+        # feature states, savepoint, update of enabled flags, values, update of values, change
+        # log, release of savepoint and the updated feature states
+        with self.assertNumQueries(8):
+            response = self.client.patch(self.bulk_url % self.environment.api_key, data=data,
+                                         format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(all(feature_state['enabled'] and
+                            feature_state['feature_state_value'] == 'on'
+                            for feature_state in response.data))
+
+    def test_should_not_apply_any_changes_when_a_feature_is_not_in_environment(self):
+        # Given
+        other_project = Project.objects.create(name='other project',
+                                               organisation=self.environment.project.organisation)
+        other_feature = Feature.objects.create(name='other feature', project=other_project)
+        data = [
+            {'feature': self.features[0].id, 'enabled': True},
+            {'feature': other_feature.id, 'enabled': True},
+        ]
+
+        # When
+        response = self.client.patch(self.bulk_url % self.environment.api_key, data=data,
+                                     format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(self.get_feature_state(self.features[0]).enabled)
+
+    def test_should_reject_invalid_values(self):
+        # When
+        response = self.client.patch(self.bulk_url % self.environment.api_key,
+                                     data=[{'feature': self.features[0].id,
+                                            'feature_state_value': {'a': 1}}],
+                                     format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEquals(self.get_feature_state(self.features[0]).get_feature_state_value(),
+                          'value0')
+
+    def test_should_reject_changing_a_feature_twice(self):
+        # When
+        response = self.client.patch(self.bulk_url % self.environment.api_key,
+                                     data=[{'feature': self.features[0].id, 'enabled': True},
+                                           {'feature': self.features[0].id, 'enabled': False}],
+                                     format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class IdentityImportTestCase(TestCase):
+    import_url = '/api/v1/environments/%s/identities/import/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        self.environment = Environment.objects.get(name="test env")
+        self.feature = Feature.objects.create(name='Feature1', project=self.environment.project,
+                                              initial_value='default')
+        Identity.objects.create(identifier='existing', environment=self.environment)
+
+    def test_should_import_identities_and_overrides_from_csv(self):
+        # Given
+        body = 'identifier,feature,enabled,feature_state_value\n' \
+               'user1,,,\n' \
+               'user2,feature1,true,blue\n' \
+               'existing,feature1,false,\n' \
+               ',feature1,true,\n' \
+               'user3,unknown,true,\n'
+
+        # When
+        response = self.client.post(self.import_url % self.environment.api_key, data=body,
+                                    content_type='text/csv')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['rows'], 5)
+        self.assertEquals(response.data['identities_created'], 2)
+        self.assertEquals(response.data['overrides'], 2)
+        self.assertEquals(response.data['rejected'], 2)
+        self.assertEquals([error['line'] for error in response.data['errors']], [5, 6])
+        self.assertEquals(sorted(self.environment.identities.values_list('identifier', flat=True)),
+                          ['existing', 'user1', 'user2'])
+        override = FeatureState.objects.get(identity__identifier='user2')
+        self.assertTrue(override.enabled)
+        self.assertEquals(override.get_feature_state_value(), 'blue')
+        override = FeatureState.objects.get(identity__identifier='existing')
+        self.assertFalse(override.enabled)
+        self.assertEquals(override.get_feature_state_value(), 'default')
+
+    def test_should_import_identities_and_overrides_from_json_lines(self):
+        # Given
+        body = '\n'.join(json.dumps(row) for row in [
+            {'identifier': 'user1', 'overrides': [
+                {'feature': 'feature1', 'enabled': True, 'feature_state_value': 10},
+            ]},
+            {'identifier': 'user2'},
+        ]) + '\nnot json\n'
+
+        # When
+        response = self.client.post(self.import_url % self.environment.api_key, data=body,
+                                    content_type='application/x-ndjson')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.data['identities_created'], 2)
+        self.assertEquals(response.data['rejected'], 1)
+        override = FeatureState.objects.get(identity__identifier='user1')
+        self.assertEquals(override.get_feature_state_value(), 10)
+
+    def test_should_update_existing_overrides(self):
+        # Given
+        identity = Identity.objects.get(identifier='existing')
+        override = FeatureState.objects.create(feature=self.feature, environment=self.environment,
+                                               identity=identity)
+        body = json.dumps({'identifier': 'existing', 'overrides': [
+            {'feature': 'feature1', 'enabled': True, 'feature_state_value': 'new'},
+        ]})
+
+        # When
+        response = self.client.post(self.import_url % self.environment.api_key, data=body,
+                                    content_type='application/x-ndjson')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        override.refresh_from_db()
+        self.assertTrue(override.enabled)
+        self.assertEquals(FeatureState.objects.get(id=override.id).get_feature_state_value(),
+                          'new')
+
+    def test_should_reject_unsupported_content_type(self):
+        # When
+        response = self.client.post(self.import_url % self.environment.api_key,
+                                    data={'identifier': 'user1'}, format='json')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    @override_settings(IDENTITY_IMPORT_MAX_UPLOAD_SIZE=100)
+    def test_should_refer_uploads_over_the_size_limit_to_the_import_command(self):
+        # Given
+        body = 'identifier\n' + ''.join('user%d\n' % i for i in range(50))
+
+        # When
+        response = self.client.post(self.import_url % self.environment.api_key, data=body,
+                                    content_type='text/csv')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertIn('import_identities', response.json()['detail'])
+        self.assertFalse(Identity.objects.filter(environment=self.environment,
+                                                 identifier__startswith='user').exists())
+
+
+class IdentityExportTestCase(TestCase):
+    export_url = '/api/v1/environments/%s/identities/export/'
+    import_url = '/api/v1/environments/%s/identities/import/'
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(user=Helper.create_ffadminuser())
+        self.environment = Environment.objects.get(name="test env")
+        self.feature = Feature.objects.create(name='feature1', project=self.environment.project)
+        Identity.objects.create(identifier='user1', environment=self.environment)
+        identity = Identity.objects.create(identifier='user2', environment=self.environment)
+        override = FeatureState.objects.create(feature=self.feature, environment=self.environment,
+                                               identity=identity, enabled=True)
+        FeatureStateValue.objects.filter(feature_state=override)\
+            .update(type=INTEGER, integer_value=7)
+
+    def test_should_export_identities_and_overrides_as_json_lines(self):
+        # When
+        response = self.client.get(self.export_url % self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+        self.assertEquals([json.loads(line) for line in lines], [
+            {'identifier': 'user1', 'overrides': []},
+            {'identifier': 'user2', 'overrides': [
+                {'feature': 'feature1', 'enabled': True, 'feature_state_value': 7},
+            ]},
+        ])
+
+    def test_should_export_identities_and_overrides_as_csv(self):
+        # When
+        response = self.client.get(self.export_url % self.environment.api_key,
+                                   HTTP_ACCEPT='text/csv')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(b''.join(response.streaming_content).decode('utf-8').splitlines(), [
+            'identifier,feature,enabled,feature_state_value,feature_state_value_type',
+            'user1,,,,',
+            'user2,feature1,true,7,integer',
+        ])
+
+    def test_should_import_exported_identities_into_another_environment(self):
+        # Given
+        environment = Environment.objects.create(name='other env',
+                                                 project=self.environment.project)
+        response = self.client.get(self.export_url % self.environment.api_key,
+                                   {'format': 'jsonl'})
+
+        # When
+        response = self.client.post(self.import_url % environment.api_key,
+                                    data=b''.join(response.streaming_content),
+                                    content_type='application/x-ndjson')
+
+        # Then
+        self.assertEquals(response.data['identities_created'], 2)
+        override = FeatureState.objects.get(identity__environment=environment)
+        self.assertTrue(override.enabled)
+        self.assertEquals(override.get_feature_state_value(), 7)
+
+    def test_should_keep_types_of_values_exported_as_csv_and_imported_again(self):
+        # Given
+        boolean_feature = Feature.objects.create(name='feature2', project=self.environment.project)
+        override = FeatureState.objects.create(feature=boolean_feature,
+                                               environment=self.environment,
+                                               identity=Identity.objects.get(identifier='user1'))
+        FeatureStateValue.objects.filter(feature_state=override)\
+            .update(type=BOOLEAN, boolean_value=False)
+        environment = Environment.objects.create(name='other env',
+                                                 project=self.environment.project)
+        response = self.client.get(self.export_url % self.environment.api_key, {'format': 'csv'})
+
+        # When
+        response = self.client.post(self.import_url % environment.api_key,
+                                    data=b''.join(response.streaming_content),
+                                    content_type='text/csv')
+
+        # Then
+        self.assertEquals(response.data['overrides'], 2)
+        self.assertEquals(response.data['rejected'], 0)
+        overrides = FeatureState.objects.filter(identity__environment=environment)
+        self.assertIs(overrides.get(feature=self.feature).get_feature_state_value(), 7)
+        self.assertIs(overrides.get(feature=boolean_feature).get_feature_state_value(), False)
+
+    def test_should_reject_csv_values_not_of_their_type(self):
+        # Given
+        body = 'identifier,feature,enabled,feature_state_value,feature_state_value_type\n' \
+               'user3,feature1,true,seven,integer\n' \
+               'user4,feature1,true,maybe,boolean\n' \
+               'user5,feature1,true,7,number\n'
+
+        # When
+        response = self.client.post(self.import_url % self.environment.api_key, data=body,
+                                    content_type='text/csv')
+
+        # Then
+        self.assertEquals(response.data['rejected'], 3)
+        self.assertEquals([error['error'] for error in response.data['errors']],
+                          ['Invalid integer value seven', 'Invalid boolean value maybe',
+                           'Unknown value type number'])
+
+
 class UserTestCase(TestCase):
     auth_base_url = '/api/v1/auth/'
     register_template = '{ ' \
@@ -438,6 +1075,802 @@ class UserTestCase(TestCase):
         self.assertEquals(user.organisations.all().count(), 2)
 
 
+class SDKFeatureStatesTestCase(TestCase):
+    flags_url = '/api/v1/flags/'
+
+    def setUp(self):
+        # drop any registrations left over by other tests
+        identity_registrations.flush()
+        self.client = APIClient()
+        organisation = Organisation.objects.create(name='ssg')
+        self.project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=self.project)
+        self.feature = Feature.objects.create(name='feature1', project=self.project,
+                                              initial_value='value')
+
+    def get_flags(self):
+        return self.client.get(self.flags_url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+    def test_environment_flags_are_served_without_queries_once_cached(self):
+        # Given
+        self.get_flags()
+
+        # When
+        with self.assertNumQueries(0):
+            response = self.get_flags()
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        flags = json.loads(response.content.decode('utf-8'))
+        self.assertEquals(len(flags), 1)
+        self.assertEquals(flags[0]['feature']['name'], 'feature1')
+        self.assertEquals(flags[0]['feature_state_value'], 'value')
+
+    def test_environment_flags_are_refreshed_when_feature_state_changes(self):
+        # Given
+        self.get_flags()
+        feature_state = FeatureState.objects.get(feature=self.feature, identity=None)
+
+        # When
+        feature_state.enabled = True
+        feature_state.save()
+        response = self.get_flags()
+
+        # Then
+        self.assertTrue(json.loads(response.content.decode('utf-8'))[0]['enabled'])
+
+    def test_environment_flags_are_refreshed_when_feature_state_value_changes(self):
+        # Given
+        self.get_flags()
+        feature_state_value = FeatureState.objects.get(feature=self.feature, identity=None)\
+            .feature_state_value
+
+        # When
+        feature_state_value.string_value = 'new value'
+        feature_state_value.save()
+        response = self.get_flags()
+
+        # Then
+        flags = json.loads(response.content.decode('utf-8'))
+        self.assertEquals(flags[0]['feature_state_value'], 'new value')
+
+    def test_environment_flags_are_refreshed_when_feature_created_or_deleted(self):
+        # Given
+        self.get_flags()
+
+        # When
+        Feature.objects.create(name='feature2', project=self.project)
+        flags_after_create = json.loads(self.get_flags().content.decode('utf-8'))
+        self.feature.delete()
+        flags_after_delete = json.loads(self.get_flags().content.decode('utf-8'))
+
+        # Then
+        self.assertEquals(len(flags_after_create), 2)
+        self.assertEquals([flag['feature']['name'] for flag in flags_after_delete], ['feature2'])
+
+    def test_environment_flags_not_served_once_environment_deleted(self):
+        # Given
+        self.get_flags()
+
+        # When
+        self.environment.delete()
+        response = self.get_flags()
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_environment_flags_not_modified_without_queries_when_etag_matches(self):
+        # Given
+        etag = self.get_flags()['ETag']
+
+        # When
+        with self.assertNumQueries(0):
+            response = self.client.get(self.flags_url,
+                                       HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                       HTTP_IF_NONE_MATCH=etag)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response['ETag'], etag)
+
+    def test_environment_flags_etag_changes_when_feature_state_changes(self):
+        # Given
+        etag = self.get_flags()['ETag']
+        FeatureState.objects.filter(feature=self.feature, identity=None).get().save()
+
+        # When
+        response = self.client.get(self.flags_url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                   HTTP_IF_NONE_MATCH=etag)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertNotEquals(response['ETag'], etag)
+
+    def test_identity_flags_not_modified_without_touching_feature_states(self):
+        # Given
+        url = self.flags_url + 'user1'
+        etag = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)['ETag']
+
+        # When
+        # the environment is resolved from the cache of api keys
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                       HTTP_IF_NONE_MATCH=etag)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_identity_flags_etag_changes_when_identity_override_changes(self):
+        # Given
+        url = self.flags_url + 'user1'
+        identity = Identity.objects.create(identifier='user1', environment=self.environment)
+        etag = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)['ETag']
+
+        # When
+        FeatureState.objects.create(feature=self.feature, environment=self.environment,
+                                    identity=identity, enabled=True)
+        response = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                   HTTP_IF_NONE_MATCH=etag)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertNotEquals(response['ETag'], etag)
+        self.assertTrue(response.json()[0]['enabled'])
+
+    def test_identity_flags_are_fetched_in_constant_queries_regardless_of_feature_count(self):
+        # Given
+        url = self.flags_url + 'user1'
+        identity = Identity.objects.create(identifier='user1', environment=self.environment)
+        for i in range(10):
+            feature = Feature.objects.create(name='feature %d' % i, project=self.project)
+            if i % 2:
+                FeatureState.objects.create(feature=feature, environment=self.environment,
+                                            identity=identity, enabled=True)
+
+        # When
+        # environment, identity and flags
+        with self.assertNumQueries(3):
+            response = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(len(response.json()), 11)
+        self.assertEquals(len([flag for flag in response.json() if flag['identity']]), 5)
+
+    def test_unknown_identity_gets_environment_flags_and_is_registered_later(self):
+        # Given
+        url = self.flags_url + 'user1'
+        environment_flags = json.loads(self.get_flags().content.decode('utf-8'))
+
+        # When
+        response = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(json.loads(response.content.decode('utf-8')), environment_flags)
+        self.assertFalse(Identity.objects.filter(identifier='user1').exists())
+
+        identity_registrations.flush()
+        self.assertTrue(Identity.objects.filter(identifier='user1',
+                                                environment=self.environment).exists())
+
+    @override_settings(IDENTITY_REGISTRATION_BATCH_SIZE=2)
+    def test_identity_registrations_are_flushed_once_batch_is_full(self):
+        # When
+        for identifier in ('user1', 'user2', 'user1'):
+            self.client.get(self.flags_url + identifier,
+                            HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(Identity.objects.filter(environment=self.environment).count(), 2)
+
+    def test_single_feature_is_returned_on_its_own(self):
+        # When
+        response = self.client.get(self.flags_url + '?feature=FEATURE1',
+                                   HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+        missing_response = self.client.get(self.flags_url + '?feature=missing',
+                                           HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.json()['feature']['name'], 'feature1')
+        self.assertEquals(missing_response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_multiple_features_are_fetched_in_one_query(self):
+        # Given
+        Feature.objects.create(name='feature2', project=self.project)
+        Feature.objects.create(name='feature3', project=self.project)
+
+        url = self.flags_url + '?feature=feature1,feature3'
+        # load the feature names
+        self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # When
+        # only the flags, the environment is resolved from the cache of api keys
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals([flag['feature']['name'] for flag in response.json()],
+                          ['feature1', 'feature3'])
+
+    def test_single_feature_with_comma_in_its_name_is_returned_on_its_own(self):
+        # Given
+        Feature.objects.create(name='feature1,feature2', project=self.project)
+
+        # When
+        response = self.client.get(self.flags_url, {'feature': 'feature1,feature2'},
+                                   HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.json()['feature']['name'], 'feature1,feature2')
+
+    def test_unknown_features_are_reported_when_fetching_multiple_features(self):
+        # When
+        response = self.client.get(self.flags_url, {'feature': ['feature1', 'missing']},
+                                   HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+        list_response = self.client.get(self.flags_url, {'feature': 'feature1,missing'},
+                                        HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEquals(response.data['features'], ['missing'])
+        self.assertEquals(list_response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEquals(list_response.data['features'], ['missing'])
+
+    def test_multiple_features_for_identity_fall_back_to_environment_defaults(self):
+        # Given
+        feature_two = Feature.objects.create(name='feature2', project=self.project)
+        identity = Identity.objects.create(identifier='user1', environment=self.environment)
+        FeatureState.objects.create(feature=feature_two, environment=self.environment,
+                                    identity=identity, enabled=True)
+
+        url = self.flags_url + 'user1?feature=feature1&feature=feature2'
+        # load the feature names
+        self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # When
+        # identity and flags
+        with self.assertNumQueries(2):
+            response = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals([(flag['feature']['name'], flag['identity']) for flag in response.json()],
+                          [('feature1', None), ('feature2', identity.id)])
+
+    def test_feature_names_are_reloaded_when_feature_renamed(self):
+        # Given
+        url = self.flags_url + '?feature=renamed'
+        self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # When
+        self.feature.name = 'Renamed'
+        self.feature.save()
+        response = self.client.get(url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.json()['feature']['id'], self.feature.id)
+
+    def test_environment_flags_are_served_compressed_when_accepted(self):
+        # Given
+        document = self.get_flags().content
+
+        # When
+        response = self.client.get(self.flags_url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                   HTTP_ACCEPT_ENCODING='gzip, deflate')
+        not_modified_response = self.client.get(self.flags_url,
+                                                HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                                HTTP_ACCEPT_ENCODING='gzip, deflate',
+                                                HTTP_IF_NONE_MATCH=response['ETag'])
+
+        # Then
+        self.assertEquals(response['Content-Encoding'], 'gzip')
+        self.assertEquals(zlib.decompress(response.content, 16 + zlib.MAX_WBITS), document)
+        self.assertNotEquals(response['ETag'], self.get_flags()['ETag'])
+        self.assertIn('Accept-Encoding', response['Vary'])
+        self.assertEquals(not_modified_response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+    def test_environment_flags_are_not_compressed_when_encoding_refused(self):
+        # When
+        response = self.client.get(self.flags_url, HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                   HTTP_ACCEPT_ENCODING='gzip;q=0')
+
+        # Then
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEquals(response.json()[0]['feature']['name'], 'feature1')
+
+
+@override_settings(FEATURE_STATE_CHANGES_SETTLE_SECONDS=0)
+class SDKFlagsDeltaTestCase(TestCase):
+    flags_url = '/api/v1/flags/'
+
+    def setUp(self):
+        self.client = APIClient()
+        organisation = Organisation.objects.create(name='ssg')
+        self.project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=self.project)
+        self.feature = Feature.objects.create(name='feature1', project=self.project)
+
+    def get_delta(self, since):
+        return self.client.get(self.flags_url, {'since': since},
+                               HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+    def test_should_return_all_flags_and_version_when_client_has_no_version(self):
+        # When
+        response = self.get_delta(0)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        delta = response.json()
+        self.assertTrue(delta['full'])
+        self.assertEquals([flag['feature']['name'] for flag in delta['added']], ['feature1'])
+        self.assertTrue(delta['version'] > 0)
+
+    def test_should_return_only_flags_changed_since_version(self):
+        # Given
+        feature2 = Feature.objects.create(name='feature2', project=self.project)
+        feature2_id = feature2.id
+        version = self.get_delta(0).json()['version']
+        feature_state = FeatureState.objects.get(feature=self.feature, identity=None)
+
+        # When
+        feature_state.enabled = True
+        feature_state.save()
+        feature3 = Feature.objects.create(name='feature3', project=self.project)
+        feature2.delete()
+        delta = self.get_delta(version).json()
+
+        # Then
+        self.assertFalse(delta['full'])
+        self.assertEquals([flag['feature']['id'] for flag in delta['changed']], [self.feature.id])
+        self.assertTrue(delta['changed'][0]['enabled'])
+        self.assertEquals([flag['feature']['id'] for flag in delta['added']], [feature3.id])
+        self.assertEquals(delta['removed'], [feature2_id])
+        self.assertTrue(delta['version'] > version)
+
+    def test_should_return_empty_delta_when_nothing_changed(self):
+        # Given
+        version = self.get_delta(0).json()['version']
+
+        # When
+        delta = self.get_delta(version).json()
+
+        # Then
+        self.assertEquals(delta['version'], version)
+        self.assertEquals((delta['added'], delta['changed'], delta['removed']), ([], [], []))
+
+    def test_should_not_return_flags_added_and_removed_since_version(self):
+        # Given
+        version = self.get_delta(0).json()['version']
+
+        # When
+        Feature.objects.create(name='feature2', project=self.project).delete()
+        delta = self.get_delta(version).json()
+
+        # Then
+        self.assertEquals((delta['added'], delta['changed'], delta['removed']), ([], [], []))
+
+    def test_should_return_all_flags_when_changes_compacted_since_version(self):
+        # Given
+        version = self.get_delta(0).json()['version']
+
+        # When
+        compact_changes(timezone.now() + timedelta(seconds=1))
+        delta = self.get_delta(version).json()
+
+        # Then
+        self.assertTrue(delta['full'])
+        self.assertEquals([flag['feature']['name'] for flag in delta['added']], ['feature1'])
+
+    def test_should_not_resynchronise_when_compacted_again_without_changes(self):
+        # Given
+        compact_changes(timezone.now() + timedelta(seconds=1))
+        version = self.get_delta(0).json()['version']
+
+        # When
+        compact_changes(timezone.now() + timedelta(seconds=1))
+        delta = self.get_delta(version).json()
+
+        # Then
+        self.assertFalse(delta['full'])
+        self.assertEquals(delta['version'], version)
+        self.assertEquals(list(FeatureStateChange.objects.filter(environment=self.environment)
+                               .values_list('id', flat=True)), [version])
+
+    def test_should_return_bad_request_if_version_invalid(self):
+        # When
+        response = self.get_delta('abc')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+@override_settings(FLAG_STREAM_POLL_INTERVAL=0, FLAG_STREAM_KEEPALIVE_INTERVAL=0.01,
+                   FEATURE_STATE_CHANGES_SETTLE_SECONDS=0, FLAG_STREAMS_HOLD_REQUESTS=True)
+class SDKFlagsStreamTestCase(TestCase):
+    stream_url = '/api/v1/stream/flags/'
+
+    def setUp(self):
+        change_listener.clear()
+        self.client = APIClient()
+        organisation = Organisation.objects.create(name='ssg')
+        self.project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=self.project)
+        self.feature = Feature.objects.create(name='feature1', project=self.project)
+
+    def open_stream(self):
+        response = self.client.get(self.stream_url,
+                                   HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+        stream = iter(response.streaming_content)
+        self.assertEquals(next(stream), b': connected\n\n')
+        return response, stream
+
+    @staticmethod
+    def read_event(stream):
+        event = next(stream).decode('utf-8')
+        fields = dict(line.split(': ', 1) for line in event.strip().split('\n'))
+        return fields['id'], json.loads(fields['data'])
+
+    def test_should_send_all_flags_when_stream_opened(self):
+        # Given
+        response, stream = self.open_stream()
+
+        # When
+        change_listener.poll()
+        event_id, delta = self.read_event(stream)
+
+        # Then
+        self.assertEquals(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(delta['full'])
+        self.assertEquals([flag['feature']['name'] for flag in delta['added']], ['feature1'])
+        self.assertEquals(int(event_id), delta['version'])
+
+    def test_should_send_changes_to_all_streams_with_constant_queries(self):
+        # Given
+        streams = [self.open_stream()[1] for _ in range(3)]
+        change_listener.poll()
+        for stream in streams:
+            self.read_event(stream)
+        feature_state = FeatureState.objects.get(feature=self.feature, identity=None)
+        feature_state.enabled = True
+        feature_state.save()
+
+        # When
+        with self.assertNumQueries(3):
+            change_listener.poll()
+
+        # Then
+        for stream in streams:
+            _, delta = self.read_event(stream)
+            self.assertFalse(delta['full'])
+            self.assertEquals([flag['enabled'] for flag in delta['changed']], [True])
+
+    def test_should_send_keepalive_when_nothing_changed(self):
+        # Given
+        _, stream = self.open_stream()
+        change_listener.poll()
+        self.read_event(stream)
+
+        # When
+        change_listener.poll()
+
+        # Then
+        self.assertEquals(next(stream), b': keepalive\n\n')
+
+    def settle_changes(self):
+        FeatureStateChange.objects.update(created_date=timezone.now() - timedelta(minutes=1))
+
+    def enable_feature(self, feature):
+        feature_state = FeatureState.objects.get(feature=feature, identity=None)
+        feature_state.enabled = True
+        feature_state.save()
+
+    @override_settings(FEATURE_STATE_CHANGES_SETTLE_SECONDS=5)
+    def test_should_send_change_committed_late_with_lower_id(self):
+        # Given
+        other_feature = Feature.objects.create(name='feature2', project=self.project)
+        self.settle_changes()
+        _, stream = self.open_stream()
+        change_listener.poll()
+        self.read_event(stream)
+        self.enable_feature(self.feature)
+        self.enable_feature(other_feature)
+        # the first change is still being committed when the second is seen
+        late_change = FeatureStateChange.objects.filter(feature_id=self.feature.id).latest('id')
+        late_change_id = late_change.id
+        late_change.delete()
+        change_listener.poll()
+        _, delta = self.read_event(stream)
+        self.assertEquals([flag['feature']['name'] for flag in delta['changed']], ['feature2'])
+
+        # When
+        late_change.id = late_change_id
+        late_change.save()
+        change_listener.poll()
+
+        # Then
+        _, delta = self.read_event(stream)
+        self.assertEquals(sorted(flag['feature']['name'] for flag in delta['changed']),
+                          ['feature1', 'feature2'])
+
+    @override_settings(FEATURE_STATE_CHANGES_SETTLE_SECONDS=5)
+    def test_should_move_stream_on_to_latest_version_once_changes_settle(self):
+        # Given
+        self.settle_changes()
+        _, stream = self.open_stream()
+        change_listener.poll()
+        event_id, _ = self.read_event(stream)
+        self.enable_feature(self.feature)
+        change_listener.poll()
+        unsettled_event_id, _ = self.read_event(stream)
+        self.settle_changes()
+
+        # When
+        change_listener.poll()
+
+        # Then
+        settled_event_id, delta = self.read_event(stream)
+        self.assertEquals(unsettled_event_id, event_id)
+        self.assertEquals(int(settled_event_id),
+                          FeatureStateChange.objects.filter(environment=self.environment)
+                          .latest('id').id)
+        self.assertEquals([flag['enabled'] for flag in delta['changed']], [True])
+        change_listener.poll()
+        self.assertEquals(next(stream), b': keepalive\n\n')
+
+    def test_should_accept_environment_key_as_query_parameter(self):
+        # Given
+        response = self.client.get(self.stream_url, {'environment_key': self.environment.api_key})
+        stream = iter(response.streaming_content)
+        self.assertEquals(next(stream), b': connected\n\n')
+
+        # When
+        change_listener.poll()
+
+        # Then
+        _, delta = self.read_event(stream)
+        self.assertTrue(delta['full'])
+
+    @override_settings(FLAG_STREAMS_HOLD_REQUESTS=None, FLAG_SYNC_WORKER_RETRY_INTERVAL=30)
+    def test_should_send_flags_and_end_stream_under_synchronous_worker(self):
+        # When
+        response = self.client.get(self.stream_url,
+                                   HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        events = list(response.streaming_content)
+        self.assertEquals(events[0], b'retry: 30000\n\n')
+        _, delta = self.read_event(iter(events[1:]))
+        self.assertTrue(delta['full'])
+        self.assertEquals(len(events), 2)
+        self.assertFalse(change_listener._subscriptions)
+
+    @override_settings(FLAG_STREAMS_HOLD_REQUESTS=False)
+    def test_should_only_send_retry_under_synchronous_worker_when_nothing_changed(self):
+        # Given
+        version = FeatureStateChange.objects.filter(environment=self.environment).latest('id').id
+
+        # When
+        response = self.client.get(self.stream_url, {'since': version},
+                                   HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(len(list(response.streaming_content)), 1)
+
+    def test_should_return_not_found_for_unknown_environment(self):
+        # When
+        response = self.client.get(self.stream_url, HTTP_X_ENVIRONMENT_KEY='unknown')
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+@override_settings(FLAG_STREAM_POLL_INTERVAL=0, FLAG_LONG_POLL_TIMEOUT=0.01,
+                   FEATURE_STATE_CHANGES_SETTLE_SECONDS=0, FLAG_STREAMS_HOLD_REQUESTS=True)
+class SDKFeatureStatesLongPollTestCase(TestCase):
+    poll_url = '/api/v1/stream/flags/poll/'
+
+    def setUp(self):
+        change_listener.clear()
+        self.client = APIClient()
+        organisation = Organisation.objects.create(name='ssg')
+        self.project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=self.project)
+        self.feature = Feature.objects.create(name='feature1', project=self.project)
+
+    def long_poll(self, version):
+        return self.client.get(self.poll_url, {'version': version},
+                               HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+    def test_should_return_flags_straight_away_when_client_is_behind(self):
+        # When
+        response = self.long_poll(0)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.json()[0]['feature']['name'], 'feature1')
+        self.assertTrue(int(response['X-Environment-Version']) > 0)
+
+    def test_should_expose_version_header_to_browsers(self):
+        # When
+        response = self.client.get(self.poll_url, {'version': 0},
+                                   HTTP_X_ENVIRONMENT_KEY=self.environment.api_key,
+                                   HTTP_ORIGIN='https://example.com')
+
+        # Then
+        self.assertIn('X-Environment-Version', response['Access-Control-Expose-Headers'])
+
+    def test_should_return_flags_straight_away_when_change_log_is_empty(self):
+        # Given
+        FeatureStateChange.objects.filter(environment=self.environment).delete()
+
+        # When
+        response = self.long_poll(0)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals(response.json()[0]['feature']['name'], 'feature1')
+        self.assertEquals(response['X-Environment-Version'], '0')
+
+    def test_should_return_not_modified_when_nothing_changes_before_timeout(self):
+        # Given
+        version = self.long_poll(0)['X-Environment-Version']
+
+        # When
+        response = self.long_poll(version)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response['X-Environment-Version'], version)
+
+    def test_should_return_new_flags_once_changed(self):
+        # Given
+        version = self.long_poll(0)['X-Environment-Version']
+        feature_state = FeatureState.objects.get(feature=self.feature, identity=None)
+        feature_state.enabled = True
+        feature_state.save()
+
+        # When
+        response = self.long_poll(version)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.json()[0]['enabled'])
+        self.assertTrue(int(response['X-Environment-Version']) > int(version))
+
+    @override_settings(FEATURE_STATE_CHANGES_SETTLE_SECONDS=5)
+    def test_should_return_settled_version_while_changes_settle(self):
+        # Given
+        FeatureStateChange.objects.update(created_date=timezone.now() - timedelta(minutes=1))
+        settled_version = FeatureStateChange.objects.filter(environment=self.environment)\
+            .latest('id').id
+        feature_state = FeatureState.objects.get(feature=self.feature, identity=None)
+        feature_state.enabled = True
+        feature_state.save()
+
+        # When
+        response = self.long_poll(0)
+
+        # Then
+        self.assertTrue(response.json()[0]['enabled'])
+        self.assertEquals(response['X-Environment-Version'], str(settled_version))
+        self.assertEquals(self.long_poll(settled_version).status_code,
+                          status.HTTP_304_NOT_MODIFIED)
+
+    @override_settings(FLAG_STREAMS_HOLD_REQUESTS=None, FLAG_SYNC_WORKER_RETRY_INTERVAL=30,
+                       FLAG_LONG_POLL_TIMEOUT=30)
+    def test_should_return_not_modified_straight_away_under_synchronous_worker(self):
+        # Given
+        version = self.long_poll(0)['X-Environment-Version']
+
+        # When
+        started = time.time()
+        response = self.long_poll(version)
+
+        # Then
+        self.assertTrue(time.time() - started < 5)
+        self.assertEquals(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response['Retry-After'], '30')
+
+    def test_should_wake_watchers_when_changes_settle(self):
+        # Given
+        Feature.objects.create(name='feature2', project=self.project)
+        change_event = change_listener.watch(self.environment.id)
+        with self.settings(FEATURE_STATE_CHANGES_SETTLE_SECONDS=5):
+            change_listener.poll()
+        self.assertFalse(change_event.is_set())
+
+        # When
+        change_listener.poll()
+
+        # Then
+        self.assertTrue(change_event.is_set())
+
+    def test_should_wake_all_watchers_of_environment_on_change(self):
+        # Given
+        change_events = [change_listener.watch(self.environment.id) for _ in range(3)]
+        change_listener.poll()
+        Feature.objects.create(name='feature2', project=self.project)
+
+        # When
+        change_listener.poll()
+
+        # Then
+        self.assertTrue(all(change_event.is_set() for change_event in change_events))
+        self.assertFalse(change_listener.watch(self.environment.id).is_set())
+
+
+class SDKIdentitiesFeatureStatesTestCase(TestCase):
+    identities_flags_url = '/api/v1/identities/flags/'
+
+    def setUp(self):
+        identity_registrations.flush()
+        self.client = APIClient()
+        organisation = Organisation.objects.create(name='ssg')
+        self.project = Project.objects.create(name='project1', organisation=organisation)
+        self.environment = Environment.objects.create(name='environment1', project=self.project)
+        self.features = [Feature.objects.create(name='feature%d' % i, project=self.project)
+                         for i in range(3)]
+
+    def get_identities_flags(self, identifiers):
+        response = self.client.post(self.identities_flags_url,
+                                    data=json.dumps({'identifiers': identifiers}),
+                                    content_type='application/json',
+                                    HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+        content = b''.join(response.streaming_content)
+        return response, json.loads(content.decode('utf-8'))
+
+    def test_should_return_effective_flags_for_each_identity(self):
+        # Given
+        identity = Identity.objects.create(identifier='user1', environment=self.environment)
+        FeatureState.objects.create(feature=self.features[1], environment=self.environment,
+                                    identity=identity, enabled=True)
+
+        # When
+        response, identities_flags = self.get_identities_flags(['user1', 'user2', 'user1'])
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_200_OK)
+        self.assertEquals([identity_flags['identifier'] for identity_flags in identities_flags],
+                          ['user1', 'user2'])
+
+        user1_flags = identities_flags[0]['flags']
+        self.assertEquals([flag['feature']['name'] for flag in user1_flags],
+                          ['feature0', 'feature2', 'feature1'])
+        self.assertEquals([flag['enabled'] for flag in user1_flags], [False, False, True])
+
+        user2_flags = identities_flags[1]['flags']
+        self.assertEquals([flag['identity'] for flag in user2_flags], [None, None, None])
+
+    def test_should_resolve_identities_in_constant_queries(self):
+        # Given
+        identifiers = ['user%d' % i for i in range(20)]
+        for identifier in identifiers[:10]:
+            identity = Identity.objects.create(identifier=identifier,
+                                               environment=self.environment)
+            FeatureState.objects.create(feature=self.features[0], environment=self.environment,
+                                        identity=identity, enabled=True)
+
+        # When
+        # environment, environment flags, identities and overrides
+        with self.assertNumQueries(4):
+            _, identities_flags = self.get_identities_flags(identifiers)
+
+        # Then
+        self.assertEquals(len(identities_flags), 20)
+
+    def test_should_return_bad_request_if_identifiers_not_a_list(self):
+        # When
+        response = self.client.post(self.identities_flags_url,
+                                    data=json.dumps({'identifiers': 'user1'}),
+                                    content_type='application/json',
+                                    HTTP_X_ENVIRONMENT_KEY=self.environment.api_key)
+
+        # Then
+        self.assertEquals(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
 class Helper:
     def __init__(self):
         pass
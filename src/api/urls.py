@@ -1,6 +1,7 @@
 from django.conf.urls import url, include
 
-from features.views import SDKFeatureStates
+from features.views import SDKFeatureStates, SDKFeatureStatesLongPoll, SDKFlagsStream, \
+    SDKIdentitiesFeatureStates
 
 urlpatterns = [
     url(r'^v1/', include([
@@ -14,6 +15,9 @@ urlpatterns = [
         url(r'^e2etests/', include('e2etests.urls')),
 
         # Client SDK urls
+        url(r'^identities/flags/$', SDKIdentitiesFeatureStates.as_view()),
+        url(r'^stream/flags/$', SDKFlagsStream.as_view()),
+        url(r'^stream/flags/poll/$', SDKFeatureStatesLongPoll.as_view()),
         url(r'^flags/(?P<identifier>\w+)', SDKFeatureStates.as_view()),
         url(r'^flags/', SDKFeatureStates.as_view()),
 
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+
+def create_index_concurrently(schema_editor, name, table, definition, unique=False):
+    """
+    Create an index, unless it exists, without blocking writes to the table so that it can be
+    added to a live database. On PostgreSQL the index is built concurrently, which can't be done
+    in a transaction so the migration mustn't be atomic. A concurrent build that fails leaves an
+    invalid index behind, which is dropped and built again when the migration is retried.
+
+    :param definition: the rest of the statement after the table, e.g. the indexed columns
+    """
+    connection = schema_editor.connection
+    concurrently = ''
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+                           [name])
+            row = cursor.fetchone()
+        if row and row[0]:
+            drop_index_concurrently(schema_editor, name)
+        concurrently = 'CONCURRENTLY '
+
+    schema_editor.execute('CREATE %sINDEX %sIF NOT EXISTS %s ON %s %s' % (
+        'UNIQUE ' if unique else '', concurrently, name, table, definition))
+
+
+def drop_index_concurrently(schema_editor, name):
+    concurrently = 'CONCURRENTLY ' if schema_editor.connection.vendor == 'postgresql' else ''
+    schema_editor.execute('DROP INDEX %sIF EXISTS %s' % (concurrently, name))
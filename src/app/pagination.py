@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models.query import QuerySet
+from django.utils.functional import cached_property
+from django.utils import six
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
+
+
+class TableEstimates(object):
+    """
+    Process local cache of the number of rows in each table according to the planner's
+    statistics, kept for ``ttl`` seconds. Only PostgreSQL keeps statistics that are cheap to
+    read; on other databases there are no estimates.
+    """
+    ttl = 60
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, model, using='default'):
+        """
+        :return: estimated number of rows in the model's table, or None if there is no estimate
+        """
+        connection = connections[using]
+        if connection.vendor != 'postgresql':
+            return None
+
+        key = (using, model._meta.db_table)
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and entry[1] > time.time():
+            return entry[0]
+
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                           [connection.ops.quote_name(model._meta.db_table)])
+            row = cursor.fetchone()
+        # tables that have never been analysed have no statistics
+        estimate = int(row[0]) if row and row[0] >= 0 else None
+
+        with self._lock:
+            self._entries[key] = (estimate, time.time() + self.ttl)
+        return estimate
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+table_estimates = TableEstimates()
+
+
+def get_estimated_count(queryset):
+    """
+    Estimate the number of results of a queryset from the planner's statistics, if it is likely
+    to have at least ESTIMATED_COUNT_THRESHOLD results. The whole table is estimated from
+    pg_class and a filtered queryset from the row estimate of its plan.
+
+    :return: the estimate, or None if the queryset should be counted exactly
+    """
+    threshold = settings.ESTIMATED_COUNT_THRESHOLD
+    table_estimate = table_estimates.get(queryset.model, queryset.db)
+    if table_estimate is None or table_estimate < threshold:
+        return None
+
+    query = queryset.query
+    if not query.where and not query.distinct and query.low_mark == 0 and \
+            query.high_mark is None:
+        return table_estimate
+
+    sql, params = queryset.order_by().query.get_compiler(queryset.db).as_sql()
+    with connections[queryset.db].cursor() as cursor:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, six.string_types):
+        plan = json.loads(plan)
+
+    estimate = int(plan[0]['Plan']['Plan Rows'])
+    return estimate if estimate >= threshold else None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator that reports an estimate of the number of objects, rather than counting them, when
+    there are likely to be at least ESTIMATED_COUNT_THRESHOLD of them, see
+    ``get_estimated_count``. As the estimate can be out, the last pages may be short or empty, or
+    not reachable.
+    """
+    count_is_estimated = False
+
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet):
+            estimate = get_estimated_count(self.object_list)
+            if estimate is not None:
+                self.count_is_estimated = True
+                return estimate
+
+        return super(EstimatedCountPaginator, self).count
+
+
+class EstimatedCountPagination(PageNumberPagination):
+    """
+    Page number pagination using ``EstimatedCountPaginator``. Responses have a
+    ``count_is_estimated`` flag next to the count.
+    """
+    django_paginator_class = EstimatedCountPaginator
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('count', self.page.paginator.count),
+            ('count_is_estimated', self.page.paginator.count_is_estimated),
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data)
+        ]))
+
+
+class IdCursorPagination(CursorPagination):
+    """
+    Keyset pagination ordered by id. Each page is found from the id at the end of the previous
+    page, so every page costs the same as the first and no count is needed.
+    """
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 999
+
+
+class OptionalCursorPagination(EstimatedCountPagination):
+    """
+    Page number pagination, as used by the rest of the API, unless the request has a ``cursor``
+    query parameter, in which case the list is paginated with ``IdCursorPagination``. Pass an
+    empty cursor to get the first page and follow the ``next`` links from there.
+    """
+    cursor_query_param = IdCursorPagination.cursor_query_param
+
+    def __init__(self):
+        self.cursor_pagination = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.cursor_query_param in request.query_params:
+            self.cursor_pagination = IdCursorPagination()
+            return self.cursor_pagination.paginate_queryset(queryset, request, view)
+
+        return super(OptionalCursorPagination, self).paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_pagination is not None:
+            return self.cursor_pagination.get_paginated_response(data)
+
+        return super(OptionalCursorPagination, self).get_paginated_response(data)
+
+    def get_schema_fields(self, view):
+        return super(OptionalCursorPagination, self).get_schema_fields(view) + \
+            IdCursorPagination().get_schema_fields(view)
@@ -10,7 +10,9 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
+import hashlib
 import os
+import tempfile
 import warnings
 
 from corsheaders.defaults import default_headers
@@ -84,7 +86,7 @@ REST_FRAMEWORK = {
     ),
     'PAGE_SIZE': 999,
     'UNICODE_JSON': False,
-    'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination'
+    'DEFAULT_PAGINATION_CLASS': 'app.pagination.EstimatedCountPagination'
 }
 
 REST_AUTH_REGISTER_SERIALIZERS = {
@@ -167,6 +169,10 @@ CORS_ALLOW_HEADERS = default_headers + (
     'X-Environment-Key',
     'X-E2E-Test-Auth-Token'
 )
+# so that browser clients of the long-poll endpoint can read the version of the flags returned
+CORS_EXPOSE_HEADERS = (
+    'X-Environment-Version',
+)
 
 DEFAULT_FROM_EMAIL = "noreply@bullet-train.io"
 EMAIL_CONFIGURATION = {
@@ -206,6 +212,73 @@ SWAGGER_SETTINGS = {
     "SHOW_REQUEST_HEADERS": True
 }
 
+# Versions that each process's caches of environments and flags are checked against. Shared
+# memory keeps the workers on a host in step, with files in a directory private to the user
+# running the app, by default one per installation in the system's temporary directory; use
+# environments.versions.PostgresNotifyVersions with a channel name as the location to keep
+# processes on several hosts in step.
+ENVIRONMENT_VERSIONS = {
+    'BACKEND': 'environments.versions.SharedMemoryVersions',
+    'LOCATION': os.path.join(tempfile.gettempdir(), 'bullet-train-versions-%s' % hashlib.sha1(
+        BASE_DIR.encode('utf-8')).hexdigest()[:12]),
+}
+
+# Each process caches the environments of up to this many api keys for up to this many seconds,
+# and remembers api keys that don't belong to an environment for a shorter time
+ENVIRONMENT_KEY_CACHE_SIZE = 10000
+ENVIRONMENT_KEY_CACHE_TTL = 300
+ENVIRONMENT_KEY_CACHE_NEGATIVE_TTL = 10
+
+# Identities first seen by the SDK endpoints are created in batches once either this many are
+# waiting or the oldest has been waiting for this many seconds
+IDENTITY_REGISTRATION_BATCH_SIZE = 500
+IDENTITY_REGISTRATION_FLUSH_INTERVAL = 5
+
+# Identities imported through the import endpoint or the import_identities command are written in
+# batches of this many, each in its own transaction. The endpoint imports bodies of up to this many
+# bytes within the request, larger files are imported with the command
+IDENTITY_IMPORT_BATCH_SIZE = 1000
+IDENTITY_IMPORT_MAX_UPLOAD_SIZE = 10 * 1024 * 1024
+
+# Identities are exported a chunk of this many at a time, each chunk's overrides with one query
+IDENTITY_EXPORT_CHUNK_SIZE = 2000
+
+# Changes to feature states are reported to polling clients as part of a version once they are
+# this many seconds old, and are kept for this many days by compact_feature_state_changes
+FEATURE_STATE_CHANGES_SETTLE_SECONDS = 5
+FEATURE_STATE_CHANGES_RETENTION_DAYS = 7
+
+# Each process checks for changes to send to its flag streams this often, in seconds. Streams
+# send a comment when idle for FLAG_STREAM_KEEPALIVE_INTERVAL seconds so that proxies keep them
+# open and closed connections are noticed.
+FLAG_STREAM_POLL_INTERVAL = 1
+FLAG_STREAM_KEEPALIVE_INTERVAL = 15
+
+# Longest time in seconds a long poll for flags waits for a change before returning 304
+FLAG_LONG_POLL_TIMEOUT = 30
+
+# Streams and long polls only wait for changes under asynchronous (gevent or eventlet) workers,
+# as each waiting client would tie up a synchronous worker. Under synchronous workers they return
+# the changes there are straight away and ask clients to come back after
+# FLAG_SYNC_WORKER_RETRY_INTERVAL seconds. Set FLAG_STREAMS_HOLD_REQUESTS to True or False rather
+# than None to override the detection of the worker class.
+FLAG_STREAMS_HOLD_REQUESTS = None
+FLAG_SYNC_WORKER_RETRY_INTERVAL = 30
+
+# Identities are copied to a cloned environment in batches of this many, by the
+# run_environment_clones worker when the source environment has more than
+# ENVIRONMENT_CLONE_BACKGROUND_IDENTITIES of them. The worker checks for clones to copy every
+# ENVIRONMENT_CLONE_POLL_INTERVAL seconds and takes over clones that haven't copied a batch for
+# ENVIRONMENT_CLONE_STALE_SECONDS, as their worker has stopped.
+ENVIRONMENT_CLONE_BATCH_SIZE = 10000
+ENVIRONMENT_CLONE_BACKGROUND_IDENTITIES = 1000
+ENVIRONMENT_CLONE_POLL_INTERVAL = 5
+ENVIRONMENT_CLONE_STALE_SECONDS = 600
+
+# Lists in the API and the admin report an estimate from the planner's statistics, rather than an
+# exact count, when they are likely to have at least this many results. PostgreSQL only.
+ESTIMATED_COUNT_THRESHOLD = 100000
+
 # Email associated with user that is used by front end for end to end testing purposes
 FE_E2E_TEST_USER_EMAIL = "nightwatch@solidstategroup.com"
 
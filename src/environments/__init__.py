@@ -0,0 +1 @@
+default_app_config = 'environments.apps.EnvironmentsConfig'
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 
+from app.pagination import EstimatedCountPaginator
 from .models import Identity, Environment
 
 
@@ -16,7 +17,17 @@ class EnvironmentAdmin(admin.ModelAdmin):
 
 @admin.register(Identity)
 class IdentityAdmin(admin.ModelAdmin):
-    date_hierarchy = 'created_date'
+    # no date hierarchy or full count, which both aggregate over the whole table
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     list_display = ('__str__', 'created_date', 'environment', )
     list_filter = ('created_date', 'environment', )
     search_fields = ('identifier', )
+
+    def get_search_results(self, request, queryset, search_term):
+        # a search for "text*" only matches identifiers starting with the text, which can be
+        # answered from an index
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        return queryset.search(search_term.rstrip('*'), prefix=search_term.endswith('*')), False
@@ -6,3 +6,6 @@ from django.apps import AppConfig
 
 class EnvironmentsConfig(AppConfig):
     name = 'environments'
+
+    def ready(self):
+        from . import signals  # noqa: F401
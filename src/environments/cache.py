@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+from .models import Environment
+from .versions import environment_versions
+
+# The parts of an environment needed to serve the SDK endpoints
+CachedEnvironment = namedtuple('CachedEnvironment', ('id', 'project_id', 'api_key'))
+
+
+class EnvironmentKeysCache(object):
+    """
+    Process local LRU cache of api keys to environments, so that resolving the X-Environment-Key
+    header doesn't need a query on every request.
+
+    An entry is only used while the environment's version is unchanged, so saving or deleting the
+    environment (in any process) invalidates it, and for at most ENVIRONMENT_KEY_CACHE_TTL
+    seconds. Keys that don't belong to an environment are remembered for
+    ENVIRONMENT_KEY_CACHE_NEGATIVE_TTL seconds so that clients using a bad key don't each cost a
+    query.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        """
+        Get the environment with the given api key.
+
+        :raises Environment.DoesNotExist: if there is no environment with the api key
+        """
+        with self._lock:
+            entry = self._entries.pop(api_key, None)
+            if entry is not None:
+                # move the entry to the most recently used end
+                self._entries[api_key] = entry
+
+        if entry is not None and entry[2] > time.time():
+            environment, version, _ = entry
+            if environment is None:
+                raise Environment.DoesNotExist("Environment matching query does not exist.")
+            if version == environment_versions.get(environment.id):
+                return environment
+
+        try:
+            environment = self.load(api_key)
+        except Environment.DoesNotExist:
+            self.set(api_key, None, None, settings.ENVIRONMENT_KEY_CACHE_NEGATIVE_TTL)
+            raise
+
+        return environment
+
+    def load(self, api_key):
+        environment_id, project_id = Environment.objects.filter(api_key=api_key)\
+            .values_list('id', 'project_id').get()
+        version = environment_versions.get(environment_id)
+        environment = CachedEnvironment(environment_id, project_id, api_key)
+        self.set(api_key, environment, version, settings.ENVIRONMENT_KEY_CACHE_TTL)
+        return environment
+
+    def set(self, api_key, environment, version, ttl):
+        with self._lock:
+            self._entries.pop(api_key, None)
+            self._entries[api_key] = (environment, version, time.time() + ttl)
+            while len(self._entries) > settings.ENVIRONMENT_KEY_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, api_key):
+        with self._lock:
+            self._entries.pop(api_key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+environment_keys_cache = EnvironmentKeysCache()
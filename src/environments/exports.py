@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import csv
+import json
+from collections import OrderedDict, defaultdict
+
+from django.conf import settings
+from django.utils import six
+from rest_framework.renderers import BaseRenderer
+
+from features.models import BOOLEAN, INTEGER, STRING, FeatureState
+from .imports import BOOLEAN_VALUE, CSV, INTEGER_VALUE, JSONL, STRING_VALUE
+from .models import Identity
+
+CSV_COLUMNS = ('identifier', 'feature', 'enabled', 'feature_state_value',
+               'feature_state_value_type')
+
+
+def _get_value(value_type, integer_value, string_value, boolean_value):
+    if value_type == INTEGER:
+        return integer_value
+    elif value_type == STRING:
+        return string_value
+    elif value_type == BOOLEAN:
+        return boolean_value
+    return None
+
+
+def iter_identities(environment_id, chunk_size=None):
+    """
+    Walk the identities of an environment in order of id, a chunk at a time, with the overrides
+    of each chunk fetched by a single query. Each chunk of identities is found from the id of the
+    last identity of the previous chunk rather than with an offset, so every chunk costs the same
+    however far into the environment it is, and no cursor is held open between chunks.
+
+    :return: iterator of (identifier, list of overrides) tuples, with each override in the form
+        read by the import, see ``environments.imports``
+    """
+    chunk_size = chunk_size or settings.IDENTITY_EXPORT_CHUNK_SIZE
+    last_identity_id = 0
+
+    while True:
+        identities = list(
+            Identity.objects.filter(environment_id=environment_id, id__gt=last_identity_id)
+            .order_by('id')
+            .values_list('id', 'identifier')[:chunk_size]
+        )
+        if not identities:
+            return
+
+        overrides = defaultdict(list)
+        rows = FeatureState.objects.filter(
+            identity__environment_id=environment_id,
+            identity_id__gt=last_identity_id,
+            identity_id__lte=identities[-1][0],
+        ).order_by('identity_id', 'feature_id').values_list(
+            'identity_id', 'feature__name', 'enabled', 'feature_state_value__type',
+            'feature_state_value__integer_value', 'feature_state_value__string_value',
+            'feature_state_value__boolean_value',
+        )
+        # read with a server side cursor where the database supports one
+        for row in rows.iterator():
+            overrides[row[0]].append(OrderedDict((
+                ('feature', row[1]),
+                ('enabled', row[2]),
+                ('feature_state_value', _get_value(*row[3:])),
+            )))
+
+        for identity_id, identifier in identities:
+            yield identifier, overrides.pop(identity_id, [])
+
+        last_identity_id = identities[-1][0]
+
+
+def render_jsonl(identities):
+    """
+    Render identities as JSON Lines, one line per identity.
+
+    :param identities: iterator of (identifier, list of overrides) tuples
+    :return: iterator of lines of UTF-8 encoded bytes
+    """
+    for identifier, overrides in identities:
+        line = OrderedDict((('identifier', identifier), ('overrides', overrides)))
+        yield json.dumps(line, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class _Line(object):
+    """
+    File like object holding the last line written to it by a CSV writer.
+    """
+    value = None
+
+    def write(self, value):
+        self.value = value
+
+
+def _render_csv_row(writer, line, row):
+    if six.PY2:
+        row = [value.encode('utf-8') if isinstance(value, six.text_type) else value
+               for value in row]
+    writer.writerow(row)
+    return line.value if six.PY2 else line.value.encode('utf-8')
+
+
+def render_csv_rows(rows):
+    """
+    :param rows: iterator of rows of strings
+    :return: iterator of lines of UTF-8 encoded bytes
+    """
+    line = _Line()
+    writer = csv.writer(line)
+    for row in rows:
+        yield _render_csv_row(writer, line, row)
+
+
+def _get_csv_rows(identities):
+    yield CSV_COLUMNS
+    for identifier, overrides in identities:
+        if not overrides:
+            yield identifier, '', '', '', ''
+
+        for override in overrides:
+            value = override['feature_state_value']
+            if value is None:
+                value, value_type = '', ''
+            elif isinstance(value, bool):
+                value, value_type = 'true' if value else 'false', BOOLEAN_VALUE
+            elif isinstance(value, six.integer_types):
+                value_type = INTEGER_VALUE
+            else:
+                value_type = STRING_VALUE
+            yield (identifier, override['feature'], 'true' if override['enabled'] else 'false',
+                   value, value_type)
+
+
+def render_csv(identities):
+    """
+    Render identities as CSV with a row per override, and a row without a feature for each
+    identity that has no overrides. The type of each value is given next to it so that the file
+    can be imported again without changing the values.
+
+    :param identities: iterator of (identifier, list of overrides) tuples
+    :return: iterator of lines of UTF-8 encoded bytes
+    """
+    return render_csv_rows(_get_csv_rows(identities))
+
+
+def render(identities, export_format):
+    if export_format == CSV:
+        return render_csv(identities)
+    return render_jsonl(identities)
+
+
+class CSVRenderer(BaseRenderer):
+    """
+    Renderer for the CSV identity export, which streams its own response. Only used to render
+    errors, as a row of the error's fields.
+    """
+    media_type = 'text/csv'
+    format = CSV
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if not isinstance(data, dict):
+            return b''
+        return b''.join(render_csv_rows([list(data.keys()),
+                                         [six.text_type(value) for value in data.values()]]))
+
+
+class JSONLRenderer(BaseRenderer):
+    """
+    Renderer for the JSON Lines identity export, which streams its own response. Only used to
+    render errors, as a single line.
+    """
+    media_type = 'application/x-ndjson'
+    format = JSONL
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(data).encode('utf-8') + b'\n'
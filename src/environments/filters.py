@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import coreapi
+from rest_framework.filters import BaseFilterBackend
+
+_TRUE_VALUES = ('true', '1')
+
+
+class IdentitySearchFilter(BaseFilterBackend):
+    """
+    Filter identities by a ``search`` for text in their identifier, or only at the start of it
+    when ``prefix`` is true. See ``IdentityQuerySet.search``.
+    """
+    search_param = 'search'
+    prefix_param = 'prefix'
+
+    def filter_queryset(self, request, queryset, view):
+        text = request.query_params.get(self.search_param, '').strip()
+        if not text:
+            return queryset
+
+        prefix = request.query_params.get(self.prefix_param, '').lower() in _TRUE_VALUES
+        return queryset.search(text, prefix=prefix)
+
+    def get_schema_fields(self, view):
+        return [
+            coreapi.Field(self.search_param, location='query', required=False,
+                          description="Text to search for in identifiers, ignoring case"),
+            coreapi.Field(self.prefix_param, location='query', required=False,
+                          description="Set to true to only match identifiers starting with the "
+                                      "search text, which is faster"),
+        ]
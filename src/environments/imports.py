@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import codecs
+import csv
+import json
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models.functions import Lower
+from django.utils import six
+
+from features.models import Feature, FeatureState
+from .models import Identity
+
+CSV = 'csv'
+JSONL = 'jsonl'
+FORMATS = (CSV, JSONL)
+
+# content types of uploads accepted in each format
+CONTENT_TYPES = {
+    'text/csv': CSV,
+    'application/x-ndjson': JSONL,
+    'application/jsonl': JSONL,
+    'application/x-jsonlines': JSONL,
+}
+
+_TRUE_VALUES = ('true', 't', 'yes', 'y', '1')
+_FALSE_VALUES = ('false', 'f', 'no', 'n', '0')
+
+# types of value given in the feature_state_value_type column of CSV files
+STRING_VALUE = 'string'
+INTEGER_VALUE = 'integer'
+BOOLEAN_VALUE = 'boolean'
+
+
+class RejectedRow(Exception):
+    pass
+
+
+def read_csv_rows(lines):
+    """
+    Read the rows of a CSV import. The file has an ``identifier`` column and, to set overrides,
+    ``feature``, ``enabled``, ``feature_state_value`` and ``feature_state_value_type`` columns.
+    Each row sets at most one override so an identity with several overrides takes several rows.
+    Values are read as the type given, one of ``string``, ``integer`` or ``boolean``, and as
+    strings in files without a type column.
+
+    :param lines: iterable of lines of text
+    :return: iterator of (line number, identifier, list of overrides) tuples
+    """
+    reader = csv.DictReader(lines)
+    for row in reader:
+        overrides = []
+        if row.get('feature'):
+            override = {'feature': row['feature']}
+            if row.get('enabled'):
+                override['enabled'] = row['enabled']
+            if row.get('feature_state_value_type'):
+                override['feature_state_value'] = row.get('feature_state_value') or ''
+                override['feature_state_value_type'] = row['feature_state_value_type']
+            elif row.get('feature_state_value'):
+                override['feature_state_value'] = row['feature_state_value']
+            overrides.append(override)
+
+        yield reader.line_num, row.get('identifier'), overrides
+
+
+def read_jsonl_rows(lines):
+    """
+    Read the rows of a JSON Lines import. Each line is an object with an ``identifier`` and,
+    optionally, a list of ``overrides`` of the form {"feature": <name>, "enabled": <bool>,
+    "feature_state_value": <value>}.
+
+    :param lines: iterable of lines of text
+    :return: iterator of (line number, identifier, list of overrides) tuples, with None in place
+        of the identifier for lines that aren't valid
+    """
+    for line_number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        if not isinstance(row, dict) or not isinstance(row.get('overrides', []), list):
+            yield line_number, None, []
+            continue
+
+        yield line_number, row.get('identifier'), row.get('overrides', [])
+
+
+def read_rows(stream, import_format):
+    """
+    Read the rows of an import from a stream of UTF-8 encoded bytes, a line at a time.
+    """
+    lines = codecs.iterdecode(stream, 'utf-8')
+    if import_format == CSV:
+        return read_csv_rows(lines)
+    return read_jsonl_rows(lines)
+
+
+class IdentityImport(object):
+    """
+    Import of identities, and optionally their overrides, into an environment. Rows are read one
+    at a time and written in batches of IDENTITY_IMPORT_BATCH_SIZE identities, each in its own
+    transaction, so memory use doesn't depend on the size of the import. Identities that already
+    exist are kept and only have the overrides given for them set.
+
+    Rows that can't be imported are counted and, up to ``max_errors`` of them, reported with the
+    reason they were rejected.
+    """
+    max_errors = 100
+    # number of identifiers whose identities are fetched per query, kept below SQLite's limit of
+    # 999 query parameters
+    lookup_batch_size = 500
+
+    def __init__(self, environment, batch_size=None):
+        self.environment = environment
+        self.batch_size = batch_size or settings.IDENTITY_IMPORT_BATCH_SIZE
+        self.rows = 0
+        self.identities_created = 0
+        self.overrides = 0
+        self.rejected = 0
+        self.errors = []
+        self.seconds = 0.0
+        self._features = None
+        self._batch = OrderedDict()
+
+    def run(self, rows):
+        """
+        :param rows: iterator of (line number, identifier, list of overrides) tuples
+        :return: self, with the statistics of the import
+        """
+        started = time.time()
+        for line_number, identifier, overrides in rows:
+            self.rows += 1
+            try:
+                self.add(identifier, overrides)
+            except RejectedRow as e:
+                self.reject(line_number, six.text_type(e))
+
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+
+        self.flush()
+        self.seconds = time.time() - started
+        return self
+
+    def add(self, identifier, overrides):
+        if not isinstance(identifier, six.string_types) or not identifier:
+            raise RejectedRow("Missing identifier")
+        if len(identifier) > Identity._meta.get_field('identifier').max_length:
+            raise RejectedRow("Identifier is too long")
+
+        # validated before being added so that a rejected row doesn't set some of its overrides
+        identity_overrides = self._batch.get(identifier, {}).copy()
+        for override in overrides:
+            feature_id, change = self.get_override(override)
+            identity_overrides[feature_id] = change
+
+        self._batch[identifier] = identity_overrides
+
+    def get_override(self, override):
+        if not isinstance(override, dict):
+            raise RejectedRow("Overrides must be objects")
+
+        feature_id = self.get_features().get(six.text_type(override.get('feature', '')).lower())
+        if feature_id is None:
+            raise RejectedRow("Unknown feature %s" % override.get('feature'))
+
+        change = {}
+        if 'enabled' in override:
+            change['enabled'] = self.get_enabled(override['enabled'])
+        if 'feature_state_value' in override:
+            value = override['feature_state_value']
+            if 'feature_state_value_type' in override:
+                value = self.get_typed_value(value, override['feature_state_value_type'])
+            if isinstance(value, (dict, list)):
+                raise RejectedRow("Values must be strings, integers or booleans")
+            if isinstance(value, six.integer_types) and not isinstance(value, bool) and \
+                    not -2 ** 31 <= value < 2 ** 31:
+                raise RejectedRow("Integer values must fit in 32 bits")
+            if isinstance(value, six.string_types) and len(value) > 2000:
+                raise RejectedRow("Values must have no more than 2000 characters")
+            change['feature_state_value'] = value
+
+        return feature_id, change
+
+    def get_enabled(self, enabled):
+        if isinstance(enabled, bool):
+            return enabled
+        if isinstance(enabled, six.string_types):
+            if enabled.lower() in _TRUE_VALUES:
+                return True
+            if enabled.lower() in _FALSE_VALUES:
+                return False
+        raise RejectedRow("Invalid enabled flag %s" % enabled)
+
+    def get_typed_value(self, value, value_type):
+        if value_type == STRING_VALUE:
+            return value
+        if value_type == INTEGER_VALUE:
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                raise RejectedRow("Invalid integer value %s" % value)
+        if value_type == BOOLEAN_VALUE:
+            if isinstance(value, six.string_types):
+                if value.lower() in _TRUE_VALUES:
+                    return True
+                if value.lower() in _FALSE_VALUES:
+                    return False
+            raise RejectedRow("Invalid boolean value %s" % value)
+        raise RejectedRow("Unknown value type %s" % value_type)
+
+    def get_features(self):
+        if self._features is None:
+            self._features = dict(
+                Feature.objects.filter(project_id=self.environment.project_id)
+                .annotate(lower_name=Lower('name'))
+                .order_by()
+                .values_list('lower_name', 'id')
+            )
+        return self._features
+
+    def reject(self, line_number, error):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append(OrderedDict((('line', line_number), ('error', error))))
+
+    def flush(self):
+        batch, self._batch = self._batch, OrderedDict()
+        if not batch:
+            return
+
+        overrides = dict((identifier, identity_overrides) for identifier, identity_overrides
+                         in batch.items() if identity_overrides)
+
+        with transaction.atomic():
+            self.identities_created += Identity.objects.register(
+                (self.environment.id, identifier) for identifier in batch)
+
+            if overrides:
+                identifiers = list(overrides)
+                identity_ids = {}
+                for i in range(0, len(identifiers), self.lookup_batch_size):
+                    identity_ids.update(Identity.objects.filter(
+                        environment_id=self.environment.id,
+                        identifier__in=identifiers[i:i + self.lookup_batch_size],
+                    ).values_list('identifier', 'id'))
+                FeatureState.objects.set_identity_overrides(self.environment.id, dict(
+                    ((identity_ids[identifier], feature_id), change)
+                    for identifier, identity_overrides in overrides.items()
+                    for feature_id, change in identity_overrides.items()
+                ))
+
+        self.overrides += sum(len(identity_overrides) for identity_overrides in overrides.values())
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.seconds if self.seconds else 0.0
+
+    def get_report(self):
+        return OrderedDict((
+            ('rows', self.rows),
+            ('identities_created', self.identities_created),
+            ('overrides', self.overrides),
+            ('rejected', self.rejected),
+            ('errors', self.errors),
+            ('seconds', round(self.seconds, 3)),
+            ('rows_per_second', round(self.rows_per_second, 1)),
+        ))
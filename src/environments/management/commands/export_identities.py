@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import sys
+import time
+
+from django.core.management import BaseCommand, CommandError
+
+from environments.exports import iter_identities, render
+from environments.imports import CSV, FORMATS, JSONL
+from environments.models import Environment
+
+
+class Command(BaseCommand):
+    help = "Export the identities of an environment, and their overrides, to a CSV or JSON " \
+           "Lines file in the form read by import_identities."
+
+    def add_arguments(self, parser):
+        parser.add_argument('api_key', help="API key of the environment to export")
+        parser.add_argument('path', help="File to export to, or - to write to standard output")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="Format of the file, by default taken from its extension")
+        parser.add_argument('--chunk-size', type=int,
+                            help="Number of identities read per query")
+
+    def handle(self, *args, **options):
+        try:
+            environment = Environment.objects.get(api_key=options['api_key'])
+        except Environment.DoesNotExist:
+            raise CommandError("Environment %s does not exist" % options['api_key'])
+
+        path = options['path']
+        export_format = options['format'] or (CSV if path.lower().endswith('.csv') else JSONL)
+
+        started = time.time()
+        identities = CountedIdentities(iter_identities(environment.id, options['chunk_size']))
+        if path == '-':
+            self.write(getattr(sys.stdout, 'buffer', sys.stdout), identities, export_format)
+        else:
+            with io.open(path, 'wb') as stream:
+                self.write(stream, identities, export_format)
+
+        seconds = time.time() - started
+        self.stderr.write("Exported %d identities in %.1fs (%.0f identities/s)" % (
+            identities.count, seconds, identities.count / seconds if seconds else 0.0))
+
+    def write(self, stream, identities, export_format):
+        for line in render(identities, export_format):
+            stream.write(line)
+
+
+class CountedIdentities(object):
+    def __init__(self, identities):
+        self.identities = identities
+        self.count = 0
+
+    def __iter__(self):
+        for identity in self.identities:
+            self.count += 1
+            yield identity
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import io
+import json
+import sys
+
+from django.core.management import BaseCommand, CommandError
+
+from environments.imports import CSV, FORMATS, JSONL, IdentityImport, read_rows
+from environments.models import Environment
+
+
+class Command(BaseCommand):
+    help = "Import identities, and optionally their overrides, into an environment from a CSV " \
+           "or JSON Lines file. See environments.imports for the formats."
+
+    def add_arguments(self, parser):
+        parser.add_argument('api_key', help="API key of the environment to import into")
+        parser.add_argument('path', help="File to import, or - to read standard input")
+        parser.add_argument('--format', choices=FORMATS,
+                            help="Format of the file, by default taken from its extension")
+        parser.add_argument('--batch-size', type=int,
+                            help="Number of identities written per transaction")
+
+    def handle(self, *args, **options):
+        try:
+            environment = Environment.objects.get(api_key=options['api_key'])
+        except Environment.DoesNotExist:
+            raise CommandError("Environment %s does not exist" % options['api_key'])
+
+        path = options['path']
+        import_format = options['format'] or (CSV if path.lower().endswith('.csv') else JSONL)
+
+        if path == '-':
+            stream = getattr(sys.stdin, 'buffer', sys.stdin)
+            identity_import = self.run(environment, stream, import_format, options)
+        else:
+            with io.open(path, 'rb') as stream:
+                identity_import = self.run(environment, stream, import_format, options)
+
+        self.stdout.write("Imported %d rows in %.1fs (%.0f rows/s): %d identities created, "
+                          "%d overrides set, %d rows rejected" % (
+                              identity_import.rows, identity_import.seconds,
+                              identity_import.rows_per_second,
+                              identity_import.identities_created, identity_import.overrides,
+                              identity_import.rejected))
+        for error in identity_import.errors:
+            self.stdout.write(json.dumps(error))
+
+    def run(self, environment, stream, import_format, options):
+        return IdentityImport(environment, options['batch_size'])\
+            .run(read_rows(stream, import_format))
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connection
+
+from environments.models import EnvironmentClone
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Copy the identities of environment clones too large to copy during the request, " \
+           "resuming those whose worker stopped partway. Runs until stopped unless --once is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help="Exit once there are no clones left to copy")
+        parser.add_argument('--interval', type=float,
+                            default=settings.ENVIRONMENT_CLONE_POLL_INTERVAL,
+                            help="Number of seconds to wait between checks for clones to copy")
+
+    def handle(self, *args, **options):
+        while True:
+            clones = list(EnvironmentClone.objects.waiting())
+            for clone in clones:
+                self.copy_identities(clone)
+
+            if not clones:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
+
+    def copy_identities(self, clone):
+        try:
+            clone.copy_identities()
+        except Exception:
+            logger.exception("Failed to copy the identities of environment clone %d", clone.id)
+            # start again with a new connection in case the old one is broken
+            connection.close()
+            return
+
+        self.stdout.write("Environment clone %d: %s, %d of %d identities copied" % (
+            clone.id, clone.status, clone.identities_copied, clone.identity_count))
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+from app.indexes import create_index_concurrently, drop_index_concurrently
+
+UNIQUE_CONSTRAINT = 'environments_identity_environment_id_identifier_uniq'
+
+
+def remove_duplicate_identities(apps, schema_editor):
+    """
+    Merge identities sharing an identifier within an environment into the oldest of them. Overrides
+    of the duplicates are moved across unless the oldest identity already overrides the feature.
+    """
+    Identity = apps.get_model('environments', 'Identity')
+    FeatureState = apps.get_model('features', 'FeatureState')
+
+    # cleared ordering so that the id isn't added to the group by
+    duplicates = Identity.objects.order_by().values('environment', 'identifier')\
+        .annotate(count=Count('id'), keep_id=Min('id'))\
+        .filter(count__gt=1)
+
+    for duplicate in duplicates:
+        duplicate_identities = Identity.objects.filter(
+            environment=duplicate['environment'],
+            identifier=duplicate['identifier'],
+        ).exclude(id=duplicate['keep_id']).order_by('id')
+
+        for identity in duplicate_identities:
+            overridden_features = FeatureState.objects.filter(identity=duplicate['keep_id'])\
+                .values_list('feature', flat=True)
+            FeatureState.objects.filter(identity=identity)\
+                .exclude(feature__in=list(overridden_features))\
+                .update(identity=duplicate['keep_id'])
+            identity.delete()
+
+
+def add_unique_constraint(apps, schema_editor):
+    """
+    Make identifiers unique within an environment without blocking writes to the identities while
+    the index is built. On PostgreSQL the unique index is built concurrently, which is why this
+    migration isn't atomic, and then becomes the constraint. Identities duplicated since they were
+    merged fail the build, which can be retried by running the migration again.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor in ('postgresql', 'sqlite'):
+        create_index_concurrently(schema_editor, UNIQUE_CONSTRAINT, 'environments_identity',
+                                  '(environment_id, identifier)', unique=True)
+        if vendor == 'postgresql':
+            schema_editor.execute(
+                'ALTER TABLE environments_identity ADD CONSTRAINT %s UNIQUE USING INDEX %s' % (
+                    UNIQUE_CONSTRAINT, UNIQUE_CONSTRAINT))
+    else:
+        Identity = apps.get_model('environments', 'Identity')
+        schema_editor.alter_unique_together(Identity, set(), {('environment', 'identifier')})
+
+
+def remove_unique_constraint(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('ALTER TABLE environments_identity DROP CONSTRAINT IF EXISTS %s'
+                              % UNIQUE_CONSTRAINT)
+    elif vendor == 'sqlite':
+        drop_index_concurrently(schema_editor, UNIQUE_CONSTRAINT)
+    else:
+        Identity = apps.get_model('environments', 'Identity')
+        schema_editor.alter_unique_together(Identity, {('environment', 'identifier')}, set())
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('environments', '0002_auto_20180809_0014'),
+        ('features', '0010_merge_20180816_1531'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_duplicate_identities, migrations.RunPython.noop, atomic=True),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(add_unique_constraint, remove_unique_constraint),
+            ],
+            state_operations=[
+                migrations.AlterUniqueTogether(
+                    name='identity',
+                    unique_together=set([('environment', 'identifier')]),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 02:54
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('environments', '0003_unique_identity_identifier'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EnvironmentClone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('include_identities', models.BooleanField(default=False)),
+                ('status', models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('COMPLETE', 'Complete'), ('FAILED', 'Failed')], default='PENDING', max_length=10)),
+                ('identity_count', models.IntegerField(default=0)),
+                ('identities_copied', models.IntegerField(default=0)),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='DateCreated')),
+                ('completed_date', models.DateTimeField(blank=True, null=True)),
+                ('environment', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='clone_job', to='environments.Environment')),
+                ('source', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='clones', to='environments.Environment')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+    ]
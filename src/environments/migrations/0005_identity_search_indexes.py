@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import DatabaseError, migrations
+
+from app.indexes import create_index_concurrently, drop_index_concurrently
+
+PREFIX_INDEX = 'environments_identity_identifier_prefix'
+TRIGRAM_INDEX = 'environments_identity_identifier_trigram'
+
+
+def create_search_indexes(apps, schema_editor):
+    """
+    Index lower(identifier) for Identity.objects.search. Prefix searches within an environment
+    use a btree index on (environment_id, lower(identifier)), with text_pattern_ops on PostgreSQL
+    so that LIKE 'x%' can use it whatever the collation. Where the pg_trgm extension is available,
+    substring searches use a trigram index.
+
+    The indexes are built concurrently on PostgreSQL, which is why this migration isn't atomic,
+    see ``create_index_concurrently``.
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        create_index_concurrently(schema_editor, PREFIX_INDEX, 'environments_identity',
+                                  '(environment_id, lower(identifier) text_pattern_ops)')
+
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm'")
+            trigrams_available = cursor.fetchone() is not None
+        if trigrams_available:
+            try:
+                schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            except DatabaseError:
+                # the extension needs privileges the database user may not have, substring
+                # searches then scan the environment's identities
+                return
+            create_index_concurrently(schema_editor, TRIGRAM_INDEX, 'environments_identity',
+                                      'USING gin (lower(identifier) gin_trgm_ops)')
+    elif vendor == 'sqlite':
+        create_index_concurrently(schema_editor, PREFIX_INDEX, 'environments_identity',
+                                  '(environment_id, lower(identifier))')
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        for name in (PREFIX_INDEX, TRIGRAM_INDEX):
+            drop_index_concurrently(schema_editor, name)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('environments', '0004_environmentclone'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
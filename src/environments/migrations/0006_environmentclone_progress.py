@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 03:49
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('environments', '0005_identity_search_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='environmentclone',
+            name='last_identity_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='environmentclone',
+            name='updated_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
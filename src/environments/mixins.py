@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.http import Http404
+
+from .cache import environment_keys_cache
+from .models import Environment, Identity
+
+
+class NestedEnvironmentMixin(object):
+    """
+    Mixin for views nested beneath an environment, and optionally an identity, which resolves the
+    environment and identity named in the URL once per request so that all of the view's methods
+    can share them.
+    """
+
+    def get_environment_from_request(self):
+        """
+        Get the environment from the URL, with only its id, project_id and api_key.
+        """
+        if not hasattr(self, '_environment'):
+            try:
+                self._environment = environment_keys_cache.get(
+                    self.kwargs['environment_api_key'])
+            except Environment.DoesNotExist:
+                raise Http404("Environment not found")
+
+        return self._environment
+
+    def get_identity_from_request(self):
+        """
+        Get the identity from the URL, or None if the view isn't nested beneath an identity.
+        """
+        if not hasattr(self, '_identity'):
+            identifier = self.kwargs.get('identity_identifier')
+            if identifier:
+                environment_id = self.get_environment_from_request().id
+                try:
+                    self._identity = Identity.objects.get(identifier=identifier,
+                                                          environment_id=environment_id)
+                except Identity.DoesNotExist:
+                    raise Http404("Identity not found")
+            else:
+                self._identity = None
+
+        return self._identity
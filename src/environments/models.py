@@ -1,13 +1,20 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
-from django.db import models
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.db.models.functions import Lower
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from app.utils import create_hash
 from django.utils.encoding import python_2_unicode_compatible
 from features.models import FeatureState
 from projects.models import Project
+from .versions import invalidate_identities
 
 
 @python_2_unicode_compatible
@@ -33,56 +40,352 @@ class Environment(models.Model):
         """
         Override save method to initialise feature states for all features in new environment
         """
-        requires_feature_state_creation = True if not self.pk else False
-        if self.pk:
-            old_environment = Environment.objects.get(pk=self.pk)
-            if old_environment.project != self.project:
-                FeatureState.objects.filter(
-                    feature__in=old_environment.project.features.values_list('pk', flat=True),
-                    environment=self,
-                ).all().delete()
-                requires_feature_state_creation = True
-
-        super(Environment, self).save(*args, **kwargs)
-
-        if requires_feature_state_creation:
-            # also create feature states for all features in the project
-            features = self.project.features.all()
-            for feature in features:
-                FeatureState.objects.create(
-                    feature=feature,
-                    environment=self,
-                    identity=None,
-                    enabled=feature.default_enabled
-                )
+        with transaction.atomic():
+            requires_feature_state_creation = True if not self.pk else False
+            if self.pk:
+                old_project_id = Environment.objects.filter(pk=self.pk)\
+                    .values_list('project_id', flat=True).get()
+                if old_project_id != self.project_id:
+                    FeatureState.objects.remove_project_features(self.pk, old_project_id)
+                    # signals aren't sent for the removed identity overrides
+                    invalidate_identities(self.pk)
+                    requires_feature_state_creation = True
+
+            super(Environment, self).save(*args, **kwargs)
+
+            if requires_feature_state_creation:
+                # also create feature states for all features in the project
+                FeatureState.objects.seed_environment(self.pk, self.project_id)
+
+    def clone(self, name, include_identities=False):
+        """
+        Create a new environment in the same project with a copy of this environment's feature
+        states. The identities and their overrides are copied by the clone job returned, see
+        ``EnvironmentClone.copy_identities``.
+
+        :return: the clone job of the new environment
+        """
+        with transaction.atomic():
+            environment = Environment(name=name, project_id=self.project_id)
+            # the feature states are copied rather than initialised with the defaults
+            super(Environment, environment).save()
+            FeatureState.objects.seed_environment(environment.pk, self.project_id,
+                                                  source_environment_id=self.pk)
+
+            return EnvironmentClone.objects.create(
+                environment=environment,
+                source=self,
+                include_identities=include_identities,
+                identity_count=self.identities.count() if include_identities else 0,
+                status=EnvironmentClone.PENDING if include_identities else
+                EnvironmentClone.COMPLETE,
+                completed_date=None if include_identities else timezone.now(),
+            )
 
     def __str__(self):
         return "Project %s - Environment %s" % (self.project.name, self.name)
 
 
+class IdentityQuerySet(models.QuerySet):
+    def search(self, text, prefix=False):
+        """
+        Case insensitively search identities by identifier, matching against lower(identifier)
+        so that the expression indexes added by migration 0005 can be used. Prefix searches
+        within an environment use a btree index. On PostgreSQL with pg_trgm substring searches
+        use a trigram index; elsewhere they scan the environment's identities.
+
+        :param text: text to search for
+        :param prefix: only match identifiers starting with the text
+        :return: queryset of matching identities
+        """
+        text = text.strip().lower()
+        queryset = self.annotate(identifier_lower=Lower('identifier'))
+        if prefix and connections[self.db].vendor == 'sqlite':
+            # SQLite doesn't use indexes for LIKE ... ESCAPE, so the prefix is searched as a range
+            return queryset.filter(identifier_lower__gte=text,
+                                   identifier_lower__lt=text + '\U0010ffff')
+        if prefix:
+            return queryset.filter(identifier_lower__startswith=text)
+        return queryset.filter(identifier_lower__contains=text)
+
+
+class IdentityManager(models.Manager.from_queryset(IdentityQuerySet)):
+    # number of rows inserted per statement, kept below SQLite's limit of 999 query parameters
+    register_batch_size = 300
+
+    def register(self, identities):
+        """
+        Idempotently create identities, ignoring any that already exist. Safe to run concurrently
+        from several processes as conflicts on (environment, identifier) are ignored by the
+        database rather than raising.
+
+        :param identities: iterable of (environment id, identifier) tuples
+        :return: number of identities created
+        """
+        identities = set(identities)
+        if not identities:
+            return 0
+
+        # identities registered against an environment that has since been deleted are dropped
+        environment_ids = set(Environment.objects.filter(
+            id__in=set(environment_id for environment_id, _ in identities)
+        ).values_list('id', flat=True))
+        identities = sorted((environment_id, identifier) for environment_id, identifier
+                            in identities if environment_id in environment_ids)
+
+        connection = connections[self.db]
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            return self._register_without_upsert(identities)
+
+        created = 0
+        created_date = connection.ops.adapt_datetimefield_value(timezone.now())
+        for i in range(0, len(identities), self.register_batch_size):
+            batch = identities[i:i + self.register_batch_size]
+            with connection.cursor() as cursor:
+                cursor.execute(self._get_register_sql(connection, len(batch)), [
+                    param for environment_id, identifier in batch
+                    for param in (identifier, created_date, environment_id)
+                ])
+                created += cursor.rowcount
+
+        return created
+
+    def _get_register_sql(self, connection, count):
+        quote_name = connection.ops.quote_name
+        sql = "INSERT INTO %s (%s, %s, %s) VALUES %s" % (
+            quote_name(self.model._meta.db_table),
+            quote_name('identifier'),
+            quote_name('created_date'),
+            quote_name('environment_id'),
+            ", ".join(["(%s, %s, %s)"] * count),
+        )
+
+        if connection.vendor == 'sqlite':
+            return sql.replace("INSERT", "INSERT OR IGNORE", 1)
+        return sql + " ON CONFLICT DO NOTHING"
+
+    def copy_environment_identities(self, source_environment_id, environment_id,
+                                    after_identity_id, last_identity_id):
+        """
+        Copy a range of the source environment's identities to the environment with a single
+        INSERT ... SELECT.
+
+        :param after_identity_id: id of the identity to copy the identities after
+        :param last_identity_id: id of the last identity to copy
+        :return: number of identities copied
+        """
+        connection = connections[self.db]
+        quote_name = connection.ops.quote_name
+        created_date = connection.ops.adapt_datetimefield_value(timezone.now())
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO %(identity)s (identifier, created_date, environment_id)
+                SELECT identifier, %%s, %%s FROM %(identity)s
+                WHERE environment_id = %%s AND id > %%s AND id <= %%s
+                """ % {'identity': quote_name(self.model._meta.db_table)},
+                [created_date, environment_id, source_environment_id, after_identity_id,
+                 last_identity_id])
+            return cursor.rowcount
+
+    def _register_without_upsert(self, identities):
+        created = 0
+        for environment_id, identifier in identities:
+            try:
+                with transaction.atomic(using=self.db):
+                    _, was_created = self.get_or_create(environment_id=environment_id,
+                                                        identifier=identifier)
+            except IntegrityError:
+                # created concurrently by another process
+                was_created = False
+            created += was_created
+
+        return created
+
+
 @python_2_unicode_compatible
 class Identity(models.Model):
     identifier = models.CharField(max_length=2000)
     created_date = models.DateTimeField('DateCreated', auto_now_add=True)
     environment = models.ForeignKey(Environment, related_name='identities')
 
+    objects = IdentityManager()
+
     class Meta:
         verbose_name_plural = "Identities"
         ordering = ['id']
+        unique_together = ('environment', 'identifier')
+
+    def get_effective_feature_states(self, feature_ids=None):
+        """
+        Get the effective feature states for the identity, i.e. the identity's overrides and the
+        environment defaults for all features that haven't been overridden. These are resolved
+        in a single query with the feature and feature state value joined in.
+
+        :param feature_ids: optional list of ids of the features to only get the states of
+        :return: queryset of feature states
+        """
+        overrides = FeatureState.objects.filter(identity=self, feature=OuterRef('feature'))
 
-    def get_all_feature_states(self):
-        # get all features that have been overridden for an identity
-        identity_flags = self.identity_features.filter(identity=self)
+        feature_states = FeatureState.objects\
+            .annotate(overridden=Exists(overrides))\
+            .filter(Q(identity=self) |
+                    Q(environment=self.environment_id, identity=None, overridden=False))\
+            .select_related('feature', 'feature_state_value')
 
-        override_features = [flag.feature for flag in identity_flags]
+        if feature_ids is not None:
+            feature_states = feature_states.filter(feature__in=feature_ids)
 
-        # get only feature states for features which are not associated with an identity
-        # and are not in the to be overridden generated above
-        environment_flags = self.environment.feature_states.filter(environment=self.environment,
-                                                                   identity=None)\
-            .exclude(feature__in=override_features)
+        return feature_states
+
+    def get_all_feature_states(self, feature_ids=None):
+        """
+        Get the effective feature states for the identity. See ``get_effective_feature_states``.
+
+        :return: tuple of lists of identity overrides and environment defaults
+        """
+        identity_flags, environment_flags = [], []
+        for feature_state in self.get_effective_feature_states(feature_ids):
+            if feature_state.identity_id is None:
+                environment_flags.append(feature_state)
+            else:
+                identity_flags.append(feature_state)
 
         return identity_flags, environment_flags
 
     def __str__(self):
         return "Account %s" % self.identifier
+
+
+class EnvironmentCloneQuerySet(models.QuerySet):
+    def waiting(self):
+        """
+        Get the jobs with identities left to copy that no worker is copying: those still pending
+        and those running that haven't copied a batch for ENVIRONMENT_CLONE_STALE_SECONDS, whose
+        worker is taken to have stopped.
+        """
+        stale_before = timezone.now() - timedelta(seconds=settings.ENVIRONMENT_CLONE_STALE_SECONDS)
+        return self.filter(Q(status=EnvironmentClone.PENDING) |
+                           Q(status=EnvironmentClone.RUNNING, updated_date__lt=stale_before))
+
+
+@python_2_unicode_compatible
+class EnvironmentClone(models.Model):
+    """
+    Job copying an environment to a new environment, see ``Environment.clone``. The identities
+    and their overrides are copied in batches of ENVIRONMENT_CLONE_BATCH_SIZE identities, each in
+    its own transaction, with the number copied so far kept on the job to report progress and the
+    last identity copied kept to resume from if the worker copying them stops partway.
+    """
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    COMPLETE = 'COMPLETE'
+    FAILED = 'FAILED'
+
+    STATUSES = (
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (COMPLETE, 'Complete'),
+        (FAILED, 'Failed'),
+    )
+
+    environment = models.OneToOneField(Environment, related_name='clone_job')
+    source = models.ForeignKey(Environment, related_name='clones', null=True,
+                               on_delete=models.SET_NULL)
+    include_identities = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    identity_count = models.IntegerField(default=0)
+    identities_copied = models.IntegerField(default=0)
+    # id of the last of the source environment's identities copied
+    last_identity_id = models.IntegerField(default=0)
+    created_date = models.DateTimeField('DateCreated', auto_now_add=True)
+    # set when the job is claimed and on each batch copied, identifying the worker's claim
+    updated_date = models.DateTimeField(null=True, blank=True)
+    completed_date = models.DateTimeField(null=True, blank=True)
+
+    objects = EnvironmentCloneQuerySet.as_manager()
+
+    class Meta:
+        ordering = ['id']
+
+    def claim(self):
+        """
+        Take the job on to copy its identities, unless it has changed hands since it was read.
+
+        :return: whether the job was claimed
+        """
+        updated_date = timezone.now()
+        claimed = EnvironmentClone.objects.filter(
+            pk=self.pk, status=self.status, updated_date=self.updated_date,
+        ).update(status=self.RUNNING, updated_date=updated_date)
+        if claimed:
+            self.status, self.updated_date = self.RUNNING, updated_date
+        return bool(claimed)
+
+    def copy_identities(self):
+        """
+        Copy the source environment's identities and their overrides, resuming after the last
+        identity copied, unless already copied or being copied by another worker.
+        """
+        if self.status in (self.COMPLETE, self.FAILED) or not self.claim():
+            return
+
+        try:
+            while self.copy_batch():
+                pass
+        except Exception:
+            self._set_status(self.FAILED)
+            raise
+
+        self._set_status(self.COMPLETE)
+
+    def copy_batch(self):
+        """
+        Copy the next batch of identities and their overrides, recording the last identity copied
+        in the same transaction. Nothing is copied once another worker has taken the job over.
+
+        :return: whether a batch was copied
+        """
+        # the id of the last identity in the next batch
+        batch = self.source.identities.filter(id__gt=self.last_identity_id).order_by('id')\
+            .values_list('id', flat=True)
+        batch_last_identity_id = batch[settings.ENVIRONMENT_CLONE_BATCH_SIZE - 1:].first() or \
+            batch.last()
+        if batch_last_identity_id is None:
+            return False
+
+        with transaction.atomic():
+            # locks the job so that a worker that has lost it waits for, and then sees, the
+            # worker that took it over
+            updated_date = timezone.now()
+            if not EnvironmentClone.objects.filter(pk=self.pk, updated_date=self.updated_date)\
+                    .update(updated_date=updated_date):
+                return False
+            self.updated_date = updated_date
+
+            copied = Identity.objects.copy_environment_identities(
+                self.source_id, self.environment_id, self.last_identity_id,
+                batch_last_identity_id)
+            FeatureState.objects.copy_identity_overrides(
+                self.source_id, self.environment_id, self.last_identity_id,
+                batch_last_identity_id)
+            self.identities_copied += copied
+            self.last_identity_id = batch_last_identity_id
+            EnvironmentClone.objects.filter(pk=self.pk).update(
+                identities_copied=self.identities_copied, last_identity_id=self.last_identity_id)
+            # signals aren't sent for the copied overrides
+            invalidate_identities(self.environment_id)
+
+        return True
+
+    def _set_status(self, status):
+        self.status = status
+        self.completed_date = timezone.now()
+        # left alone if another worker has taken the job over
+        EnvironmentClone.objects.filter(pk=self.pk, updated_date=self.updated_date)\
+            .update(status=self.status, completed_date=self.completed_date)
+
+    def __str__(self):
+        return "Clone of environment %s to %s - %s" % (self.source_id, self.environment_id,
+                                                       self.status)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+from .models import Identity
+
+logger = logging.getLogger(__name__)
+
+
+class IdentityRegistrations(object):
+    """
+    Process local buffer of identities that have been seen by the SDK endpoints but don't exist
+    yet. Rather than creating each identity while serving its request, registrations are
+    collected and created together once enough have been buffered or the oldest has waited long
+    enough.
+
+    Registrations are best effort: anything still buffered when a process exits is lost and will
+    simply be registered again on the identity's next request.
+    """
+
+    def __init__(self):
+        self._pending = set()
+        self._oldest = None
+        self._lock = threading.Lock()
+
+    def add(self, environment_id, identifier):
+        with self._lock:
+            if not self._pending:
+                self._oldest = time.time()
+            self._pending.add((environment_id, identifier))
+
+    def is_due(self):
+        with self._lock:
+            return bool(self._pending) and (
+                len(self._pending) >= settings.IDENTITY_REGISTRATION_BATCH_SIZE or
+                time.time() - self._oldest >= settings.IDENTITY_REGISTRATION_FLUSH_INTERVAL
+            )
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, set()
+
+        if not pending:
+            return 0
+
+        try:
+            return Identity.objects.register(pending)
+        except Exception:
+            logger.exception("Failed to register %d identities", len(pending))
+            return 0
+
+    def flush_if_due(self):
+        if self.is_due():
+            return self.flush()
+        return 0
+
+
+identity_registrations = IdentityRegistrations()
@@ -1,7 +1,7 @@
 from rest_framework import serializers
 
 from features.serializers import FeatureStateSerializerFull
-from environments.models import Environment, Identity
+from environments.models import Environment, EnvironmentClone, Identity
 from projects.serializers import ProjectSerializer
 
 
@@ -36,3 +36,17 @@ class IdentitySerializer(serializers.ModelSerializer):
     class Meta:
         model = Identity
         fields = ('id', 'identifier', 'environment')
+
+
+class EnvironmentCloneSerializer(serializers.ModelSerializer):
+    name = serializers.CharField(write_only=True, max_length=2000,
+                                 help_text="Name of the new environment")
+    environment = EnvironmentSerializerLight(read_only=True)
+    source = serializers.SlugRelatedField(slug_field='api_key', read_only=True)
+
+    class Meta:
+        model = EnvironmentClone
+        fields = ('id', 'name', 'environment', 'source', 'include_identities', 'status',
+                  'identity_count', 'identities_copied', 'created_date', 'completed_date')
+        read_only_fields = ('status', 'identity_count', 'identities_copied', 'created_date',
+                            'completed_date')
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.signals import request_finished
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import environment_keys_cache
+from .models import Environment
+from .registrations import identity_registrations
+from .versions import invalidate_environment
+
+
+@receiver(post_save, sender=Environment)
+@receiver(post_delete, sender=Environment)
+def invalidate_environment_receiver(sender, instance, **kwargs):
+    invalidate_environment(instance.id)
+    # other processes see the new version but rely on the TTL to forget a bad key
+    environment_keys_cache.invalidate(instance.api_key)
+
+
+@receiver(request_finished)
+def flush_identity_registrations(sender, **kwargs):
+    # flushed once the response has been sent so that no SDK request waits on the inserts
+    identity_registrations.flush_if_due()
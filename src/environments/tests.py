@@ -1,9 +1,28 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+from unittest import skipUnless
 
-from .models import Environment, Identity
-from features.models import Feature, FeatureState
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import six, timezone
+
+from app.pagination import table_estimates
+
+from .cache import environment_keys_cache
+from .exports import iter_identities
+from .imports import IdentityImport
+from .models import Environment, EnvironmentClone, Identity
+from .versions import PostgresNotifyVersions, SharedMemoryVersions
+from features.models import Feature, FeatureState, FeatureStateChange, FeatureStateValue
 from organisations.models import Organisation
 from projects.models import Project
+from users.models import FFAdminUser
 
 
 class EnvironmentTestCase(TestCase):
@@ -79,6 +98,123 @@ class EnvironmentSaveTestCase(TestCase):
 
         self.assertNotEqual(fs.enabled, FeatureState.objects.exclude(id=fs.id).get().enabled)
 
+    def test_on_creation_save_feature_state_values_get_the_initial_value(self):
+        self.feature.initial_value = "value"
+        self.feature.save()
+
+        self.environment.save()
+
+        self.assertEqual(FeatureState.objects.get().get_feature_state_value(), "value")
+        self.assertEqual(list(FeatureStateChange.objects.filter(environment=self.environment)
+                              .values_list('feature_id', 'change_type')),
+                         [(self.feature.id, FeatureStateChange.ADDED)])
+
+    def test_on_creation_save_query_count_doesnt_grow_with_the_number_of_features(self):
+        Environment.objects.create(name="Warm Up", project=self.project)
+        with CaptureQueriesContext(connection) as one_feature:
+            Environment.objects.create(name="One Feature", project=self.project)
+
+        for i in range(20):
+            Feature.objects.create(name="Feature %d" % i, project=self.project)
+        with CaptureQueriesContext(connection) as many_features:
+            self.environment.save()
+
+        self.assertEqual(FeatureState.objects.filter(environment=self.environment).count(), 21)
+        self.assertEqual(len(many_features), len(one_feature))
+
+    def test_on_project_change_save_feature_states_get_replaced(self):
+        self.environment.save()
+        identity = Identity.objects.create(identifier="test-identity", environment=self.environment)
+        FeatureState.objects.create(feature=self.feature, environment=self.environment,
+                                    identity=identity)
+        project = Project.objects.create(name="Other Project", organisation=self.organisation)
+        feature = Feature.objects.create(name="Other Feature", project=project,
+                                         default_enabled=True)
+
+        self.environment.project = project
+        self.environment.save()
+
+        feature_state = FeatureState.objects.get(environment=self.environment)
+        self.assertEqual(feature_state.feature, feature)
+        self.assertTrue(feature_state.enabled)
+        self.assertEqual(FeatureStateValue.objects.filter(feature_state__feature=self.feature)
+                         .count(), 0)
+        self.assertEqual(list(FeatureStateChange.objects.filter(environment=self.environment)
+                              .values_list('feature_id', 'change_type')),
+                         [(self.feature.id, FeatureStateChange.ADDED),
+                          (self.feature.id, FeatureStateChange.REMOVED),
+                          (feature.id, FeatureStateChange.ADDED)])
+
+
+class EnvironmentCloneTestCase(TestCase):
+    def setUp(self):
+        organisation = Organisation.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organisation=organisation)
+        self.feature = Feature.objects.create(name="Test Feature", project=self.project)
+        self.environment = Environment.objects.create(name="Test Environment",
+                                                      project=self.project)
+        for i in range(3):
+            identity = Identity.objects.create(identifier="identity%d" % i,
+                                               environment=self.environment)
+            FeatureState.objects.create(feature=self.feature, environment=self.environment,
+                                        identity=identity, enabled=True)
+
+    @override_settings(ENVIRONMENT_CLONE_BATCH_SIZE=2)
+    def test_identities_are_copied_in_batches(self):
+        clone = self.environment.clone("Clone", include_identities=True)
+        self.assertEqual(clone.status, EnvironmentClone.PENDING)
+        self.assertEqual(clone.identity_count, 3)
+
+        clone.copy_identities()
+
+        clone.refresh_from_db()
+        self.assertEqual(clone.status, EnvironmentClone.COMPLETE)
+        self.assertEqual(clone.identities_copied, 3)
+        self.assertEqual(sorted(clone.environment.identities.values_list('identifier', flat=True)),
+                         ["identity0", "identity1", "identity2"])
+        overrides = FeatureState.objects.filter(environment=clone.environment,
+                                                identity__isnull=False)
+        self.assertEqual(overrides.filter(enabled=True).count(), 3)
+        self.assertEqual(FeatureStateValue.objects.filter(feature_state__in=overrides).count(), 3)
+
+    @override_settings(ENVIRONMENT_CLONE_BATCH_SIZE=2)
+    def test_stopped_clone_is_resumed_after_the_last_identity_copied(self):
+        clone = self.environment.clone("Clone", include_identities=True)
+        # a worker that stops once it has copied the first batch
+        clone.claim()
+        clone.copy_batch()
+        self.assertFalse(EnvironmentClone.objects.waiting().exists())
+        EnvironmentClone.objects.filter(pk=clone.pk)\
+            .update(updated_date=timezone.now() - timedelta(hours=1))
+
+        call_command("run_environment_clones", once=True, stdout=six.StringIO())
+
+        clone.refresh_from_db()
+        self.assertEqual(clone.status, EnvironmentClone.COMPLETE)
+        self.assertEqual(clone.identities_copied, 3)
+        self.assertEqual(sorted(clone.environment.identities.values_list('identifier', flat=True)),
+                         ["identity0", "identity1", "identity2"])
+        self.assertEqual(FeatureState.objects.filter(environment=clone.environment,
+                                                     identity__isnull=False).count(), 3)
+
+    def test_clone_taken_over_by_another_worker_is_left_to_it(self):
+        clone = self.environment.clone("Clone", include_identities=True)
+        clone.claim()
+        EnvironmentClone.objects.get(pk=clone.pk).claim()
+
+        self.assertFalse(clone.copy_batch())
+        self.assertFalse(clone.environment.identities.exists())
+
+    def test_feature_states_are_copied_with_a_fixed_number_of_queries(self):
+        for i in range(10):
+            Feature.objects.create(name="Feature %d" % i, project=self.project)
+
+        # environment, change log, feature states, values and clone job, plus two savepoints
+        with self.assertNumQueries(9):
+            clone = self.environment.clone("Clone")
+
+        self.assertEqual(FeatureState.objects.filter(environment=clone.environment).count(), 11)
+
 
 class IdentityTestCase(TestCase):
     @classmethod
@@ -93,4 +229,340 @@ class IdentityTestCase(TestCase):
         self.assertIsInstance(identity.environment, Environment)
         self.assertTrue(hasattr(identity, 'created_date'))
 
+    def test_get_all_feature_states_returns_overrides_in_place_of_environment_defaults(self):
+        # Given
+        feature_one = Feature.objects.create(name="Feature One", project=self.project)
+        feature_two = Feature.objects.create(name="Feature Two", project=self.project)
+        identity = Identity.objects.create(identifier="test-identity", environment=self.environment)
+        override = FeatureState.objects.create(feature=feature_one, environment=self.environment,
+                                               identity=identity, enabled=True)
+
+        # When
+        with self.assertNumQueries(1):
+            identity_flags, environment_flags = identity.get_all_feature_states()
+
+        # Then
+        self.assertEqual(identity_flags, [override])
+        self.assertEqual([flag.feature for flag in environment_flags], [feature_two])
+
+    def test_register_identities_only_creates_missing_identities(self):
+        # Given
+        Identity.objects.create(identifier="existing-identity", environment=self.environment)
+
+        # When
+        created = Identity.objects.register([
+            (self.environment.id, "existing-identity"),
+            (self.environment.id, "new-identity"),
+            (self.environment.id, "new-identity"),
+        ])
+
+        # Then
+        self.assertEqual(created, 1)
+        self.assertEqual(
+            sorted(self.environment.identities.values_list('identifier', flat=True)),
+            ["existing-identity", "new-identity"]
+        )
+
+
+class IdentitySearchTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organisation = Organisation.objects.create(name="Test Org")
+        project = Project.objects.create(name="Test Project", organisation=organisation)
+        cls.environment = Environment.objects.create(name="Test Environment", project=project)
+        cls.other_environment = Environment.objects.create(name="Other", project=project)
+        for identifier in ("Alice@example.com", "bob@example.com", "alice_b", "100%-alice"):
+            Identity.objects.create(identifier=identifier, environment=cls.environment)
+        Identity.objects.create(identifier="alice@example.com", environment=cls.other_environment)
+
+    def search(self, text, prefix=False):
+        return sorted(Identity.objects.filter(environment=self.environment)
+                      .search(text, prefix=prefix).values_list('identifier', flat=True))
+
+    def test_search_matches_identifiers_containing_text_ignoring_case(self):
+        self.assertEqual(self.search("ALICE"), ["100%-alice", "Alice@example.com", "alice_b"])
+
+    def test_prefix_search_only_matches_identifiers_starting_with_text(self):
+        self.assertEqual(self.search("alice", prefix=True), ["Alice@example.com", "alice_b"])
+
+    def test_search_does_not_treat_text_as_wildcards(self):
+        self.assertEqual(self.search("%-"), ["100%-alice"])
+        self.assertEqual(self.search("e_b"), ["alice_b"])
+
+    def test_prefix_search_uses_index(self):
+        queryset = Identity.objects.filter(environment=self.environment).search("ali", prefix=True)
+        sql, params = queryset.query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'postgresql':
+                # the table is too small for an index to be cheaper than a scan otherwise
+                cursor.execute('ANALYZE environments_identity')
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = ' '.join(six.text_type(row) for row in cursor.fetchall())
+
+        self.assertIn('environments_identity_identifier_prefix', plan)
+
+
+class IdentityAdminTestCase(TestCase):
+    def setUp(self):
+        user = FFAdminUser.objects.create_superuser(email='admin@example.com', password='password')
+        self.client.force_login(user)
+        organisation = Organisation.objects.create(name='Test Org')
+        project = Project.objects.create(name='Test Project', organisation=organisation)
+        environment = Environment.objects.create(name='Test Environment', project=project)
+        Identity.objects.bulk_create([Identity(identifier='user%d' % i, environment=environment)
+                                      for i in range(3)])
+        table_estimates.clear()
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE %s' % connection.ops.quote_name(Identity._meta.db_table))
+
+    def tearDown(self):
+        table_estimates.clear()
+
+    @override_settings(ESTIMATED_COUNT_THRESHOLD=1)
+    def test_changelist_does_not_count_identities_when_estimated(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/admin/environments/identity/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['cl'].result_count, 3)
+        self.assertIsNone(response.context['cl'].full_result_count)
+        counts = [query for query in queries.captured_queries
+                  if 'COUNT(' in query['sql'].upper() and 'identity' in query['sql']]
+        self.assertEqual(len(counts), 0 if connection.vendor == 'postgresql' else 1)
+
+
+class IdentityImportTestCase(TestCase):
+    def setUp(self):
+        organisation = Organisation.objects.create(name="Test Org")
+        project = Project.objects.create(name="Test Project", organisation=organisation)
+        Feature.objects.create(name="Test Feature", project=project)
+        self.environment = Environment.objects.create(name="Test Environment", project=project)
+
+    def test_identities_are_written_in_batches(self):
+        rows = [(i + 1, "identity%d" % (i % 10), [{'feature': "test feature", 'enabled': True}])
+                for i in range(20)]
+
+        with CaptureQueriesContext(connection) as queries:
+            identity_import = IdentityImport(self.environment, batch_size=5).run(rows)
+
+        identity_inserts = [query for query in queries.captured_queries
+                            if query['sql'].startswith('INSERT') and
+                            '"environments_identity"' in query['sql']]
+        self.assertEqual(len(identity_inserts), 4)
+        self.assertEqual(identity_import.rows, 20)
+        self.assertEqual(identity_import.identities_created, 10)
+        self.assertEqual(FeatureState.objects.filter(identity__isnull=False, enabled=True)
+                         .count(), 10)
+
+    def test_overrides_are_looked_up_in_chunks(self):
+        rows = [(i + 1, "identity%d" % i, [{'feature': "test feature", 'enabled': True}])
+                for i in range(5)]
+
+        FeatureState.objects.ids_batch_size = 2
+        self.addCleanup(delattr, FeatureState.objects, 'ids_batch_size')
+        identity_import = IdentityImport(self.environment)
+        identity_import.lookup_batch_size = 2
+
+        identity_import.run(rows)
+
+        self.assertEqual(FeatureState.objects.filter(identity__isnull=False, enabled=True)
+                         .count(), 5)
+
+    def test_import_identities_command_reports_rejected_rows(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "identities.csv")
+        with open(path, "w") as f:
+            f.write("identifier\nuser1\n\"\"\nuser2\n")
+
+        output = six.StringIO()
+        call_command("import_identities", self.environment.api_key, path, stdout=output)
+
+        self.assertIn("2 identities created", output.getvalue())
+        self.assertIn("1 rows rejected", output.getvalue())
+        self.assertIn('{"line": 3, "error": "Missing identifier"}', output.getvalue())
+
+
+class IdentityExportTestCase(TestCase):
+    def setUp(self):
+        organisation = Organisation.objects.create(name="Test Org")
+        project = Project.objects.create(name="Test Project", organisation=organisation)
+        self.feature = Feature.objects.create(name="Test Feature", project=project)
+        self.environment = Environment.objects.create(name="Test Environment", project=project)
+        for i in range(5):
+            identity = Identity.objects.create(identifier="identity%d" % i,
+                                               environment=self.environment)
+            if i % 2:
+                FeatureState.objects.create(feature=self.feature, environment=self.environment,
+                                            identity=identity)
+
+    def test_identities_are_read_a_chunk_at_a_time(self):
+        # identities and overrides for each of the three chunks, and the empty last chunk
+        with self.assertNumQueries(3 * 2 + 1):
+            identities = list(iter_identities(self.environment.id, chunk_size=2))
+
+        self.assertEqual([identifier for identifier, _ in identities],
+                         ["identity%d" % i for i in range(5)])
+        self.assertEqual([len(overrides) for _, overrides in identities], [0, 1, 0, 1, 0])
+
+    def test_export_identities_command_writes_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "identities.csv")
+
+        call_command("export_identities", self.environment.api_key, path, stderr=six.StringIO())
+
+        with open(path) as f:
+            self.assertEqual(len(f.read().splitlines()), 6)
+
+
+class SharedMemoryVersionsTestCase(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.location = os.path.join(directory, 'versions')
+
+    def test_versions_bumped_by_one_worker_are_seen_by_another(self):
+        # Given
+        worker_versions = SharedMemoryVersions('environment', self.location)
+        other_worker_versions = SharedMemoryVersions('environment', self.location)
+        version = other_worker_versions.get(1)
+
+        # When
+        worker_versions.bump(1)
+
+        # Then
+        self.assertNotEquals(other_worker_versions.get(1), version)
+        self.assertEquals(other_worker_versions.get(1), worker_versions.get(1))
+
+    def test_versions_are_stable_until_bumped(self):
+        # Given
+        versions = SharedMemoryVersions('environment', self.location)
+        version = versions.get(1)
+
+        # When
+        versions.bump(2)
+
+        # Then
+        self.assertEquals(versions.get(1), version)
+        self.assertTrue(versions.bump(1) > version)
+
+    @skipUnless(hasattr(os, 'getuid'), "files are only checked where there are users")
+    def test_location_is_created_private_to_the_user(self):
+        SharedMemoryVersions('environment', self.location).get(1)
+
+        self.assertEqual(os.stat(self.location).st_mode & 0o777, 0o700)
+        self.assertEqual(os.stat(os.path.join(self.location, 'environment')).st_mode & 0o777,
+                         0o600)
+
+    @skipUnless(hasattr(os, 'symlink'), "links are not supported")
+    def test_linked_file_is_refused(self):
+        os.mkdir(self.location, 0o700)
+        target = os.path.join(os.path.dirname(self.location), 'target')
+        open(target, 'w').close()
+        os.symlink(target, os.path.join(self.location, 'environment'))
+
+        with self.assertRaises(OSError):
+            SharedMemoryVersions('environment', self.location).get(1)
+
+    @skipUnless(hasattr(os, 'getuid'), "files are only checked where there are users")
+    def test_file_writable_by_others_is_refused(self):
+        os.mkdir(self.location, 0o700)
+        path = os.path.join(self.location, 'environment')
+        open(path, 'w').close()
+        os.chmod(path, 0o666)
+
+        with self.assertRaises(ImproperlyConfigured):
+            SharedMemoryVersions('environment', self.location).get(1)
+
+
+@skipUnless(connection.vendor == 'postgresql', "LISTEN / NOTIFY requires postgres")
+class PostgresNotifyVersionsTestCase(TransactionTestCase):
+    def test_versions_are_bumped_when_notified_by_another_host(self):
+        # Given
+        versions = PostgresNotifyVersions('environment', 'test_environment_versions')
+        self.addCleanup(versions.close)
+        version = versions.get(1)
+
+        # When
+        # the listener starts in the background so keep notifying until it's listening
+        deadline = time.time() + 5
+        while versions.get(1) == version and time.time() < deadline:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_notify('test_environment_versions', 'environment:1')")
+            time.sleep(0.05)
+
+        # Then
+        self.assertNotEquals(versions.get(1), version)
+
+
+class EnvironmentKeysCacheTestCase(TestCase):
+    def setUp(self):
+        environment_keys_cache.clear()
+        organisation = Organisation.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organisation=organisation)
+        self.environment = Environment.objects.create(name="Test Environment",
+                                                      project=self.project)
+
+    def test_environment_is_resolved_without_queries_once_cached(self):
+        # Given
+        environment_keys_cache.get(self.environment.api_key)
+
+        # When
+        with self.assertNumQueries(0):
+            environment = environment_keys_cache.get(self.environment.api_key)
+
+        # Then
+        self.assertEquals((environment.id, environment.project_id),
+                          (self.environment.id, self.project.id))
+
+    def test_unknown_api_key_is_rejected_without_queries_once_cached(self):
+        # Given
+        with self.assertRaises(Environment.DoesNotExist):
+            environment_keys_cache.get('unknown')
+
+        # When / Then
+        with self.assertNumQueries(0), self.assertRaises(Environment.DoesNotExist):
+            environment_keys_cache.get('unknown')
+
+    def test_environment_is_reloaded_once_saved(self):
+        # Given
+        environment_keys_cache.get(self.environment.api_key)
+        other_project = Project.objects.create(name="Other Project",
+                                               organisation=self.project.organisation)
+
+        # When
+        self.environment.project = other_project
+        self.environment.save()
+
+        # Then
+        self.assertEquals(environment_keys_cache.get(self.environment.api_key).project_id,
+                          other_project.id)
+
+    @override_settings(ENVIRONMENT_KEY_CACHE_SIZE=1)
+    def test_least_recently_used_environment_is_evicted(self):
+        # Given
+        other_environment = Environment.objects.create(name="Other Environment",
+                                                       project=self.project)
+        environment_keys_cache.get(self.environment.api_key)
+
+        # When
+        environment_keys_cache.get(other_environment.api_key)
+
+        # Then
+        with self.assertNumQueries(1):
+            environment_keys_cache.get(self.environment.api_key)
+
+    @override_settings(ENVIRONMENT_KEY_CACHE_TTL=0)
+    def test_environment_is_reloaded_once_expired(self):
+        # Given
+        environment_keys_cache.get(self.environment.api_key)
 
+        # When / Then
+        with self.assertNumQueries(1):
+            environment_keys_cache.get(self.environment.api_key)
@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import errno
+import logging
+import mmap
+import os
+import select
+import stat
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, where bumps to shared versions aren't locked
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def _version_seed():
+    """
+    Versions are seeded from the clock so that a restarted process never hands out a version that
+    was already used for different content before the restart.
+    """
+    return int(time.time() * 1000000)
+
+
+class EnvironmentVersions(object):
+    """
+    Process local registry of monotonically increasing versions, one per environment. Anything
+    derived from an environment's feature states can be cached against the environment's current
+    version and is considered stale as soon as the version moves on.
+
+    Versions bumped in one process aren't seen by any other, so this is only suitable when the
+    app runs in a single process.
+    """
+    # whether versions bumped in one process are seen by the others
+    shared = False
+
+    def __init__(self, name, location=None, options=None):
+        self.name = name
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, environment_id):
+        try:
+            return self._versions[environment_id]
+        except KeyError:
+            with self._lock:
+                return self._versions.setdefault(environment_id, _version_seed())
+
+    def bump(self, environment_id):
+        with self._lock:
+            version = max(self._versions.get(environment_id, 0) + 1, _version_seed())
+            self._versions[environment_id] = version
+            return version
+
+    def clear(self):
+        """
+        Forget all of the versions so that each environment is given a new one when next used.
+        """
+        with self._lock:
+            self._versions.clear()
+
+
+def _check_private(path, status, mode_mask):
+    # only checked where there are users to check for
+    if not hasattr(os, 'getuid'):
+        return
+    if status.st_uid != os.getuid() or status.st_mode & mode_mask:
+        raise ImproperlyConfigured(
+            "%s must belong to, and only be writable by, the user running the app. Set the "
+            "LOCATION of ENVIRONMENT_VERSIONS to a directory private to that user." % path)
+
+
+class SharedMemoryVersions(object):
+    """
+    Versions held in a memory mapped file so that they are shared by all of the processes on a
+    host that use the same location, e.g. the workers of a gunicorn server. Reading a version is
+    a single unlocked read from the shared memory; bumps are serialised with a file lock.
+
+    The location is a directory, created if need be, holding a file per registry. Both must
+    belong to the user running the app and not be writable by anyone else, and the file isn't
+    opened through a link, so that other users can't supply or alter the versions.
+
+    The file has a fixed number of slots and environments share a slot when there are more of
+    them. Bumping a shared slot only makes the other environments' caches miss needlessly.
+    """
+    shared = True
+
+    _slot = struct.Struct(str('=q'))
+
+    def __init__(self, name, location, options=None):
+        self.name = name
+        self.directory = location
+        self.path = os.path.join(location, name)
+        self.slots = (options or {}).get('SLOTS', 65536)
+        self._map = None
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_map(self):
+        # each process maps the file itself so that file locks aren't shared with its parent
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    size = self.slots * self._slot.size
+                    descriptor = self._open()
+                    if os.fstat(descriptor).st_size < size:
+                        os.ftruncate(descriptor, size)
+                    self._file = os.fdopen(descriptor, 'r+b')
+                    self._map = mmap.mmap(descriptor, size)
+                    self._pid = os.getpid()
+
+        return self._map
+
+    def _open(self):
+        try:
+            os.mkdir(self.directory, 0o700)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        directory_status = os.lstat(self.directory)
+        if not stat.S_ISDIR(directory_status.st_mode):
+            raise ImproperlyConfigured("%s must be a directory" % self.directory)
+        _check_private(self.directory, directory_status, stat.S_IWGRP | stat.S_IWOTH)
+
+        descriptor = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0),
+                             0o600)
+        try:
+            _check_private(self.path, os.fstat(descriptor), 0o077)
+        except ImproperlyConfigured:
+            os.close(descriptor)
+            raise
+        return descriptor
+
+    def _get_offset(self, environment_id):
+        return (environment_id % self.slots) * self._slot.size
+
+    def _update(self, environment_id, get_version):
+        shared_map = self._get_map()
+        offset = self._get_offset(environment_id)
+
+        with self._lock:
+            if fcntl is not None:
+                fcntl.lockf(self._file, fcntl.LOCK_EX, self._slot.size, offset)
+            try:
+                version = get_version(self._slot.unpack_from(shared_map, offset)[0])
+                self._slot.pack_into(shared_map, offset, version)
+                return version
+            finally:
+                if fcntl is not None:
+                    fcntl.lockf(self._file, fcntl.LOCK_UN, self._slot.size, offset)
+
+    def get(self, environment_id):
+        version = self._slot.unpack_from(self._get_map(), self._get_offset(environment_id))[0]
+        if version:
+            return version
+
+        # the first process to use the slot seeds it for the others
+        return self._update(environment_id, lambda current: current or _version_seed())
+
+    def bump(self, environment_id):
+        return self._update(environment_id, lambda current: max(current + 1, _version_seed()))
+
+
+class PostgresNotifyVersions(EnvironmentVersions):
+    """
+    Process local versions which are kept in step across hosts with Postgres' LISTEN / NOTIFY.
+    Each bump is sent as a notification on the channel given by the location, which Postgres
+    delivers once the bumping transaction commits, and each process bumps its own version of the
+    environment when it receives one.
+
+    Notifications are received by a thread per process holding its own database connection.
+    """
+    shared = True
+
+    def __init__(self, name, location, options=None):
+        super(PostgresNotifyVersions, self).__init__(name, location, options)
+        self.channel = location
+
+    def get(self, environment_id):
+        _PostgresListener.get(self.channel).register(self)
+        return super(PostgresNotifyVersions, self).get(environment_id)
+
+    def bump(self, environment_id):
+        _PostgresListener.get(self.channel).register(self)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_notify(%s, %s)',
+                           [self.channel, '%s:%d' % (self.name, environment_id)])
+        return self.bump_local(environment_id)
+
+    def bump_local(self, environment_id):
+        return super(PostgresNotifyVersions, self).bump(environment_id)
+
+    def close(self):
+        """
+        Stop listening for notifications in this process.
+        """
+        _PostgresListener.stop(self.channel)
+
+
+class _PostgresListener(object):
+    """
+    Thread listening for the notifications sent on a channel by ``PostgresNotifyVersions`` and
+    passing them on to the registry of the same name.
+    """
+    _listeners = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, channel):
+        key = (channel, os.getpid())
+        try:
+            return cls._listeners[key]
+        except KeyError:
+            with cls._lock:
+                if key not in cls._listeners:
+                    listener = cls(channel)
+                    listener.start()
+                    cls._listeners[key] = listener
+                return cls._listeners[key]
+
+    @classmethod
+    def stop(cls, channel):
+        with cls._lock:
+            listener = cls._listeners.pop((channel, os.getpid()), None)
+
+        if listener is not None:
+            listener._stopped.set()
+            listener._thread.join()
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.registries = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def register(self, registry):
+        self.registries.setdefault(registry.name, registry)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name='environment-versions-listener')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                self.listen()
+            except Exception:
+                logger.exception("Lost connection listening for environment versions")
+                self._stopped.wait(1)
+
+    def listen(self):
+        listen_connection = connection.get_new_connection(connection.get_connection_params())
+        listen_connection.autocommit = True
+        try:
+            with listen_connection.cursor() as cursor:
+                cursor.execute('LISTEN %s' % connection.ops.quote_name(self.channel))
+
+            # versions may have moved on while nobody was listening
+            for registry in list(self.registries.values()):
+                registry.clear()
+
+            while not self._stopped.is_set():
+                if select.select([listen_connection], [], [], 1) == ([], [], []):
+                    continue
+
+                listen_connection.poll()
+                while listen_connection.notifies:
+                    self.handle(listen_connection.notifies.pop(0).payload)
+        finally:
+            listen_connection.close()
+
+    def handle(self, payload):
+        name, _, environment_id = payload.partition(':')
+        registry = self.registries.get(name)
+        if registry is not None:
+            registry.bump_local(int(environment_id))
+
+
+def get_versions(name):
+    """
+    Create the version registry with the given name using the ENVIRONMENT_VERSIONS setting.
+    """
+    backend = settings.ENVIRONMENT_VERSIONS
+    return import_string(backend['BACKEND'])(name, backend.get('LOCATION'),
+                                             backend.get('OPTIONS'))
+
+
+environment_versions = get_versions('environment')
+
+# The identity overrides within an environment share a single version so that the version of an
+# identity's flags is known without looking the identity up.
+identity_versions = get_versions('identity')
+
+
+def _invalidate(versions, environment_id):
+    versions.bump(environment_id)
+
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(lambda: versions.bump(environment_id))
+
+
+def invalidate_environment(environment_id):
+    """
+    Move the environment on to a new version. When called inside a transaction the version is
+    bumped again once the transaction commits so that readers who repopulated a cache with
+    uncommitted (i.e. old) data in the meantime don't keep serving it.
+    """
+    _invalidate(environment_versions, environment_id)
+
+
+def invalidate_identities(environment_id):
+    """
+    Move the identity overrides of the environment on to a new version. See
+    ``invalidate_environment``.
+    """
+    _invalidate(identity_versions, environment_id)
@@ -1,11 +1,23 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+from django.conf import settings
+from django.http import StreamingHttpResponse
 from rest_framework import viewsets, status
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, UnsupportedMediaType
 from rest_framework.response import Response
 
-from .models import Environment, Identity
-from .serializers import EnvironmentSerializerLight, IdentitySerializer
+from app.pagination import OptionalCursorPagination
+
+from .exports import CSVRenderer, JSONLRenderer, iter_identities, \
+    render as render_identities
+from .filters import IdentitySearchFilter
+from .imports import CONTENT_TYPES, IdentityImport, read_rows
+from .mixins import NestedEnvironmentMixin
+from .models import Environment, EnvironmentClone, Identity
+from .serializers import EnvironmentCloneSerializer, EnvironmentSerializerLight, \
+    IdentitySerializer
 
 
 class EnvironmentViewSet(viewsets.ModelViewSet):
@@ -27,6 +39,10 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
 
     delete:
     Delete an environment
+
+    clone:
+    Clone an environment (POST) with its feature states and, optionally, its identities and
+    their overrides, or get the progress of the clone that created an environment (GET)
     """
     serializer_class = EnvironmentSerializerLight
     lookup_field = 'api_key'
@@ -38,11 +54,36 @@ class EnvironmentViewSet(viewsets.ModelViewSet):
 
         return queryset
 
+    @action(detail=True, methods=["GET", "POST"], serializer_class=EnvironmentCloneSerializer)
+    def clone(self, request, api_key):
+        environment = self.get_object()
+
+        if request.method == "GET":
+            try:
+                clone = environment.clone_job
+            except EnvironmentClone.DoesNotExist:
+                raise NotFound("Environment is not a clone")
+            return Response(EnvironmentCloneSerializer(clone).data)
+
+        serializer = EnvironmentCloneSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        clone = environment.clone(serializer.validated_data['name'],
+                                  serializer.validated_data.get('include_identities', False))
+
+        if clone.identity_count > settings.ENVIRONMENT_CLONE_BACKGROUND_IDENTITIES:
+            # large environments are copied by the run_environment_clones worker, poll for progress
+            return Response(EnvironmentCloneSerializer(clone).data, status=status.HTTP_202_ACCEPTED)
+
+        clone.copy_identities()
+        return Response(EnvironmentCloneSerializer(clone).data, status=status.HTTP_201_CREATED)
 
-class IdentityViewSet(viewsets.ModelViewSet):
+
+class IdentityViewSet(NestedEnvironmentMixin, viewsets.ModelViewSet):
     """
     list:
-    Get all identities within specified environment
+    Get all identities within specified environment. Pass a cursor parameter, empty for the first
+    page, to page through them in order of id, and a search parameter to only get identities
+    with the text in their identifier
 
     create:
     Create identity within specified environment
@@ -58,21 +99,66 @@ class IdentityViewSet(viewsets.ModelViewSet):
 
     delete:
     Delete an identity within specified environment
+
+    import_identities:
+    Import identities, and optionally their overrides, from a CSV (text/csv) or JSON Lines
+    (application/x-ndjson) request body
+
+    export_identities:
+    Export all of the identities and their overrides as CSV (text/csv) or JSON Lines
+    (application/x-ndjson), in the form read by the import
     """
 
     serializer_class = IdentitySerializer
     lookup_field = 'identifier'
+    pagination_class = OptionalCursorPagination
+    filter_backends = (IdentitySearchFilter, )
 
     def get_queryset(self):
-        env_key = self.kwargs['environment_api_key']
-        return Identity.objects.filter(environment__api_key=env_key)
+        return Identity.objects.filter(environment_id=self.get_environment_from_request().id)
 
-    def get_environment_from_request(self):
+    @action(detail=False, methods=["POST"], url_path='import')
+    def import_identities(self, request, *args, **kwargs):
+        """
+        The body is read and imported a batch at a time, see ``IdentityImport``, and the response
+        reports the number of rows imported and rejected. The import runs within the request so
+        bodies are limited to IDENTITY_IMPORT_MAX_UPLOAD_SIZE bytes, larger files are imported with
+        the import_identities command.
         """
-        Get environment object from URL parameters in request.
+        content_type = request.content_type.split(';')[0].strip().lower()
+        if content_type not in CONTENT_TYPES:
+            raise UnsupportedMediaType(content_type)
+
+        try:
+            content_length = int(request.META.get('CONTENT_LENGTH'))
+        except (TypeError, ValueError):
+            return Response({'detail': 'Content-Length is required to import identities'},
+                            status=status.HTTP_411_LENGTH_REQUIRED)
+        if content_length > settings.IDENTITY_IMPORT_MAX_UPLOAD_SIZE:
+            return Response({'detail': 'Imports are limited to %d bytes, import larger files with '
+                                       'the import_identities management command'
+                                       % settings.IDENTITY_IMPORT_MAX_UPLOAD_SIZE},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        rows = read_rows(request.stream or [], CONTENT_TYPES[content_type])
+        identity_import = IdentityImport(self.get_environment_from_request()).run(rows)
+        return Response(identity_import.get_report())
+
+    @action(detail=False, methods=["GET"], url_path='export',
+            renderer_classes=[JSONLRenderer, CSVRenderer])
+    def export_identities(self, request, *args, **kwargs):
         """
-        environment = Environment.objects.get(api_key=self.kwargs['environment_api_key'])
-        return environment
+        The format is chosen from the Accept header or the format query parameter. The response
+        is streamed a chunk of identities at a time, see ``iter_identities``.
+        """
+        environment = self.get_environment_from_request()
+        export_format = request.accepted_renderer.format
+
+        response = StreamingHttpResponse(
+            render_identities(iter_identities(environment.id), export_format),
+            content_type=request.accepted_renderer.media_type)
+        response['Content-Disposition'] = 'attachment; filename="identities.%s"' % export_format
+        return response
 
     def create(self, request, *args, **kwargs):
         environment = self.get_environment_from_request()
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 from django.contrib import admin
 
+from app.pagination import EstimatedCountPaginator
 from .models import Feature, FeatureState, FeatureStateValue
 
 
@@ -28,6 +29,8 @@ class FeatureAdmin(admin.ModelAdmin):
 
 @admin.register(FeatureState)
 class FeatureStateAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     inlines = [
         FeatureStateValueInline,
     ]
@@ -45,6 +48,8 @@ class FeatureStateAdmin(admin.ModelAdmin):
 
 @admin.register(FeatureStateValue)
 class FeatureStateValueAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
     list_display = ('feature_state', 'type', 'boolean_value', 'integer_value', 'string_value', )
     list_filter = ('type', 'boolean_value', )
     list_select_related = ('feature_state',)
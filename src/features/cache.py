@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import zlib
+from collections import OrderedDict, namedtuple
+
+from django.db.models.functions import Lower
+from django.utils.http import quote_etag
+
+from environments.versions import environment_versions, identity_versions
+from .models import Feature
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, only gzip is offered without it
+    brotli = None
+
+CachedFlags = namedtuple('CachedFlags', ('environment_id', 'version', 'etag', 'document',
+                                         'encoded_documents'))
+
+# content encodings offered for cached documents, in order of preference
+CONTENT_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def get_environment_flags_etag(environment_id, version=None):
+    """
+    Strong ETag for the flags of an environment (or a single feature within it).
+    """
+    if version is None:
+        version = environment_versions.get(environment_id)
+
+    return quote_etag('%x-%x' % (environment_id, version))
+
+
+def get_encoded_etag(etag, content_encoding):
+    """
+    Each content encoding of a document is a different representation so needs its own ETag.
+    """
+    if content_encoding is None:
+        return etag
+
+    return '%s-%s"' % (etag[:-1], content_encoding)
+
+
+def get_identity_flags_etag(environment_id):
+    """
+    Strong ETag for the flags of an identity within an environment, covering both the environment
+    defaults and the identity overrides.
+    """
+    return quote_etag('%x-%x-%x' % (environment_id, environment_versions.get(environment_id),
+                                    identity_versions.get(environment_id)))
+
+
+def encode_document(document):
+    """
+    Compress a document with each of the content encodings offered.
+
+    :return: dictionary of content encoding to compressed document
+    """
+    encoded_documents = {}
+
+    for content_encoding in CONTENT_ENCODINGS:
+        if content_encoding == 'br':
+            encoded_documents[content_encoding] = brotli.compress(document)
+        else:
+            # a window size of 16 + 15 bits produces a gzip rather than a zlib stream
+            compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            encoded_documents[content_encoding] = compressor.compress(document) + \
+                compressor.flush()
+
+    return encoded_documents
+
+
+def get_content_encoding(accept_encoding):
+    """
+    Choose the content encoding to use for a response from an Accept-Encoding header.
+
+    :param accept_encoding: value of the Accept-Encoding header
+    :return: one of CONTENT_ENCODINGS or None if the response shouldn't be compressed
+    """
+    qualities = {}
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        quality = 1.0
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[params[0].strip().lower()] = quality
+
+    content_encoding, best_quality = None, 0.0
+    for candidate in CONTENT_ENCODINGS:
+        quality = qualities.get(candidate, qualities.get('*', 0.0))
+        if quality > best_quality:
+            content_encoding, best_quality = candidate, quality
+
+    return content_encoding
+
+
+class EnvironmentFlagsCache(object):
+    """
+    Process local cache of the rendered flags document for each environment, keyed by the
+    environment's api key so that a warm lookup doesn't need to resolve the environment first.
+
+    Only the latest version of each environment's document is kept. An entry is only returned
+    while its version matches the environment's current version. Compressed copies of the
+    document are stored with it so that compression only happens once per version.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, api_key):
+        entry = self._entries.get(api_key)
+        if entry is not None and entry.version == environment_versions.get(entry.environment_id):
+            return entry
+
+        return None
+
+    def set(self, api_key, environment_id, version, document):
+        entry = CachedFlags(environment_id, version,
+                            get_environment_flags_etag(environment_id, version), document,
+                            encode_document(document))
+        self._entries[api_key] = entry
+        return entry
+
+    def clear(self):
+        self._entries.clear()
+
+
+environment_flags_cache = EnvironmentFlagsCache()
+
+
+class FeatureNamesCache(object):
+    """
+    Process local map of lower case feature names to feature ids, used to resolve the features
+    requested by name on the SDK endpoints without querying the features.
+
+    The map for a project is held against each of its environments as saving or deleting a
+    feature moves all of the project's environments on to a new version, which invalidates it.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def get_feature_ids(self, environment, names):
+        """
+        Get the ids of the features in the environment's project with the given names.
+
+        :return: ordered dictionary of name to feature id, without the names that don't match a
+            feature
+        """
+        version, feature_ids = self._entries.get(environment.id, (None, None))
+
+        current_version = environment_versions.get(environment.id)
+        if version != current_version:
+            feature_ids = dict(
+                Feature.objects.filter(project_id=environment.project_id)
+                .annotate(lower_name=Lower('name'))
+                .order_by()
+                .values_list('lower_name', 'id')
+            )
+            self._entries[environment.id] = (current_version, feature_ids)
+
+        return OrderedDict((name, feature_ids[name.lower()]) for name in names
+                           if name.lower() in feature_ids)
+
+    def clear(self):
+        self._entries.clear()
+
+
+feature_names_cache = FeatureNamesCache()
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .encoders import feature_state_to_dict, get_feature_state_rows
+from .models import FeatureState, FeatureStateChange
+
+
+def get_settled_before():
+    """
+    Changes are only reported as part of a version once they are old enough that any change with
+    a lower id which was still being committed when they were read has landed too. More recent
+    changes are still sent but are sent again on the client's next request.
+    """
+    return timezone.now() - timedelta(seconds=settings.FEATURE_STATE_CHANGES_SETTLE_SECONDS)
+
+
+def get_changes_version(environment):
+    settled_changes = FeatureStateChange.objects.filter(environment=environment,
+                                                        created_date__lte=get_settled_before())
+    return settled_changes.aggregate(version=Max('id'))['version'] or 0
+
+
+def get_latest_version(environment):
+    """
+    Get the id of the latest change to the environment, whether or not it has settled.
+    """
+    changes = FeatureStateChange.objects.filter(environment=environment)
+    return changes.aggregate(version=Max('id'))['version'] or 0
+
+
+def get_full_flags(environment):
+    """
+    Get all of the environment's flags in the form of a delta which replaces whatever flags the
+    client already has.
+    """
+    version = get_changes_version(environment)
+    rows = get_feature_state_rows(FeatureState.objects.filter(environment=environment,
+                                                              identity=None))
+
+    return OrderedDict((
+        ('version', version),
+        ('full', True),
+        ('added', [feature_state_to_dict(row) for row in rows]),
+        ('changed', []),
+        ('removed', []),
+    ))
+
+
+def get_flags_delta(environment, since):
+    """
+    Get the flags of an environment that have been added, changed or removed since the given
+    version, with the version the client should ask for changes since next. Removed flags are
+    given as feature ids.
+
+    All of the flags are returned, marked as ``full``, when the client has no version yet or when
+    the log has been compacted since its version.
+    """
+    if not since:
+        return get_full_flags(environment)
+
+    settled_before = get_settled_before()
+    changes = FeatureStateChange.objects.filter(environment=environment, id__gt=since)\
+        .values_list('id', 'feature_id', 'change_type', 'created_date')
+
+    version = since
+    first_changes = OrderedDict()
+    for change_id, feature_id, change_type, created_date in changes:
+        if change_type == FeatureStateChange.COMPACTED:
+            return get_full_flags(environment)
+
+        if created_date <= settled_before:
+            version = change_id
+        first_changes.setdefault(feature_id, change_type)
+
+    flags = {}
+    if first_changes:
+        rows = get_feature_state_rows(FeatureState.objects.filter(
+            environment=environment, identity=None, feature__in=list(first_changes)))
+        flags = {flag['feature']['id']: flag for flag in map(feature_state_to_dict, rows)}
+
+    added, changed, removed = [], [], []
+    for feature_id, first_change in first_changes.items():
+        # a feature whose first change is its addition didn't exist at the client's version
+        existed = first_change != FeatureStateChange.ADDED
+        if feature_id in flags:
+            (changed if existed else added).append(flags[feature_id])
+        elif existed:
+            removed.append(feature_id)
+
+    return OrderedDict((
+        ('version', version),
+        ('full', False),
+        ('added', added),
+        ('changed', changed),
+        ('removed', removed),
+    ))
+
+
+def compact_changes(before):
+    """
+    Delete the changes recorded before the given time. Each environment that loses any is given a
+    new COMPACTED marker, in place of its older markers, so that clients with an older version
+    resynchronise. Environments that only had markers to delete keep their newest marker, so that
+    clients aren't made to resynchronise when nothing has changed.
+
+    :return: number of changes deleted, not counting markers
+    """
+    old_changes = FeatureStateChange.objects.filter(created_date__lt=before)
+    old_markers = old_changes.filter(change_type=FeatureStateChange.COMPACTED)
+
+    with transaction.atomic():
+        environment_ids = set(old_changes.exclude(change_type=FeatureStateChange.COMPACTED)
+                              .order_by().values_list('environment_id', flat=True).distinct())
+        newest_marker_ids = old_markers.exclude(environment_id__in=environment_ids)\
+            .order_by().values('environment_id').annotate(newest_id=Max('id'))\
+            .values_list('newest_id', flat=True)
+        deleted, _ = old_changes.exclude(change_type=FeatureStateChange.COMPACTED).delete()
+        old_markers.exclude(id__in=list(newest_marker_ids)).delete()
+        FeatureStateChange.objects.bulk_create([
+            FeatureStateChange(environment_id=environment_id,
+                               change_type=FeatureStateChange.COMPACTED)
+            for environment_id in sorted(environment_ids)
+        ])
+
+    return deleted
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+from collections import OrderedDict
+
+from django.utils import timezone
+
+from .models import BOOLEAN, INTEGER, STRING
+
+# Columns fetched for each feature state, in the order ``feature_state_to_dict`` unpacks them.
+FEATURE_STATE_FIELDS = (
+    'id',
+    'feature_id',
+    'feature__name',
+    'feature__created_date',
+    'feature__initial_value',
+    'feature__description',
+    'feature__default_enabled',
+    'feature__type',
+    'feature__project_id',
+    'feature_state_value__type',
+    'feature_state_value__integer_value',
+    'feature_state_value__string_value',
+    'feature_state_value__boolean_value',
+    'enabled',
+    'environment_id',
+    'identity_id',
+)
+
+
+def get_feature_state_rows(feature_states):
+    """
+    Get the rows needed to render the given feature states, fetched in a single query.
+
+    :param feature_states: queryset of feature states
+    :return: queryset of tuples of ``FEATURE_STATE_FIELDS``
+    """
+    return feature_states.values_list(*FEATURE_STATE_FIELDS)
+
+
+def is_identity_override(row):
+    return row[-1] is not None
+
+
+def _format_datetime(value):
+    # matches the ISO 8601 output of DRF's DateTimeField
+    if value is None:
+        return None
+
+    value = timezone.localtime(value).isoformat()
+    if value.endswith('+00:00'):
+        value = value[:-6] + 'Z'
+    return value
+
+
+def feature_state_to_dict(row):
+    """
+    Build the same representation of a feature state as ``FeatureStateSerializerFull`` from a
+    row of ``FEATURE_STATE_FIELDS``.
+    """
+    (feature_state_id, feature_id, name, created_date, initial_value, description,
+     default_enabled, feature_type, project_id, value_type, integer_value, string_value,
+     boolean_value, enabled, environment_id, identity_id) = row
+
+    if value_type == INTEGER:
+        value = integer_value
+    elif value_type == STRING:
+        value = string_value
+    elif value_type == BOOLEAN:
+        value = boolean_value
+    else:
+        value = None
+
+    return OrderedDict((
+        ('id', feature_state_id),
+        ('feature', OrderedDict((
+            ('id', feature_id),
+            ('name', name),
+            ('created_date', _format_datetime(created_date)),
+            ('initial_value', initial_value),
+            ('description', description),
+            ('default_enabled', default_enabled),
+            ('type', feature_type),
+            ('project', project_id),
+        ))),
+        ('feature_state_value', value),
+        ('enabled', enabled),
+        ('environment', environment_id),
+        ('identity', identity_id),
+    ))
+
+
+def render(data):
+    """
+    Render data to JSON bytes in the same way as DRF's JSONRenderer with the project's settings.
+    """
+    return json.dumps(data, ensure_ascii=True, allow_nan=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def render_feature_states(rows):
+    return render([feature_state_to_dict(row) for row in rows])
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import timeit
+
+from django.core.management import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from environments.models import Environment
+from features.management.benchmark import rolled_back
+from features.models import Feature
+from organisations.models import Organisation
+from projects.models import Project
+
+
+class Command(BaseCommand):
+    help = "Measure the queries and time taken to create an environment, and to move it to " \
+           "another project, as the number of features grows. Test data is created in a " \
+           "transaction that is always rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--features', type=int, nargs='+', default=[10, 100, 1000, 2000],
+                            help="Numbers of features per project to benchmark")
+
+    def handle(self, *args, **options):
+        self.stdout.write("%10s %14s %14s %14s %14s" % ("features", "create queries",
+                                                        "create ms", "move queries", "move ms"))
+
+        for feature_count in options['features']:
+            with rolled_back():
+                self.benchmark(feature_count)
+
+    def benchmark(self, feature_count):
+        organisation = Organisation.objects.create(name="Benchmark Organisation")
+        projects = [Project.objects.create(name="Benchmark Project %d" % i,
+                                           organisation=organisation) for i in range(2)]
+        for project in projects:
+            Feature.objects.bulk_create([
+                Feature(name="benchmark_feature_%d" % i, project=project,
+                        initial_value="value %d" % i)
+                for i in range(feature_count)
+            ])
+
+        environment = Environment(name="Benchmark Environment", project=projects[0])
+        with CaptureQueriesContext(connection) as create_queries:
+            create_time = timeit.timeit(environment.save, number=1) * 1000
+
+        environment.project = projects[1]
+        with CaptureQueriesContext(connection) as move_queries:
+            move_time = timeit.timeit(environment.save, number=1) * 1000
+
+        self.stdout.write("%10d %14d %14.2f %14d %14.2f" % (feature_count, len(create_queries),
+                                                            create_time, len(move_queries),
+                                                            move_time))
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import timeit
+
+from django.core.management import BaseCommand
+from rest_framework.renderers import JSONRenderer
+
+from environments.models import Environment
+from features.encoders import get_feature_state_rows, render_feature_states
+from features.management.benchmark import rolled_back
+from features.models import Feature, FeatureState
+from features.serializers import FeatureStateSerializerFull
+from organisations.models import Organisation
+from projects.models import Project
+
+
+class Command(BaseCommand):
+    help = "Compare rendering an environment's flags with the SDK encoder against the DRF " \
+           "serializer. Test data is created in a transaction that is always rolled back."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--features', type=int, nargs='+', default=[10, 100, 1000],
+                            help="Numbers of features per environment to benchmark")
+        parser.add_argument('--repeat', type=int, default=20,
+                            help="Number of times each rendering is timed")
+
+    def handle(self, *args, **options):
+        self.stdout.write("%10s %14s %14s %8s" % ("features", "serializer ms", "encoder ms",
+                                                  "speedup"))
+
+        for feature_count in options['features']:
+            with rolled_back():
+                self.benchmark(feature_count, options['repeat'])
+
+    def benchmark(self, feature_count, repeat):
+        organisation = Organisation.objects.create(name="Benchmark Organisation")
+        project = Project.objects.create(name="Benchmark Project", organisation=organisation)
+        environment = Environment.objects.create(name="Benchmark Environment", project=project)
+        for i in range(feature_count):
+            Feature.objects.create(name="benchmark_feature_%d" % i, project=project,
+                                   initial_value="value %d" % i,
+                                   description="Benchmark feature %d" % i)
+
+        def serialize():
+            feature_states = FeatureState.objects.filter(environment=environment, identity=None)\
+                .select_related('feature', 'feature_state_value')
+            return JSONRenderer().render(
+                FeatureStateSerializerFull(feature_states, many=True).data)
+
+        def encode():
+            feature_states = FeatureState.objects.filter(environment=environment, identity=None)
+            return render_feature_states(get_feature_state_rows(feature_states))
+
+        if serialize() != encode():
+            raise AssertionError("Encoder output differs from the serializer output")
+
+        serializer_time = min(timeit.repeat(serialize, number=1, repeat=repeat)) * 1000
+        encoder_time = min(timeit.repeat(encode, number=1, repeat=repeat)) * 1000
+
+        self.stdout.write("%10d %14.2f %14.2f %7.1fx" % (
+            feature_count, serializer_time, encoder_time, serializer_time / encoder_time))
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.utils import timezone
+
+from features.changes import compact_changes
+
+
+class Command(BaseCommand):
+    help = "Delete old feature state changes from the log used for the delta flags endpoint. " \
+           "Intended to be run periodically, e.g. daily."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int,
+                            default=settings.FEATURE_STATE_CHANGES_RETENTION_DAYS,
+                            help="Number of days of changes to keep")
+
+    def handle(self, *args, **options):
+        deleted = compact_changes(timezone.now() - timedelta(days=options['days']))
+        self.stdout.write("Deleted %d feature state changes" % deleted)
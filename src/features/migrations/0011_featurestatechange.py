@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-18 02:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('environments', '0003_unique_identity_identifier'),
+        ('features', '0010_merge_20180816_1531'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeatureStateChange',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('feature_id', models.IntegerField(null=True)),
+                ('change_type', models.CharField(choices=[('ADDED', 'Added'), ('CHANGED', 'Changed'), ('REMOVED', 'Removed'), ('COMPACTED', 'Compacted')], max_length=10)),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='DateCreated')),
+                ('environment', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='feature_state_changes', to='environments.Environment')),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='featurestatechange',
+            index=models.Index(fields=['environment', 'id'], name='features_fe_environ_d8dca0_idx'),
+        ),
+    ]
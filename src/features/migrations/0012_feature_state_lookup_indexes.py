@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+from app.indexes import create_index_concurrently, drop_index_concurrently
+
+# name, columns and condition of each index
+INDEXES = (
+    # environment defaults, i.e. an environment's flags, in the order they're listed in
+    ('features_featurestate_environment_defaults', '(environment_id, id)',
+     'WHERE identity_id IS NULL'),
+    # an identity's override of a feature
+    ('features_featurestate_identity_feature', '(identity_id, feature_id)', ''),
+)
+
+
+def create_indexes(apps, schema_editor):
+    """
+    Add the indexes used to look up feature states by environment, for an environment's flags,
+    and by identity and feature, for an identity's overrides. The unique index on (feature,
+    environment, identity) leads with the feature so doesn't help either. Identities are looked
+    up by (environment, identifier) with their unique index, see environments migration 0003.
+
+    The indexes are built concurrently on PostgreSQL, which is why this migration isn't atomic,
+    see ``create_index_concurrently``.
+    """
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        for name, columns, condition in INDEXES:
+            create_index_concurrently(schema_editor, name, 'features_featurestate',
+                                      '%s %s' % (columns, condition))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        for name, _, _ in INDEXES:
+            drop_index_concurrently(schema_editor, name)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('features', '0011_featurestatechange'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+COMPACTED = 'COMPACTED'
+
+
+def record_baselines(apps, schema_editor):
+    """
+    Start the change log of each environment that has no changes, i.e. those created before the
+    log was added, with a COMPACTED marker so that it has a version to report before its first
+    change.
+    """
+    Environment = apps.get_model('environments', 'Environment')
+    FeatureStateChange = apps.get_model('features', 'FeatureStateChange')
+
+    environment_ids = Environment.objects.exclude(
+        id__in=FeatureStateChange.objects.values('environment_id'),
+    ).order_by('id').values_list('id', flat=True)
+    FeatureStateChange.objects.bulk_create([
+        FeatureStateChange(environment_id=environment_id, change_type=COMPACTED)
+        for environment_id in environment_ids
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('features', '0012_feature_state_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(record_baselines, migrations.RunPython.noop),
+    ]
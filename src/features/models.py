@@ -2,10 +2,14 @@
 from __future__ import unicode_literals
 
 from django.core.exceptions import ObjectDoesNotExist, ValidationError, NON_FIELD_ERRORS
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models import Case, F, Value, When
+from django.db.models.functions import Lower
+from django.utils import six, timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 
+from environments.versions import invalidate_environment, invalidate_identities
 from projects.models import Project
 
 
@@ -19,6 +23,16 @@ STRING = "unicode"
 BOOLEAN = "bool"
 
 
+class FeatureQuerySet(models.QuerySet):
+    def filter_by_name(self, name):
+        """
+        Filter features by name, case insensitively. Compares ``lower(name)`` rather than using
+        ``name__iexact`` (which compares ``upper(name)``) so that the lowercase_feature_name index
+        on (lower(name), project_id) can be used.
+        """
+        return self.annotate(lower_name=Lower('name')).filter(lower_name=Lower(Value(name)))
+
+
 @python_2_unicode_compatible
 class Feature(models.Model):
     FEATURE_TYPES = (
@@ -43,36 +57,90 @@ class Feature(models.Model):
     default_enabled = models.BooleanField(default=False)
     type = models.CharField(max_length=50, choices=FEATURE_TYPES, default=FLAG)
 
+    objects = FeatureQuerySet.as_manager()
+
     class Meta:
         ordering = ['id']
         # Note: uniqueness is changed to reference lowercase name in explicit SQL in the migrations
         unique_together = ("name", "project")
 
+    # fields of the feature sent to clients with each of its flags
+    flags_fields = ('name', 'initial_value', 'description', 'default_enabled', 'type')
+
     def save(self, *args, **kwargs):
         """
-        Override save method to initialise feature states for all environments
-        """
-        if self.pk:
-            old_feature = Feature.objects.get(pk=self.pk)
-            if old_feature.project != self.project:
-                FeatureState.objects.filter(
-                    feature=self,
-                    environment=old_feature.project.environments.values_list('pk', flat=True),
-                ).all().delete()
-
-        super(Feature, self).save(*args, **kwargs)
-
-        # create feature states for all environments in the project
-        environments = self.project.environments.all()
-        for env in environments:
-            FeatureState.objects.update_or_create(
-                feature=self,
-                environment=env,
-                identity=None,
-                defaults={
-                    'enabled': self.default_enabled
-                },
-            )
+        Override save method to initialise feature states for all environments, and to record
+        a change to each of them when the feature's part of their flags has changed
+        """
+        with transaction.atomic():
+            old_values = None
+            if self.pk:
+                old_values = Feature.objects.filter(pk=self.pk)\
+                    .values('project_id', *self.flags_fields).get()
+                if old_values['project_id'] != self.project_id:
+                    FeatureState.objects.filter(
+                        feature=self,
+                        environment__project_id=old_values['project_id'],
+                    ).delete()
+
+            super(Feature, self).save(*args, **kwargs)
+
+            # the feature states of a new or moved feature are recorded as added as they are
+            # created
+            added = old_values is None or old_values['project_id'] != self.project_id
+            # the environment feature states only need to change when the feature is new, has
+            # moved project or has a new default
+            if added or old_values['default_enabled'] != self.default_enabled:
+                self.initialise_feature_states(created=added)
+            if not added and any(old_values[field] != getattr(self, field)
+                                 for field in self.flags_fields):
+                FeatureStateChange.objects.bulk_create([
+                    FeatureStateChange(environment_id=environment_id, feature_id=self.id,
+                                       change_type=FeatureStateChange.CHANGED)
+                    for environment_id in self.project.environments.values_list('id', flat=True)
+                ])
+
+    def initialise_feature_states(self, created=False):
+        """
+        Set the environment feature states of all of the project's environments to the feature's
+        default, creating those that are missing along with their values.
+
+        :param created: whether none of the feature states can exist yet
+        """
+        environment_ids = set(self.project.environments.values_list('id', flat=True))
+        if not environment_ids:
+            return
+
+        existing_environment_ids = set()
+        if not created:
+            FeatureState.objects.filter(feature=self, identity=None)\
+                .exclude(enabled=self.default_enabled).update(enabled=self.default_enabled)
+            existing_environment_ids = set(
+                FeatureState.objects.filter(feature=self, identity=None)
+                .values_list('environment_id', flat=True))
+
+        missing_environment_ids = sorted(environment_ids - existing_environment_ids)
+        if not missing_environment_ids:
+            return
+
+        FeatureState.objects.bulk_create([
+            FeatureState(feature=self, environment_id=environment_id, identity=None,
+                         enabled=self.default_enabled)
+            for environment_id in missing_environment_ids
+        ])
+        # ids aren't set by bulk_create on every database so the new feature states are fetched
+        feature_state_ids = FeatureState.objects.filter(
+            feature=self, identity=None, environment_id__in=missing_environment_ids,
+        ).values_list('id', flat=True)
+        FeatureStateValue.objects.bulk_create([
+            FeatureStateValue(feature_state_id=feature_state_id, string_value=self.initial_value)
+            for feature_state_id in feature_state_ids
+        ])
+        FeatureStateChange.objects.bulk_create([
+            FeatureStateChange(environment_id=environment_id, feature_id=self.id,
+                               change_type=FeatureStateChange.ADDED)
+            for environment_id in missing_environment_ids
+        ])
 
     def validate_unique(self, *args, **kwargs):
         """
@@ -81,7 +149,7 @@ class Feature(models.Model):
         """
         super(Feature, self).validate_unique(*args, **kwargs)
 
-        if Feature.objects.filter(project=self.project, name__iexact=self.name).exists():
+        if Feature.objects.filter(project=self.project).filter_by_name(self.name).exists():
             raise ValidationError(
                 {
                     NON_FIELD_ERRORS: [
@@ -95,6 +163,266 @@ class Feature(models.Model):
         return "Project %s - Feature %s" % (self.project.name, self.name)
 
 
+class FeatureStateManager(models.Manager):
+    # number of ids given to each IN clause, kept below SQLite's limit of 999 query parameters
+    ids_batch_size = 500
+
+    def _get_tables(self, connection):
+        quote_name = connection.ops.quote_name
+        return {
+            'feature': quote_name(Feature._meta.db_table),
+            'feature_state': quote_name(self.model._meta.db_table),
+            'feature_state_value': quote_name(FeatureStateValue._meta.db_table),
+            'feature_state_change': quote_name(FeatureStateChange._meta.db_table),
+        }
+
+    def seed_environment(self, environment_id, project_id, source_environment_id=None):
+        """
+        Create the default feature state, and its value, of each of the project's features that
+        doesn't have one in the environment yet, recording each addition in the change log. Runs
+        a fixed number of INSERT ... SELECT statements however many features the project has.
+        Signals aren't sent for the new feature states.
+
+        :param source_environment_id: optional id of an environment of the same project to copy
+            the feature states and values of rather than using the features' defaults
+        """
+        connection = connections[self.db]
+        tables = self._get_tables(connection)
+        missing_features = """
+            WHERE feature.project_id = %%s AND NOT EXISTS (
+                SELECT 1 FROM %(feature_state)s feature_state
+                WHERE feature_state.feature_id = feature.id
+                AND feature_state.environment_id = %%s
+                AND feature_state.identity_id IS NULL
+            )
+        """ % tables
+        created_date = connection.ops.adapt_datetimefield_value(timezone.now())
+
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO %(feature_state_change)s
+                    (environment_id, feature_id, change_type, created_date)
+                SELECT %%s, feature.id, %%s, %%s
+                FROM %(feature)s feature
+                """ % tables + missing_features,
+                [environment_id, FeatureStateChange.ADDED, created_date, project_id,
+                 environment_id])
+            cursor.execute(
+                """
+                INSERT INTO %(feature_state)s (feature_id, environment_id, identity_id, enabled)
+                SELECT feature.id, %%s, NULL, COALESCE(source.enabled, feature.default_enabled)
+                FROM %(feature)s feature
+                LEFT OUTER JOIN %(feature_state)s source ON source.feature_id = feature.id
+                    AND source.environment_id = %%s AND source.identity_id IS NULL
+                """ % tables + missing_features,
+                [environment_id, source_environment_id, project_id, environment_id])
+            cursor.execute(
+                """
+                INSERT INTO %(feature_state_value)s
+                    (feature_state_id, type, boolean_value, integer_value, string_value)
+                SELECT
+                    feature_state.id,
+                    CASE WHEN source_value.id IS NULL THEN %%s ELSE source_value.type END,
+                    source_value.boolean_value,
+                    source_value.integer_value,
+                    CASE WHEN source_value.id IS NULL THEN feature.initial_value
+                        ELSE source_value.string_value END
+                FROM %(feature_state)s feature_state
+                INNER JOIN %(feature)s feature ON feature.id = feature_state.feature_id
+                LEFT OUTER JOIN %(feature_state)s source ON source.feature_id = feature.id
+                    AND source.environment_id = %%s AND source.identity_id IS NULL
+                LEFT OUTER JOIN %(feature_state_value)s source_value
+                    ON source_value.feature_state_id = source.id
+                WHERE feature_state.environment_id = %%s AND feature_state.identity_id IS NULL
+                AND NOT EXISTS (
+                    SELECT 1 FROM %(feature_state_value)s feature_state_value
+                    WHERE feature_state_value.feature_state_id = feature_state.id
+                )
+                """ % tables,
+                [STRING, source_environment_id, environment_id])
+
+    def update_environment_feature_states(self, environment_id, changes):
+        """
+        Update many of the environment's default feature states with a fixed number of
+        statements, recording the changes and moving the environment on to a new version once.
+        Signals aren't sent for the updated feature states.
+
+        :param changes: list of dictionaries with the ids of a feature and of its feature state
+            in the environment (``feature`` and ``feature_state``) and, optionally, the new
+            ``enabled`` flag and ``feature_state_value``
+        """
+        enabled = {True: [], False: []}
+        values = {}
+        for change in changes:
+            if 'enabled' in change:
+                enabled[change['enabled']].append(change['feature_state'])
+            if 'feature_state_value' in change:
+                values[change['feature_state']] = change['feature_state_value']
+
+        batch_size = self.ids_batch_size
+        with transaction.atomic(using=self.db):
+            for value, feature_state_ids in enabled.items():
+                for i in range(0, len(feature_state_ids), batch_size):
+                    self.filter(id__in=feature_state_ids[i:i + batch_size])\
+                        .exclude(enabled=value).update(enabled=value)
+
+            if values:
+                FeatureStateValue.objects.bulk_set_values(values)
+
+            FeatureStateChange.record(environment_id,
+                                      sorted(change['feature'] for change in changes),
+                                      FeatureStateChange.CHANGED)
+            invalidate_environment(environment_id)
+
+    def set_identity_overrides(self, environment_id, overrides):
+        """
+        Create or update many identity overrides in the environment with a fixed number of
+        statements, moving the environment's identity overrides on to a new version once.
+        Overrides are created with the feature's initial value unless given a value, as when
+        created through the API. Signals aren't sent for the feature states.
+
+        :param overrides: dictionary of (identity id, feature id) to a dictionary with,
+            optionally, the override's ``enabled`` flag and ``feature_state_value``
+        """
+        if not overrides:
+            return
+
+        batch_size = self.ids_batch_size
+        identity_ids = sorted(set(identity_id for identity_id, _ in overrides))
+
+        def get_override_ids():
+            override_ids = {}
+            for i in range(0, len(identity_ids), batch_size):
+                override_ids.update(
+                    ((identity_id, feature_id), feature_state_id)
+                    for identity_id, feature_id, feature_state_id in self.filter(
+                        identity_id__in=identity_ids[i:i + batch_size],
+                    ).values_list('identity_id', 'feature_id', 'id')
+                    if (identity_id, feature_id) in overrides
+                )
+            return override_ids
+
+        with transaction.atomic(using=self.db):
+            override_ids = get_override_ids()
+            new_overrides = [key for key in overrides if key not in override_ids]
+
+            enabled = {True: [], False: []}
+            for key, override_id in override_ids.items():
+                if 'enabled' in overrides[key]:
+                    enabled[overrides[key]['enabled']].append(override_id)
+            for value, feature_state_ids in enabled.items():
+                for i in range(0, len(feature_state_ids), batch_size):
+                    self.filter(id__in=feature_state_ids[i:i + batch_size])\
+                        .exclude(enabled=value).update(enabled=value)
+
+            if new_overrides:
+                self.bulk_create([
+                    self.model(feature_id=feature_id, environment_id=environment_id,
+                               identity_id=identity_id,
+                               enabled=overrides[identity_id, feature_id].get('enabled', False))
+                    for identity_id, feature_id in new_overrides
+                ])
+                # ids aren't set by bulk_create on every database so the overrides are fetched
+                override_ids = get_override_ids()
+                initial_values = dict(Feature.objects.filter(
+                    project__environments__id=environment_id,
+                ).values_list('id', 'initial_value'))
+
+            values = {}
+            for key, override_id in override_ids.items():
+                if 'feature_state_value' in overrides[key]:
+                    values[override_id] = overrides[key]['feature_state_value']
+            for identity_id, feature_id in new_overrides:
+                override_id = override_ids[identity_id, feature_id]
+                values.setdefault(override_id, initial_values[feature_id])
+            if values:
+                FeatureStateValue.objects.bulk_set_values(values)
+
+            invalidate_identities(environment_id)
+
+    def copy_identity_overrides(self, source_environment_id, environment_id,
+                                after_identity_id, last_identity_id):
+        """
+        Copy the overrides, and their values, of a range of the source environment's identities
+        to the identities with the same identifiers in the environment, which must already exist.
+        Signals aren't sent for the new feature states.
+
+        :param after_identity_id: id of the source identity to copy the overrides after
+        :param last_identity_id: id of the last source identity to copy the overrides of
+        """
+        connection = connections[self.db]
+        tables = self._get_tables(connection)
+        tables['identity'] = connection.ops.quote_name(
+            self.model._meta.get_field('identity').related_model._meta.db_table)
+        source_overrides = """
+            FROM %(feature_state)s source
+            INNER JOIN %(identity)s source_identity ON source_identity.id = source.identity_id
+            INNER JOIN %(identity)s target_identity
+                ON target_identity.identifier = source_identity.identifier
+                AND target_identity.environment_id = %%s
+        """ % tables
+        source_identities = """
+            WHERE source_identity.environment_id = %s
+            AND source_identity.id > %s AND source_identity.id <= %s
+        """
+        params = [environment_id, source_environment_id, after_identity_id, last_identity_id]
+
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO %(feature_state)s (feature_id, environment_id, identity_id, enabled)
+                SELECT source.feature_id, %%s, target_identity.id, source.enabled
+                """ % tables + source_overrides + source_identities,
+                [environment_id] + params)
+            cursor.execute(
+                """
+                INSERT INTO %(feature_state_value)s
+                    (feature_state_id, type, boolean_value, integer_value, string_value)
+                SELECT target.id, source_value.type, source_value.boolean_value,
+                    source_value.integer_value, source_value.string_value
+                """ % tables + source_overrides + """
+                INNER JOIN %(feature_state)s target ON target.identity_id = target_identity.id
+                    AND target.feature_id = source.feature_id
+                INNER JOIN %(feature_state_value)s source_value
+                    ON source_value.feature_state_id = source.id
+                """ % tables + source_identities,
+                params)
+
+    def remove_project_features(self, environment_id, project_id):
+        """
+        Delete the feature states, including identity overrides, of the project's features in the
+        environment, recording the removal of each default in the change log. Signals aren't sent
+        for the deleted feature states.
+        """
+        connection = connections[self.db]
+        tables = self._get_tables(connection)
+        project_feature_states = """
+            environment_id = %%s
+            AND feature_id IN (SELECT id FROM %(feature)s WHERE project_id = %%s)
+        """ % tables
+        created_date = connection.ops.adapt_datetimefield_value(timezone.now())
+
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.execute(
+                """
+                INSERT INTO %(feature_state_change)s
+                    (environment_id, feature_id, change_type, created_date)
+                SELECT environment_id, feature_id, %%s, %%s FROM %(feature_state)s
+                WHERE identity_id IS NULL AND
+                """ % tables + project_feature_states,
+                [FeatureStateChange.REMOVED, created_date, environment_id, project_id])
+            cursor.execute(
+                """
+                DELETE FROM %(feature_state_value)s WHERE feature_state_id IN (
+                    SELECT id FROM %(feature_state)s WHERE
+                """ % tables + project_feature_states + ")",
+                [environment_id, project_id])
+            cursor.execute(
+                "DELETE FROM %(feature_state)s WHERE" % tables + project_feature_states,
+                [environment_id, project_id])
+
+
 @python_2_unicode_compatible
 class FeatureState(models.Model):
     feature = models.ForeignKey(Feature, related_name='feature_states')
@@ -104,6 +432,8 @@ class FeatureState(models.Model):
                                  null=True, default=None, blank=True)
     enabled = models.BooleanField(default=False)
 
+    objects = FeatureStateManager()
+
     class Meta:
         unique_together = ("feature", "environment", "identity")
         ordering = ['id']
@@ -172,6 +502,62 @@ class FeatureState(models.Model):
             return "Feature %s - Enabled: %r" % (self.feature.name, self.enabled)
 
 
+class FeatureStateValueManager(models.Manager):
+    # number of values set per UPDATE, kept below SQLite's limit of 999 query parameters
+    set_values_batch_size = 150
+
+    def bulk_set_values(self, values):
+        """
+        Set the values of many feature states with an UPDATE per batch of values, creating the
+        feature state values that don't exist yet. Only the type and the field holding the value
+        are written, as when a value is set through the API.
+
+        :param values: dictionary of feature state id to value
+        """
+        # feature state id to the type, the name of the field holding the value and the value
+        fields = {}
+        for feature_state_id, value in values.items():
+            fsv_type = type(value).__name__
+            if fsv_type not in (STRING, INTEGER, BOOLEAN):
+                # Default to string if not an anticipated type to keep backwards compatibility
+                fsv_type = STRING
+                value = value if value is None else six.text_type(value)
+            fields[feature_state_id] = (fsv_type,
+                                        FeatureState._get_feature_state_key_name(fsv_type), value)
+
+        feature_state_ids = sorted(fields)
+        existing_ids = set()
+        for i in range(0, len(feature_state_ids), self.set_values_batch_size):
+            batch = feature_state_ids[i:i + self.set_values_batch_size]
+            batch_existing_ids = set(self.filter(feature_state_id__in=batch)
+                                     .values_list('feature_state_id', flat=True))
+            if batch_existing_ids:
+                self._update_values(dict((feature_state_id, fields[feature_state_id])
+                                         for feature_state_id in batch_existing_ids))
+            existing_ids |= batch_existing_ids
+
+        self.bulk_create([
+            self.model(feature_state_id=feature_state_id, type=field[0], **{field[1]: field[2]})
+            for feature_state_id, field in fields.items() if feature_state_id not in existing_ids
+        ])
+
+    def _update_values(self, fields):
+        update_fields = {}
+        for field_name in ('type', 'boolean_value', 'integer_value', 'string_value'):
+            whens = [
+                When(feature_state_id=feature_state_id,
+                     then=Value(fsv_type if field_name == 'type' else value))
+                for feature_state_id, (fsv_type, value_field_name, value) in fields.items()
+                if field_name in ('type', value_field_name)
+            ]
+            if whens:
+                update_fields[field_name] = Case(
+                    *whens, default=F(field_name),
+                    output_field=self.model._meta.get_field(field_name))
+
+        self.filter(feature_state_id__in=list(fields)).update(**update_fields)
+
+
 class FeatureStateValue(models.Model):
     FEATURE_STATE_VALUE_TYPES = (
         (INTEGER, 'Integer'),
@@ -185,3 +571,51 @@ class FeatureStateValue(models.Model):
     boolean_value = models.NullBooleanField(null=True, blank=True)
     integer_value = models.IntegerField(null=True, blank=True)
     string_value = models.CharField(null=True, max_length=2000, blank=True)
+
+    objects = FeatureStateValueManager()
+
+
+class FeatureStateChange(models.Model):
+    """
+    Append only log of changes to the environment level feature states of each environment, used
+    to send polling clients only the flags that have changed since the version they last saw. The
+    id of a change is used as the version of the environment it produces.
+
+    The log is compacted periodically. Compaction leaves a COMPACTED marker behind so that
+    clients asking for changes from before the marker know to resynchronise all of their flags.
+    """
+    ADDED = 'ADDED'
+    CHANGED = 'CHANGED'
+    REMOVED = 'REMOVED'
+    COMPACTED = 'COMPACTED'
+
+    CHANGE_TYPES = (
+        (ADDED, 'Added'),
+        (CHANGED, 'Changed'),
+        (REMOVED, 'Removed'),
+        (COMPACTED, 'Compacted'),
+    )
+
+    id = models.BigAutoField(primary_key=True)
+    # changes are recorded while an environment's feature states are deleted along with it, so
+    # they aren't constrained to existing environments and are left for compaction to remove
+    environment = models.ForeignKey('environments.Environment',
+                                    related_name='feature_state_changes',
+                                    on_delete=models.DO_NOTHING, db_constraint=False)
+    # not a foreign key so that removals are kept once the feature has been deleted
+    feature_id = models.IntegerField(null=True)
+    change_type = models.CharField(max_length=10, choices=CHANGE_TYPES)
+    created_date = models.DateTimeField('DateCreated', auto_now_add=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['environment', 'id']),
+        ]
+
+    @classmethod
+    def record(cls, environment_id, feature_ids, change_type):
+        cls.objects.bulk_create([
+            cls(environment_id=environment_id, feature_id=feature_id, change_type=change_type)
+            for feature_id in feature_ids
+        ])
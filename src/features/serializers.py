@@ -1,3 +1,4 @@
+from django.utils import six
 from rest_framework import serializers
 
 from .models import Feature, FeatureState, FeatureStateValue
@@ -11,7 +12,7 @@ class CreateFeatureSerializer(serializers.ModelSerializer):
     def validate(self, data):
         data = super(CreateFeatureSerializer, self).validate(data)
 
-        if Feature.objects.filter(project=data['project'], name__iexact=data['name']).exists():
+        if Feature.objects.filter(project=data['project']).filter_by_name(data['name']).exists():
             raise serializers.ValidationError("Feature with that name already exists for this "
                                               "project. Note that feature names are case "
                                               "insensitive.")
@@ -59,3 +60,20 @@ class FeatureStateValueSerializer(serializers.ModelSerializer):
     class Meta:
         model = FeatureStateValue
         fields = "__all__"
+
+
+class FeatureStateBulkUpdateSerializer(serializers.Serializer):
+    feature = serializers.IntegerField()
+    enabled = serializers.BooleanField(required=False)
+    feature_state_value = serializers.JSONField(required=False, allow_null=True)
+
+    def validate_feature_state_value(self, value):
+        if isinstance(value, (dict, list)):
+            raise serializers.ValidationError("Must be a string, integer or boolean.")
+        if isinstance(value, six.integer_types) and not isinstance(value, bool) and \
+                not -2 ** 31 <= value < 2 ** 31:
+            raise serializers.ValidationError("Integer values must fit in 32 bits.")
+        if isinstance(value, six.string_types) and len(value) > 2000:
+            raise serializers.ValidationError("Ensure this field has no more than 2000 "
+                                              "characters.")
+        return value
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from environments.models import Environment
+from environments.versions import invalidate_environment, invalidate_identities
+from .models import Feature, FeatureState, FeatureStateChange, FeatureStateValue
+
+
+def invalidate_feature_state(feature_state):
+    if feature_state.identity_id is not None:
+        environment_id = feature_state.environment_id or feature_state.identity.environment_id
+        invalidate_identities(environment_id)
+    elif feature_state.environment_id is not None:
+        invalidate_environment(feature_state.environment_id)
+
+
+def record_feature_state_change(feature_state, change_type):
+    # only the environment defaults are sent to clients as deltas
+    if feature_state.identity_id is None and feature_state.environment_id is not None:
+        FeatureStateChange.record(feature_state.environment_id, [feature_state.feature_id],
+                                  change_type)
+
+
+@receiver(post_save, sender=Feature)
+@receiver(post_delete, sender=Feature)
+def invalidate_feature(sender, instance, **kwargs):
+    environment_ids = Environment.objects.filter(project_id=instance.project_id)\
+        .values_list('id', flat=True)
+    for environment_id in environment_ids:
+        invalidate_environment(environment_id)
+
+
+@receiver(post_save, sender=FeatureState)
+@receiver(post_delete, sender=FeatureState)
+def invalidate_feature_state_receiver(sender, instance, **kwargs):
+    invalidate_feature_state(instance)
+
+
+@receiver(post_save, sender=FeatureState)
+def record_feature_state_save(sender, instance, created, **kwargs):
+    record_feature_state_change(
+        instance, FeatureStateChange.ADDED if created else FeatureStateChange.CHANGED)
+
+
+@receiver(post_delete, sender=FeatureState)
+def record_feature_state_delete(sender, instance, **kwargs):
+    record_feature_state_change(instance, FeatureStateChange.REMOVED)
+
+
+@receiver(post_save, sender=FeatureStateValue)
+@receiver(post_delete, sender=FeatureStateValue)
+def invalidate_feature_state_value(sender, instance, **kwargs):
+    try:
+        feature_state = instance.feature_state
+    except ObjectDoesNotExist:
+        return
+
+    invalidate_feature_state(feature_state)
+
+
+@receiver(post_save, sender=FeatureStateValue)
+def record_feature_state_value_change(sender, instance, **kwargs):
+    try:
+        feature_state = instance.feature_state
+    except ObjectDoesNotExist:
+        return
+
+    record_feature_state_change(feature_state, FeatureStateChange.CHANGED)
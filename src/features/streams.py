@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import logging
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Case, F, Max, When
+from django.utils.six.moves import queue
+
+from environments.versions import environment_versions, invalidate_environment
+from .changes import get_flags_delta, get_settled_before
+from .models import FeatureStateChange
+
+logger = logging.getLogger(__name__)
+
+
+def can_hold_requests():
+    """
+    Whether requests can wait for changes without tying up a worker process, as under gunicorn's
+    gevent and eventlet workers, which patch the standard library so that waiting yields to other
+    requests. See FLAG_STREAMS_HOLD_REQUESTS.
+    """
+    if settings.FLAG_STREAMS_HOLD_REQUESTS is not None:
+        return settings.FLAG_STREAMS_HOLD_REQUESTS
+
+    gevent_monkey = sys.modules.get('gevent.monkey')
+    if gevent_monkey is not None and gevent_monkey.is_module_patched('socket'):
+        return True
+    eventlet_patcher = sys.modules.get('eventlet.patcher')
+    return eventlet_patcher is not None and eventlet_patcher.is_monkey_patched('socket')
+
+
+class Subscription(object):
+    """
+    A stream's subscription to the changes of an environment. Deltas are put on the
+    subscription's queue by the change listener for the stream to send.
+    """
+
+    def __init__(self, environment_id, version):
+        self.environment_id = environment_id
+        self.version = version
+        self.queue = queue.Queue()
+        # a new subscription is sent the changes since its version on the next poll
+        self.pending = True
+        self.last_delta = None
+
+    def send(self, delta):
+        self.pending = False
+
+        # changes that haven't settled are in each delta until they have, so are only sent again
+        # when the delta differs
+        if (delta['full'] or delta['added'] or delta['changed'] or delta['removed']) and \
+                delta != self.last_delta:
+            self.queue.put(delta)
+        self.last_delta = delta
+        self.version = delta['version']
+
+
+class ChangeListener(object):
+    """
+    Single poller of the feature state change log per process, shared by all of the process's
+    flag streams and long polls. Each poll finds the latest change to each environment being
+    listened to with one query and works out the delta for each version that their streams are
+    at once, so that the number of queries doesn't grow with the number of streams and the
+    streams themselves never need a database connection while they wait.
+
+    Changes can commit out of order of id, so rather than only reading changes above the highest
+    id seen, each poll looks back over the changes made within the settle window, see
+    ``get_settled_before``. Streams whose version is behind the latest change to their
+    environment, as the version only moves on to changes once they have settled, are sent a
+    delta on every poll until they catch up, which picks up any change committed late.
+
+    Long polls wait on a single event per environment which is set, and replaced, each time the
+    environment changes and each time its settled version, the version long polls are given,
+    moves on.
+    """
+
+    def __init__(self):
+        self._subscriptions = defaultdict(set)
+        self._watchers = Counter()
+        self._change_events = {}
+        self._latest_versions = {}
+        self._settled_versions = {}
+        # reentrant as streams closed by the garbage collector unsubscribe from whichever thread
+        # it runs in, which may already hold the lock
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def subscribe(self, environment_id, version):
+        subscription = Subscription(environment_id, version)
+        with self._lock:
+            self._subscriptions[environment_id].add(subscription)
+
+        self.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.environment_id, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.environment_id, None)
+
+    def watch(self, environment_id):
+        """
+        Get the event that is set on the environment's next change. Must be paired with a call to
+        ``unwatch`` once the caller is no longer waiting.
+        """
+        with self._lock:
+            self._watchers[environment_id] += 1
+            change_event = self._change_events.setdefault(environment_id, threading.Event())
+
+        self.start()
+        return change_event
+
+    def get_change_event(self, environment_id):
+        """
+        Get the event that is set on the next change to an environment already being watched.
+        """
+        with self._lock:
+            return self._change_events.setdefault(environment_id, threading.Event())
+
+    def unwatch(self, environment_id):
+        with self._lock:
+            self._watchers[environment_id] -= 1
+            if self._watchers[environment_id] <= 0:
+                del self._watchers[environment_id]
+                self._change_events.pop(environment_id, None)
+
+    def observe(self, environment_id, version, settled_version=0):
+        """
+        Note the latest change, and latest settled change, to an environment seen by this process.
+        The first time either is seen anything watching the environment is woken. The first time
+        a change is seen, unless versions are shared between processes, the environment's cached
+        flags are invalidated as the change may have been made by another process.
+        """
+        with self._lock:
+            changed = version > self._latest_versions.get(environment_id, 0)
+            settled = settled_version > self._settled_versions.get(environment_id, 0)
+            if not changed and not settled:
+                return
+
+            if changed:
+                self._latest_versions[environment_id] = version
+            if settled:
+                self._settled_versions[environment_id] = settled_version
+            change_event = self._change_events.pop(environment_id, None)
+            if change_event is not None:
+                self._change_events[environment_id] = threading.Event()
+
+        if changed and not environment_versions.shared:
+            invalidate_environment(environment_id)
+        if change_event is not None:
+            change_event.set()
+
+    def clear(self):
+        with self._lock:
+            self._subscriptions.clear()
+            self._watchers.clear()
+            self._change_events.clear()
+            self._latest_versions.clear()
+            self._settled_versions.clear()
+
+    def start(self):
+        """
+        Start polling in the background unless already started. With FLAG_STREAM_POLL_INTERVAL
+        set to 0 the listener only polls when ``poll`` is called.
+        """
+        if not settings.FLAG_STREAM_POLL_INTERVAL:
+            return
+
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run, name='flag-change-listener')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Failed to poll for feature state changes")
+                # start again with a new connection in case the old one is broken
+                connection.close()
+
+            time.sleep(settings.FLAG_STREAM_POLL_INTERVAL)
+
+    def poll(self):
+        with self._lock:
+            subscriptions = dict((environment_id, list(environment_subscriptions))
+                                 for environment_id, environment_subscriptions
+                                 in self._subscriptions.items())
+            environment_ids = set(subscriptions) | set(self._watchers)
+            # versions of environments no longer listened to would go stale, so are forgotten
+            for environment_id in set(self._latest_versions) - environment_ids:
+                del self._latest_versions[environment_id]
+                self._settled_versions.pop(environment_id, None)
+            new_environment_ids = environment_ids - set(self._latest_versions)
+
+        if not environment_ids:
+            return
+
+        settled_before = get_settled_before()
+        if new_environment_ids:
+            # the latest change to an environment before it was listened to isn't news
+            versions = list(self._get_versions(FeatureStateChange.objects.filter(
+                environment_id__in=list(new_environment_ids)), settled_before))
+            with self._lock:
+                for environment_id in new_environment_ids:
+                    self._latest_versions.setdefault(environment_id, 0)
+                    self._settled_versions.setdefault(environment_id, 0)
+                for environment_id, version, settled_version in versions:
+                    self._latest_versions[environment_id] = max(
+                        version, self._latest_versions[environment_id])
+                    self._settled_versions[environment_id] = max(
+                        settled_version or 0, self._settled_versions[environment_id])
+
+        # looks back a poll interval (at least a second) past the settle window so that changes
+        # made, or settled, while the last poll ran are still seen
+        look_back = settled_before - timedelta(seconds=max(settings.FLAG_STREAM_POLL_INTERVAL, 1))
+        changes = self._get_versions(FeatureStateChange.objects.filter(
+            environment_id__in=list(environment_ids), created_date__gte=look_back), settled_before)
+        for environment_id, version, settled_version in changes:
+            self.observe(environment_id, version, settled_version or 0)
+
+        deltas = {}
+        for environment_id, environment_subscriptions in subscriptions.items():
+            latest_version = self._latest_versions.get(environment_id, 0)
+            for subscription in environment_subscriptions:
+                if subscription.version >= latest_version and not subscription.pending:
+                    continue
+
+                key = (environment_id, subscription.version)
+                if key not in deltas:
+                    deltas[key] = get_flags_delta(environment_id, subscription.version)
+                subscription.send(deltas[key])
+
+    @staticmethod
+    def _get_versions(changes, settled_before):
+        # the latest change, and latest settled change, to each environment
+        return changes.order_by().values('environment_id').annotate(
+            version=Max('id'),
+            settled_version=Max(Case(When(created_date__lte=settled_before, then=F('id')))),
+        ).values_list('environment_id', 'version', 'settled_version')
+
+
+change_listener = ChangeListener()
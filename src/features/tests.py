@@ -1,7 +1,14 @@
+from django.db import connection
 from django.test import TestCase
+from django.utils import six
+from rest_framework.renderers import JSONRenderer
 
-from environments.models import Environment
-from .models import Feature, FeatureState
+from environments.models import Environment, Identity
+from .cache import CONTENT_ENCODINGS, get_content_encoding
+from .encoders import get_feature_state_rows, render_feature_states
+from .models import Feature, FeatureState, FeatureStateChange, FeatureStateValue, INTEGER, \
+    BOOLEAN
+from .serializers import FeatureStateSerializerFull
 from organisations.models import Organisation
 from projects.models import Project
 
@@ -30,4 +37,193 @@ class FeatureTestCase(TestCase):
         feature_states = FeatureState.objects.filter(feature=feature)
 
         for feature_state in feature_states:
-            self.assertEquals(feature_state.get_feature_state_value(), "This is a value")
\ No newline at end of file
+            self.assertEquals(feature_state.get_feature_state_value(), "This is a value")
+
+    def test_creating_feature_should_record_addition_to_each_environment(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project)
+
+        changes = FeatureStateChange.objects.filter(feature_id=feature.id)
+
+        self.assertEquals(sorted(changes.values_list('environment_id', 'change_type')),
+                          [(self.environment_one.id, FeatureStateChange.ADDED),
+                           (self.environment_two.id, FeatureStateChange.ADDED)])
+
+    def test_creating_feature_should_not_need_queries_per_environment(self):
+        Environment.objects.create(name="Test Environment 3", project=self.project)
+
+        # savepoint, insert, environments, feature states, values and changes, plus the signals
+        with self.assertNumQueries(9):
+            Feature.objects.create(name="Test Feature", project=self.project)
+
+    def test_changing_default_enabled_should_update_environment_feature_states(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project)
+        FeatureState.objects.filter(feature=feature, environment=self.environment_one)\
+            .update(enabled=True)
+
+        feature.default_enabled = True
+        feature.save()
+
+        self.assertEquals(FeatureState.objects.filter(feature=feature, enabled=True).count(), 2)
+
+    def test_updating_feature_description_should_leave_feature_states_alone(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project)
+        FeatureState.objects.filter(feature=feature, environment=self.environment_one)\
+            .update(enabled=True)
+
+        feature.description = "A description"
+        # savepoint, old feature, update, plus the signals
+        with self.assertNumQueries(7):
+            feature.save()
+
+        feature_state = FeatureState.objects.get(feature=feature, environment=self.environment_one)
+        self.assertTrue(feature_state.enabled)
+
+    def test_saving_unchanged_feature_should_not_record_changes(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project)
+
+        Feature.objects.get(pk=feature.pk).save()
+
+        self.assertFalse(FeatureStateChange.objects.filter(
+            feature_id=feature.id, change_type=FeatureStateChange.CHANGED).exists())
+
+    def test_renaming_feature_should_record_change_to_each_environment(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project)
+
+        feature.name = "Renamed Feature"
+        feature.save()
+
+        changes = FeatureStateChange.objects.filter(feature_id=feature.id,
+                                                    change_type=FeatureStateChange.CHANGED)
+        self.assertEquals(sorted(changes.values_list('environment_id', flat=True)),
+                          [self.environment_one.id, self.environment_two.id])
+
+    def test_moving_feature_should_record_it_as_added_to_new_environments(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project)
+        project = Project.objects.create(name="Other Project", organisation=self.organisation)
+        environment = Environment.objects.create(name="Other Environment", project=project)
+
+        feature.project = project
+        feature.save()
+
+        self.assertEquals(list(FeatureStateChange.objects.filter(
+            environment=environment, feature_id=feature.id).values_list('change_type', flat=True)),
+            [FeatureStateChange.ADDED])
+        self.assertEquals(list(FeatureStateChange.objects.filter(
+            environment=self.environment_one, feature_id=feature.id)
+            .values_list('change_type', flat=True)),
+            [FeatureStateChange.ADDED, FeatureStateChange.REMOVED])
+
+    def test_moving_feature_should_replace_feature_states(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project,
+                                         initial_value="value")
+        project = Project.objects.create(name="Other Project", organisation=self.organisation)
+        environment = Environment.objects.create(name="Other Environment", project=project)
+
+        feature.project = project
+        feature.save()
+
+        feature_state = FeatureState.objects.get(feature=feature)
+        self.assertEquals(feature_state.environment, environment)
+        self.assertEquals(feature_state.get_feature_state_value(), "value")
+
+    def test_filter_by_name_should_be_case_insensitive(self):
+        feature = Feature.objects.create(name="Test Feature", project=self.project)
+
+        features = Feature.objects.filter(project=self.project).filter_by_name("TEST feature")
+
+        self.assertEquals(list(features), [feature])
+
+
+class FeatureStateIndexesTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        organisation = Organisation.objects.create(name="Test Org")
+        project = Project.objects.create(name="Test Project", organisation=organisation)
+        Feature.objects.bulk_create([Feature(name="Feature %d" % i, project=project)
+                                     for i in range(30)])
+        # environments are created with a default feature state for each feature
+        environments = [Environment.objects.create(name="Environment %d" % i, project=project)
+                        for i in range(20)]
+        cls.environment, cls.other_environment = environments[:2]
+        Identity.objects.bulk_create([Identity(identifier="user%d" % i, environment=cls.environment)
+                                      for i in range(10)])
+        cls.identity = Identity.objects.get(identifier="user1", environment=cls.environment)
+        cls.feature = project.features.first()
+        FeatureState.objects.bulk_create([
+            FeatureState(feature=feature, environment=cls.environment, identity=identity)
+            for identity in cls.environment.identities.all()
+            for feature in project.features.all()
+        ])
+
+    def get_plan(self, queryset):
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE features_featurestate')
+            cursor.execute('ANALYZE environments_identity')
+            if connection.vendor == 'postgresql':
+                # the tables are too small for an index scan to be cheaper than reading them
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + sql, params)
+            else:
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return ' '.join(six.text_type(row) for row in cursor.fetchall())
+
+    def test_environment_feature_states_are_found_with_partial_index(self):
+        plan = self.get_plan(FeatureState.objects.filter(environment=self.other_environment,
+                                                         identity=None))
+
+        self.assertIn('features_featurestate_environment_defaults', plan)
+
+    def test_identity_override_is_found_with_identity_and_feature_index(self):
+        plan = self.get_plan(FeatureState.objects.filter(identity=self.identity,
+                                                         feature=self.feature))
+
+        self.assertIn('features_featurestate_identity_feature', plan)
+
+    def test_identity_is_found_with_environment_and_identifier_index(self):
+        plan = self.get_plan(Identity.objects.filter(environment=self.environment,
+                                                     identifier="user1"))
+
+        self.assertIn('environment_id_identifier', plan)
+
+
+class FeatureStateEncoderTestCase(TestCase):
+    def setUp(self):
+        organisation = Organisation.objects.create(name="Test Org")
+        self.project = Project.objects.create(name="Test Project", organisation=organisation)
+        self.environment = Environment.objects.create(name="Test Environment",
+                                                      project=self.project)
+
+    def test_encoder_should_render_the_same_json_as_the_serializer(self):
+        # Given
+        Feature.objects.create(name="string feature", project=self.project,
+                               initial_value="caf\u00e9 \u2028", description="Description")
+        integer_feature = Feature.objects.create(name="integer feature", project=self.project,
+                                                 default_enabled=True)
+        boolean_feature = Feature.objects.create(name="boolean feature", project=self.project)
+        Feature.objects.create(name="feature without value", project=self.project)
+        FeatureStateValue.objects.filter(feature_state__feature=integer_feature)\
+            .update(type=INTEGER, integer_value=10)
+        FeatureStateValue.objects.filter(feature_state__feature=boolean_feature)\
+            .update(type=BOOLEAN, boolean_value=False)
+        FeatureStateValue.objects.filter(feature_state__feature__name="feature without value")\
+            .delete()
+        feature_states = FeatureState.objects.filter(environment=self.environment)
+
+        # When
+        encoded = render_feature_states(get_feature_state_rows(feature_states))
+
+        # Then
+        serialized = JSONRenderer().render(
+            FeatureStateSerializerFull(feature_states, many=True).data)
+        self.assertEqual(encoded, serialized)
+
+
+class ContentEncodingTestCase(TestCase):
+    def test_should_choose_accepted_encoding_with_highest_quality(self):
+        self.assertEquals(get_content_encoding('br;q=0.5, gzip;q=0.8'), 'gzip')
+        self.assertEquals(get_content_encoding('deflate, *;q=0.1'), CONTENT_ENCODINGS[0])
+
+    def test_should_not_choose_encoding_if_none_accepted(self):
+        self.assertIsNone(get_content_encoding(''))
+        self.assertIsNone(get_content_encoding('deflate, gzip;q=0'))
@@ -1,16 +1,36 @@
+from collections import OrderedDict, defaultdict
+
 import coreapi
+from django.conf import settings
+from django.db import connection
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import six
+from django.utils.six.moves import queue
+from django.utils.cache import get_conditional_response, patch_vary_headers
 from rest_framework import status, viewsets
-from rest_framework.generics import GenericAPIView, get_object_or_404
+from rest_framework.decorators import action
+from rest_framework.generics import GenericAPIView
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework.schemas import AutoSchema
 
+from app.pagination import OptionalCursorPagination
+from environments.cache import environment_keys_cache
+from environments.mixins import NestedEnvironmentMixin
 from environments.models import Environment, Identity
+from environments.registrations import identity_registrations
+from environments.versions import environment_versions
 from projects.models import Project
+from .cache import environment_flags_cache, feature_names_cache, get_content_encoding, \
+    get_encoded_etag, get_environment_flags_etag, get_identity_flags_etag
+from .changes import get_changes_version, get_flags_delta, get_latest_version
+from .encoders import FEATURE_STATE_FIELDS, feature_state_to_dict, get_feature_state_rows, \
+    is_identity_override, render, render_feature_states
 from .models import FeatureState, Feature
+from .streams import can_hold_requests, change_listener
 from .serializers import FeatureStateSerializerBasic, FeatureStateSerializerFull, \
     FeatureStateSerializerCreate, CreateFeatureSerializer, FeatureSerializer, \
-    FeatureStateValueSerializer
+    FeatureStateValueSerializer, FeatureStateBulkUpdateSerializer
 
 
 class FeatureViewSet(viewsets.ModelViewSet):
@@ -27,13 +47,14 @@ class FeatureViewSet(viewsets.ModelViewSet):
         return project.features.all()
 
 
-class FeatureStateViewSet(viewsets.ModelViewSet):
+class FeatureStateViewSet(NestedEnvironmentMixin, viewsets.ModelViewSet):
     """
     View set to manage feature states. Nested beneath environments and environments + identities
     to allow for filtering on both.
 
     list:
-    Get feature states for an environment or identity if provided
+    Get feature states for an environment or identity if provided. Pass a cursor parameter,
+    empty for the first page, to page through them in order of id
 
     create:
     Create feature state for an environment or identity if provided
@@ -49,7 +70,11 @@ class FeatureStateViewSet(viewsets.ModelViewSet):
 
     delete:
     Delete specific feature state
+
+    bulk:
+    Update several of an environment's feature states together, in a single transaction
     """
+    pagination_class = OptionalCursorPagination
 
     # Override serializer class to show correct information in docs
     def get_serializer_class(self):
@@ -63,31 +88,16 @@ class FeatureStateViewSet(viewsets.ModelViewSet):
         """
         Override queryset to filter based on provided URL parameters.
         """
-        environment_api_key = self.kwargs['environment_api_key']
-        identifier = self.kwargs.get('identity_identifier')
-        environment = Environment.objects.get(api_key=environment_api_key)
+        queryset = FeatureState.objects.filter(
+            environment_id=self.get_environment_from_request().id,
+            identity=self.get_identity_from_request(),
+        ).select_related('feature_state_value')
 
-        if identifier:
-            identity = Identity.objects.get(identifier=identifier, environment=environment)
-        else:
-            identity = None
+        if self.action in ('update', 'partial_update'):
+            # needed to validate that the feature state is unique
+            queryset = queryset.select_related('feature', 'environment', 'identity')
 
-        return FeatureState.objects.filter(environment=environment, identity=identity)
-
-    def get_environment_from_request(self):
-        """
-        Get environment object from URL parameters in request.
-        """
-        environment = Environment.objects.get(api_key=self.kwargs['environment_api_key'])
-        return environment
-
-    def get_identity_from_request(self, environment):
-        """
-        Get identity object from URL parameters in request.
-        """
-        identity = Identity.objects.get(identifier=self.kwargs['identity_identifier'],
-                                        environment=environment)
-        return identity
+        return queryset
 
     def create(self, request, *args, **kwargs):
         """
@@ -103,12 +113,12 @@ class FeatureStateViewSet(viewsets.ModelViewSet):
 
         feature_id = int(data['feature'])
 
-        if feature_id not in [feature.id for feature in environment.project.features.all()]:
+        if not Feature.objects.filter(id=feature_id, project_id=environment.project_id).exists():
             error = {"detail": "Feature does not exist in project"}
             return Response(error, status=status.HTTP_400_BAD_REQUEST)
 
-        if self.kwargs.get('identity_identifier', None):
-            identity = self.get_identity_from_request(environment)
+        identity = self.get_identity_from_request()
+        if identity:
             data['identity'] = identity.id
 
         serializer = FeatureStateSerializerBasic(data=data)
@@ -167,6 +177,48 @@ class FeatureStateViewSet(viewsets.ModelViewSet):
         """
         return self.update(request, *args, **kwargs)
 
+    @action(detail=False, methods=["PATCH"], serializer_class=FeatureStateBulkUpdateSerializer)
+    def bulk(self, request, *args, **kwargs):
+        """
+        Apply a list of changes of the form {"feature": <id>, "enabled": <bool>,
+        "feature_state_value": <value>}, where enabled and feature_state_value are optional, to
+        the environment's feature states. The changes are validated together and either all or
+        none of them are applied.
+        """
+        if self.get_identity_from_request() is not None:
+            error = {"detail": "Bulk updates are only available for environment feature states."}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        serializer = FeatureStateBulkUpdateSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        changes = serializer.validated_data
+        if not changes:
+            return Response([])
+
+        feature_ids = [change['feature'] for change in changes]
+        if len(set(feature_ids)) != len(feature_ids):
+            error = {"detail": "Each feature may only be changed once."}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        environment = self.get_environment_from_request()
+        feature_state_ids = dict(FeatureState.objects.filter(
+            environment_id=environment.id, identity=None, feature_id__in=feature_ids,
+        ).values_list('feature_id', 'id'))
+        missing_feature_ids = set(feature_ids) - set(feature_state_ids)
+        if missing_feature_ids:
+            error = {"detail": "Features %s do not exist in environment." %
+                               ", ".join(str(feature_id) for feature_id in
+                                         sorted(missing_feature_ids))}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        for change in changes:
+            change['feature_state'] = feature_state_ids[change['feature']]
+        FeatureState.objects.update_environment_feature_states(environment.id, changes)
+
+        feature_states = FeatureState.objects.filter(id__in=feature_state_ids.values())\
+            .select_related('feature_state_value')
+        return Response(FeatureStateSerializerBasic(feature_states, many=True).data)
+
     def update_feature_state_value(self, instance, value, feature_state):
         feature_state_value_dict = feature_state.generate_feature_state_value_data(value)
 
@@ -184,6 +236,13 @@ class FeatureStateViewSet(viewsets.ModelViewSet):
         return feature_state_value
 
 
+def get_environment_or_404(api_key):
+    try:
+        return environment_keys_cache.get(api_key)
+    except Environment.DoesNotExist:
+        raise Http404
+
+
 class SDKFeatureStates(GenericAPIView):
     serializer_class = FeatureStateSerializerFull
     permission_classes = (AllowAny,)
@@ -192,8 +251,15 @@ class SDKFeatureStates(GenericAPIView):
         manual_fields=[
             coreapi.Field("X-Environment-Key", location="header",
                           description="API Key for an Environment"),
+            coreapi.Field("If-None-Match", location="header",
+                          description="ETag of the flags previously returned for this request"),
             coreapi.Field("feature", location="query",
-                          description="Name of the feature to get the state of")
+                          description="Name of the feature to get the state of. Several features "
+                                      "can be given as a comma separated list."),
+            coreapi.Field("since", location="query",
+                          description="Version of the environment's flags the client already has. "
+                                      "Only the flags added, changed or removed since are "
+                                      "returned, use 0 to get all flags and the current version.")
         ]
     )
 
@@ -202,62 +268,435 @@ class SDKFeatureStates(GenericAPIView):
             error = {"detail": "Environment Key header not provided"}
             return Response(error, status=status.HTTP_400_BAD_REQUEST)
 
-        environment = get_object_or_404(Environment, api_key=request.META['HTTP_X_ENVIRONMENT_KEY'])
+        api_key = request.META['HTTP_X_ENVIRONMENT_KEY']
+
+        if not identifier and 'since' in request.GET:
+            return self.get_flags_delta(request, api_key)
+
+        if not identifier and 'feature' not in request.GET:
+            return self.get_environment_flags(request, api_key)
+
+        environment = get_environment_or_404(api_key)
+
+        # the ETag must be generated before the feature states are read so that a change made in
+        # the meantime can only result in a stale ETag rather than a stale response
+        if identifier:
+            etag = get_identity_flags_etag(environment.id)
+        else:
+            etag = get_environment_flags_etag(environment.id)
+
+        not_modified = self.get_not_modified_response(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        response = self.get_flags(request, environment, identifier)
+        if response.status_code == status.HTTP_200_OK:
+            response['ETag'] = etag
+        return response
 
+    def get_flags(self, request, environment, identifier):
+        identity = None
         if identifier:
             try:
-                identity = Identity.objects.get(identifier=identifier, environment=environment)
+                identity = Identity.objects.get(identifier=identifier,
+                                                environment_id=environment.id)
             except Identity.DoesNotExist:
-                identity = Identity.objects.create(identifier=identifier, environment=environment)
+                # an unknown identity can't have any overrides so gets the environment defaults,
+                # the identity itself is created later by the registration buffer
+                identity_registrations.add(environment.id, identifier)
 
-            if 'feature' in request.GET:
-                try:
-                    feature = Feature.objects.get(name__iexact=request.GET['feature'],
-                                                  project=environment.project)
-                except Feature.DoesNotExist:
-                    error = {"detail": "Given feature not found"}
-                    return Response(error, status=status.HTTP_404_NOT_FOUND)
+        if 'feature' in request.GET:
+            return self.get_feature_flags(request, environment, identity)
 
-                try:
-                    feature_state = FeatureState.objects.get(identity=identity,
-                                                             feature=feature,
-                                                             environment=environment)
-                except FeatureState.DoesNotExist:
-                    feature_state = FeatureState.objects.get(feature=feature,
-                                                             environment=environment,
-                                                             identity=None)
-                    return Response(self.get_serializer(feature_state).data,
-                                    status=status.HTTP_200_OK)
-                return Response(self.get_serializer(feature_state).data,
-                                status=status.HTTP_200_OK)
-
-            identity_flags, environment_flags = identity.get_all_feature_states()
-
-            serialized_env_flags = self.get_serializer(environment_flags, many=True)
-            serialized_id_flags = self.get_serializer(identity_flags, many=True)
-
-            return Response(serialized_env_flags.data + serialized_id_flags.data,
-                            status=status.HTTP_200_OK)
+        if identity is None:
+            cached_flags = environment_flags_cache.get(environment.api_key) or \
+                self.cache_environment_flags(environment)
+            return HttpResponse(cached_flags.document, content_type='application/json')
+
+        # environment defaults are listed before the identity overrides
+        rows = sorted(get_feature_state_rows(identity.get_effective_feature_states()),
+                      key=is_identity_override)
+        return HttpResponse(render_feature_states(rows), content_type='application/json')
+
+    def get_feature_flags(self, request, environment, identity=None):
+        """
+        Get the flags for the features named in the request, resolved with a single query. A
+        single feature is returned on its own, several features (given by repeating the parameter
+        or, when a single name isn't a feature's, as a comma separated list) are returned as a
+        list. Any names that aren't features' are reported as not found.
+        """
+        feature_names = request.GET.getlist('feature')
+        feature_ids = feature_names_cache.get_feature_ids(environment, feature_names)
+        single_feature = len(feature_names) == 1
+        if single_feature and not feature_ids and ',' in feature_names[0]:
+            feature_names = [name.strip() for name in feature_names[0].split(',') if name.strip()]
+            feature_ids = feature_names_cache.get_feature_ids(environment, feature_names)
+            single_feature = False
+
+        missing_features = [name for name in feature_names if name not in feature_ids]
+        if missing_features:
+            if single_feature:
+                error = {"detail": "Given feature not found"}
+            else:
+                error = {"detail": "Given features not found", "features": missing_features}
+            return Response(error, status=status.HTTP_404_NOT_FOUND)
+
+        if identity:
+            feature_states = identity.get_effective_feature_states(list(feature_ids.values()))
+        else:
+            feature_states = FeatureState.objects.filter(environment_id=environment.id,
+                                                         identity=None,
+                                                         feature__in=list(feature_ids.values()))
+        flags = [feature_state_to_dict(row) for row in
+                 sorted(get_feature_state_rows(feature_states), key=is_identity_override)]
+
+        if single_feature:
+            if not flags:
+                error = {"detail": "Given feature not found"}
+                return Response(error, status=status.HTTP_404_NOT_FOUND)
+
+            return HttpResponse(render(flags[0]), content_type='application/json')
+
+        return HttpResponse(render(flags), content_type='application/json')
+
+    def get_flags_delta(self, request, api_key):
+        try:
+            since = int(request.GET['since'])
+        except ValueError:
+            since = -1
+
+        if since < 0:
+            error = {"detail": "Version must be a positive integer"}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        environment = get_environment_or_404(api_key)
+        return HttpResponse(render(get_flags_delta(environment.id, since)),
+                            content_type='application/json')
+
+    def get_environment_flags(self, request, api_key):
+        """
+        Serve the flags for an environment from the rendered document cache, rendering and
+        caching the document first if the environment has changed since it was last cached.
+        """
+        content_encoding = get_content_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        cached_flags = environment_flags_cache.get(api_key)
+
+        if cached_flags is None:
+            environment = get_environment_or_404(api_key)
+            # the version must be read before the feature states so that a change made while
+            # rendering leaves the cached document stale rather than the change missed
+            version = environment_versions.get(environment.id)
+
+            etag = get_encoded_etag(get_environment_flags_etag(environment.id, version),
+                                    content_encoding)
+            not_modified = self.get_not_modified_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+
+            cached_flags = self.cache_environment_flags(environment, version)
+        else:
+            etag = get_encoded_etag(cached_flags.etag, content_encoding)
+            not_modified = self.get_not_modified_response(request, etag)
+            if not_modified is not None:
+                return not_modified
+
+        if content_encoding:
+            response = HttpResponse(cached_flags.encoded_documents[content_encoding],
+                                    content_type='application/json')
+            response['Content-Encoding'] = content_encoding
+        else:
+            response = HttpResponse(cached_flags.document, content_type='application/json')
+
+        response['ETag'] = etag
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def cache_environment_flags(self, environment, version=None):
+        """
+        Render the flags document for an environment and add it to the cache.
+        """
+        if version is None:
+            version = environment_versions.get(environment.id)
+
+        environment_flags = FeatureState.objects.filter(environment_id=environment.id,
+                                                        identity=None)
+        document = render_feature_states(get_feature_state_rows(environment_flags))
+        return environment_flags_cache.set(environment.api_key, environment.id, version, document)
+
+    @staticmethod
+    def get_not_modified_response(request, etag):
+        """
+        Get a 304 response if the client already has the flags identified by the given ETag,
+        otherwise None.
+        """
+        not_modified = get_conditional_response(request, etag=etag)
+        if not_modified is not None:
+            not_modified['ETag'] = etag
+            patch_vary_headers(not_modified, ('Accept-Encoding',))
+        return not_modified
+
+
+class SDKFeatureStatesLongPoll(SDKFeatureStates):
+    """
+    Long-poll variant of the environment flags endpoint for clients that can't use the stream.
+    The client passes the version of the flags it has (0 if none) and the request waits until
+    the environment has changed since, returning the new flags, or until FLAG_LONG_POLL_TIMEOUT
+    has passed, returning 304. A client without flags is sent them straight away. The version of
+    the flags returned, given in the X-Environment-Version header, is the settled version used by
+    the delta mode of the flags endpoint, so that a change committed after others with a higher id
+    is still sent once it has settled.
+
+    Waiting requests don't hold a database connection but, like the stream, are only held by
+    asynchronous workers. A synchronous worker returns 304 straight away with a Retry-After of
+    FLAG_SYNC_WORKER_RETRY_INTERVAL rather than being tied up by the client.
+    """
+    schema = AutoSchema(
+        manual_fields=[
+            coreapi.Field("X-Environment-Key", location="header",
+                          description="API Key for an Environment"),
+            coreapi.Field("version", location="query",
+                          description="Version of the environment's flags the client already has")
+        ]
+    )
+
+    def get(self, request, *args, **kwargs):
+        if 'HTTP_X_ENVIRONMENT_KEY' not in request.META:
+            error = {"detail": "Environment Key header not provided"}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            version = int(request.GET.get('version', 0))
+        except ValueError:
+            version = -1
+
+        if version < 0:
+            error = {"detail": "Version must be a positive integer"}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        environment = get_environment_or_404(request.META['HTTP_X_ENVIRONMENT_KEY'])
+
+        # start watching before checking for changes so that none can be missed in between
+        change_listener.watch(environment.id)
+        try:
+            latest_version = get_latest_version(environment.id)
+            settled_version = get_changes_version(environment.id)
+            # the change may have been made by another process so the cached flags of this one
+            # can't be trusted until the listener has seen it
+            change_listener.observe(environment.id, latest_version, settled_version)
+
+            # a client without flags gets them straight away, even from an environment that
+            # hasn't changed since its change log began, whose settled version is also 0
+            if version and settled_version <= version:
+                if not can_hold_requests():
+                    response = self.get_not_modified_response_for_version(version)
+                    response['Retry-After'] = settings.FLAG_SYNC_WORKER_RETRY_INTERVAL
+                    return response
+
+                # the connection isn't needed while waiting so is given up rather than held
+                if not connection.in_atomic_block:
+                    connection.close()
+
+                # woken by a new change or by the settled version moving on, the client only
+                # having the flags of the changes made before its last request. The event is
+                # fetched once the versions just read have been observed, which may have set it.
+                change_event = change_listener.get_change_event(environment.id)
+                if not change_event.wait(settings.FLAG_LONG_POLL_TIMEOUT):
+                    return self.get_not_modified_response_for_version(version)
+
+                settled_version = get_changes_version(environment.id)
+                if settled_version <= version and \
+                        get_latest_version(environment.id) <= latest_version:
+                    return self.get_not_modified_response_for_version(version)
+        finally:
+            change_listener.unwatch(environment.id)
+
+        response = self.get_environment_flags(request, environment.api_key)
+        response['X-Environment-Version'] = settled_version
+        return response
+
+    @staticmethod
+    def get_not_modified_response_for_version(version):
+        response = HttpResponse(status=status.HTTP_304_NOT_MODIFIED)
+        response['X-Environment-Version'] = version
+        return response
+
+
+class SDKFlagsStream(GenericAPIView):
+    """
+    Server-Sent Events stream of the changes to an environment's flags. The first event holds
+    all of the flags (or the changes since the version given) and each later event holds the
+    flags added, changed or removed since the one before, in the same form as the delta mode of
+    the flags endpoint. The id of each event is the version to resume from.
+
+    Streams are long lived so are only held open by asynchronous workers, e.g. gunicorn's gevent
+    worker. A synchronous worker sends the changes there are and ends the stream, telling the
+    client to reconnect after FLAG_SYNC_WORKER_RETRY_INTERVAL, rather than being tied up by it.
+
+    Browsers' EventSource can't send headers, so the key can be given as the environment_key
+    query parameter instead of the X-Environment-Key header.
+    """
+    permission_classes = (AllowAny,)
+
+    schema = AutoSchema(
+        manual_fields=[
+            coreapi.Field("X-Environment-Key", location="header",
+                          description="API Key for an Environment"),
+            coreapi.Field("environment_key", location="query",
+                          description="API Key for an Environment, for clients that can't set "
+                                      "the header"),
+            coreapi.Field("Last-Event-ID", location="header",
+                          description="Id of the last event received, to resume the stream from"),
+            coreapi.Field("since", location="query",
+                          description="Version of the environment's flags the client already has")
+        ]
+    )
+
+    def get(self, request, *args, **kwargs):
+        api_key = request.META.get('HTTP_X_ENVIRONMENT_KEY') or \
+            request.GET.get('environment_key')
+        if not api_key:
+            error = {"detail": "Environment Key header not provided"}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            since = int(request.META.get('HTTP_LAST_EVENT_ID') or request.GET.get('since', 0))
+        except ValueError:
+            since = -1
+
+        if since < 0:
+            error = {"detail": "Version must be a positive integer"}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        environment = get_environment_or_404(api_key)
 
+        if can_hold_requests():
+            # the change listener does all of the querying for the stream so the connection can
+            # be given up rather than held open for as long as the client is connected
+            if not connection.in_atomic_block:
+                connection.close()
+            events = self.stream_events(environment.id, since)
         else:
-            if 'feature' in request.GET:
+            events = self.get_events(environment.id, since)
+
+        response = StreamingHttpResponse(events, content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # stop nginx from buffering the events
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    def stream_events(self, environment_id, since):
+        subscription = change_listener.subscribe(environment_id, since)
+
+        try:
+            # sent straight away so that the response starts before the first change arrives
+            yield b': connected\n\n'
+
+            while True:
                 try:
-                    feature = Feature.objects.get(name__iexact=request.GET['feature'],
-                                                  project=environment.project)
-                except Feature.DoesNotExist:
-                    error = {"detail": "Given feature not found"}
-                    return Response(error, status=status.HTTP_404_NOT_FOUND)
-
-                environment_flag = FeatureState.objects.get(environment=environment,
-                                                               identity=None,
-                                                               feature=feature)
-                return Response(self.get_serializer(environment_flag).data,
-                                status=status.HTTP_200_OK)
-            else:
-                environment_flags = FeatureState.objects.filter(environment=environment,
-                                                                identity=None)
-                return Response(self.get_serializer(environment_flags, many=True).data,
-                                status=status.HTTP_200_OK)
+                    delta = subscription.queue.get(
+                        timeout=settings.FLAG_STREAM_KEEPALIVE_INTERVAL)
+                except queue.Empty:
+                    yield b': keepalive\n\n'
+                    continue
+
+                yield self.render_event(delta)
+        finally:
+            change_listener.unsubscribe(subscription)
+
+    def get_events(self, environment_id, since):
+        retry = ('retry: %d\n\n' % (settings.FLAG_SYNC_WORKER_RETRY_INTERVAL * 1000))\
+            .encode('utf-8')
+        delta = get_flags_delta(environment_id, since)
+        if delta['full'] or delta['added'] or delta['changed'] or delta['removed']:
+            return [retry, self.render_event(delta)]
+        return [retry]
+
+    @staticmethod
+    def render_event(delta):
+        return ('id: %d\nevent: flags\ndata: ' % delta['version']).encode('utf-8') + \
+            render(delta) + b'\n\n'
+
+
+class SDKIdentitiesFeatureStates(GenericAPIView):
+    """
+    Get the flags for many identities of an environment in a single request. Identities are
+    resolved in chunks, each using a constant number of queries, and the response is streamed as
+    each chunk is resolved so that large batches aren't built up in memory.
+    """
+    serializer_class = FeatureStateSerializerFull
+    permission_classes = (AllowAny,)
+    chunk_size = 500
+
+    schema = AutoSchema(
+        manual_fields=[
+            coreapi.Field("X-Environment-Key", location="header",
+                          description="API Key for an Environment"),
+            coreapi.Field("identifiers", location="form", required=True,
+                          description="List of identifiers to get the flags of")
+        ]
+    )
+
+    def post(self, request, *args, **kwargs):
+        if 'HTTP_X_ENVIRONMENT_KEY' not in request.META:
+            error = {"detail": "Environment Key header not provided"}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        identifiers = request.data.get('identifiers')
+        if not isinstance(identifiers, list) or \
+                not all(isinstance(identifier, six.string_types) for identifier in identifiers):
+            error = {"detail": "List of identifiers must be provided"}
+            return Response(error, status=status.HTTP_400_BAD_REQUEST)
+
+        environment = get_environment_or_404(request.META['HTTP_X_ENVIRONMENT_KEY'])
+
+        # remove duplicates but keep the order the identifiers were given in
+        identifiers = list(OrderedDict.fromkeys(identifiers))
+
+        return StreamingHttpResponse(self.stream_flags(environment, identifiers),
+                                     content_type='application/json')
+
+    def stream_flags(self, environment, identifiers):
+        """
+        Generate a JSON list of the identifiers and their flags, in the same form as returned for a
+        single identity.
+        """
+        environment_flags = FeatureState.objects.filter(environment_id=environment.id,
+                                                        identity=None)
+        environment_flags = OrderedDict(
+            (row[1], feature_state_to_dict(row))
+            for row in get_feature_state_rows(environment_flags)
+        )
+
+        yield b'['
+        for i in range(0, len(identifiers), self.chunk_size):
+            chunk = identifiers[i:i + self.chunk_size]
+
+            known_identifiers = set(
+                Identity.objects.filter(environment_id=environment.id, identifier__in=chunk)
+                .values_list('identifier', flat=True)
+            )
+
+            identity_flags = defaultdict(list)
+            overrides = FeatureState.objects.filter(identity__environment_id=environment.id,
+                                                    identity__identifier__in=chunk)\
+                .values_list(*(FEATURE_STATE_FIELDS + ('identity__identifier',)))
+            for row in overrides:
+                identity_flags[row[-1]].append(feature_state_to_dict(row[:-1]))
+
+            for j, identifier in enumerate(chunk):
+                if identifier not in known_identifiers:
+                    identity_registrations.add(environment.id, identifier)
+
+                overridden_features = set(flag['feature']['id']
+                                          for flag in identity_flags[identifier])
+                flags = [flag for feature_id, flag in environment_flags.items()
+                         if feature_id not in overridden_features]
+                flags.extend(identity_flags[identifier])
+
+                if i + j:
+                    yield b','
+                yield render(OrderedDict((('identifier', identifier), ('flags', flags))))
+        yield b']'
 
 
 def organisation_has_got_feature(request, organisation):